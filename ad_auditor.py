@@ -1,132 +1,666 @@
 #!/usr/bin/env python3
 import configparser
-import mysql.connector
-from ldap3 import Server, Connection, ALL, Tls
-from datetime import date
+from datetime import date, timedelta
 import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+import threading
+import queue
+import time
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 import traceback
 import uuid
-from collections import defaultdict
+import zlib
+import socket
+from collections import defaultdict, deque
+from itertools import zip_longest
 import argparse
 from argparse import RawTextHelpFormatter
 import sys
 import ssl
-import boto3
 import json
+import gzip
+import csv
+import mail_templates
+
+# ldap3, mysql.connector, boto3 and asyncio are imported where they are first used:
+# together they cost ~400ms at startup, and most modes need only some of them.
+# ldap3's scope constants are plain strings, so they are mirrored here.
+BASE = 'BASE'
+SUBTREE = 'SUBTREE'
 
 # Parse arguments
 class WideHelpFormatter(argparse.HelpFormatter):
     def __init__(self, prog):
         super().__init__(prog, max_help_position=45, width=120)
 
-parser = argparse.ArgumentParser(
-    formatter_class=WideHelpFormatter
-)
-
-parser.add_argument('--dry-run', action='store_true', help='Preview actions without making changes')
-parser.add_argument('--list-managers', action='store_true', help='List unique managers from AD and exit')
-parser.add_argument('--list-manager-counts', action='store_true', help='List manager emails and number of users they manage')
-parser.add_argument('--send-all-audit-emails', action='store_true', help='Ignore max emails per manager limit')
-parser.add_argument('--update-only', action='store_true', help='Only update database, do not send audit emails')
-parser.add_argument('--group-prefix', action='append', help='Override default group prefix (can be passed multiple times)')
-parser.add_argument('--limit-users', type=int, help='Limit the number of users processed (for testing)')
-parser.add_argument('--filter-user-email', type=str, help='Only process a specific user with this email')
-parser.add_argument('--override-recipient', type=str, help='Override all outbound recipient email addresses (for testing)')
-parser.add_argument('--debug-user', type=str, help='Print debug info for a specific user email')
-args = parser.parse_args()
-dry_run = args.dry_run
-list_managers_mode = args.list_managers
-list_manager_counts_mode = args.list_manager_counts
-send_all = args.send_all_audit_emails
-update_only = getattr(args, 'update_only', False)
-override_group_prefixes = args.group_prefix or []
-user_limit = args.limit_users
-filter_user_email = args.filter_user_email
-override_recipient = args.override_recipient
-debug_user_email = args.debug_user
-
-
-# Load config
-config = configparser.ConfigParser()
-config.read('config.ini')
+def build_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=WideHelpFormatter
+    )
+
+    parser.add_argument('--config', default='config.ini', help='Path to the config file (default: config.ini)')
+    parser.add_argument('--dry-run', action='store_true', help='Preview actions without making changes')
+    parser.add_argument('--list-managers', action='store_true', help='List unique managers from AD and exit')
+    parser.add_argument('--list-manager-counts', action='store_true', help='List manager emails and number of users they manage')
+    parser.add_argument('--send-all-audit-emails', action='store_true', help='Ignore max emails per manager limit')
+    parser.add_argument('--update-only', action='store_true', help='Only update database, do not send audit emails')
+    parser.add_argument('--group-prefix', action='append', help='Override default group prefix (can be passed multiple times)')
+    parser.add_argument('--limit-users', type=int, help='Limit the number of users processed (for testing)')
+    parser.add_argument('--filter-user-email', type=str, help='Only process a specific user with this email')
+    parser.add_argument('--override-recipient', type=str, help='Override all outbound recipient email addresses (for testing)')
+    parser.add_argument('--debug-user', type=str, help='Print debug info for a specific user email')
+    parser.add_argument('--drain-outbox', action='store_true', help='Send pending outbox emails and exit')
+    parser.add_argument('--incremental', action='store_true', help='Only sync groups and users changed since the last run (uSNChanged)')
+    parser.add_argument('--full-resync', action='store_true', help='Ignore the stored USN high-water mark and rescan everything')
+    parser.add_argument('--live', action='store_true', help='Ignore the on-disk snapshot and query AD directly in read-only modes')
+    parser.add_argument('--expand-nested', action='store_true', help='Include users who are members through nested groups')
+    parser.add_argument('--migrate', action='store_true', help='Apply pending database schema migrations and exit')
+    parser.add_argument('--archive', action='store_true', help='Move closed reviews older than the retention window to audit_log_archive, exporting them, and exit')
+    parser.add_argument('--digest', action='store_true', help='Send one digest email per manager instead of one email per user')
+    parser.add_argument('--pipeline', action='store_true', help='Overlap LDAP collection, database sync and email sending (asyncio)')
+    parser.add_argument('--metrics-json', type=str, help='Write a JSON timing and counter report for this run to this path')
+    parser.add_argument('--metrics-prom', type=str, help='Write run metrics in Prometheus textfile format to this path')
+    parser.add_argument('--engine', choices=['members', 'memberof'], help='Membership collection engine (default: from config, else members)')
+    parser.add_argument('--shards', type=int, help='Split the run into this many shards claimed by cooperating workers through MySQL leases')
+    parser.add_argument('--run-id', type=str, help='Identifies one sharded run; workers with the same run ID share its shards (default: today\'s date)')
+    return parser
+
+class SecretCache:
+    """
+    Local cache of Secrets Manager values, so back-to-back runs (cron, drain-outbox,
+    list modes) skip the AWS round trip. The file is a single Fernet token (AES with
+    an HMAC, from the optional `cryptography` package) over a JSON map of
+    secret name -> {fetched_at, value}, written with 0600 permissions. Entries older
+    than the TTL are ignored; an unreadable file (wrong key, corrupt, missing) is
+    treated as empty rather than as an error.
+    """
 
-def get_secret(secret_name, region_name=None):
-    try:
+    def __init__(self, path, ttl_minutes, key):
+        from cryptography.fernet import Fernet
+        self.path = path
+        self.ttl = ttl_minutes * 60
+        self._fernet = Fernet(key)
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                return json.loads(self._fernet.decrypt(f.read()))
+        except Exception:
+            return {}
+
+    def get(self, name):
+        entry = self._load().get(name)
+        if entry and time.time() - entry['fetched_at'] < self.ttl:
+            return entry['value']
+        return None
+
+    def put(self, name, value):
+        entries = self._load()
+        entries[name] = {'fetched_at': time.time(), 'value': value}
+        now = time.time()
+        entries = {k: v for k, v in entries.items() if now - v['fetched_at'] < self.ttl}
+        tmp_path = f"{self.path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self._fernet.encrypt(json.dumps(entries).encode()))
+        os.replace(tmp_path, self.path)
+
+_secrets_clients = {}
+_secret_values = {}
+_secret_cache = None
+
+def secrets_client(region_name=None):
+    """
+    Returns the process-wide Secrets Manager client for a region, importing boto3 and
+    creating the client (credential and endpoint resolution) only on first use.
+    """
+    client = _secrets_clients.get(region_name)
+    if client is None:
+        import boto3
         session = boto3.session.Session()
         region = region_name or session.region_name or config.get('aws', 'region', fallback=None)
         if not region:
             raise Exception("You must specify a region for AWS Secrets Manager.")
-        client = session.client(service_name='secretsmanager', region_name=region)
-        response = client.get_secret_value(SecretId=secret_name)
-        return json.loads(response['SecretString'])
+        client = _secrets_clients[region_name] = session.client(service_name='secretsmanager', region_name=region)
+    return client
+
+def secret_cache():
+    """
+    Opens the local secret cache on first use. Returns None (fetch from AWS every run)
+    unless [aws] secret_cache_ttl_minutes > 0, the key is set in the environment and
+    `cryptography` is installed.
+    """
+    global _secret_cache
+    if _secret_cache is None:
+        _secret_cache = False
+        if settings.SECRET_CACHE_TTL_MINUTES > 0:
+            key = os.environ.get(settings.SECRET_CACHE_KEY_ENV)
+            if not key:
+                log(f"Secret cache disabled: {settings.SECRET_CACHE_KEY_ENV} is not set.")
+            else:
+                try:
+                    _secret_cache = SecretCache(settings.SECRET_CACHE_PATH, settings.SECRET_CACHE_TTL_MINUTES, key)
+                except ImportError:
+                    log("Secret cache disabled: the 'cryptography' package is not installed.")
+                except ValueError as e:
+                    log(f"Secret cache disabled: invalid key in {settings.SECRET_CACHE_KEY_ENV} ({e}).")
+    return _secret_cache or None
+
+def get_secret(secret_name, region_name=None):
+    try:
+        value = _secret_values.get(secret_name)
+        if value is not None:
+            return value
+        cache = secret_cache()
+        value = cache.get(secret_name) if cache else None
+        if value is not None:
+            metrics.count('secret_cache_hits')
+        else:
+            with metrics.phase('secret_fetch'):
+                response = secrets_client(region_name).get_secret_value(SecretId=secret_name)
+            value = json.loads(response['SecretString'])
+            if cache:
+                metrics.count('secret_cache_misses')
+                cache.put(secret_name, value)
+        _secret_values[secret_name] = value
+        return value
     except Exception as e:
         print(f"[!] Failed to retrieve secret {secret_name}: {e}")
         sys.exit(1)
 
-# LDAP configuration
-ldap_secret_key = config['ldap'].get('secret_name', fallback=None)
-ldap_has_plain = all(k in config['ldap'] for k in ('server', 'bind_user', 'bind_password', 'base_dn'))
-if ldap_secret_key and ldap_has_plain:
-    print("[!] Both LDAP secret_name and plaintext credentials are configured. Please remove one.")
-    sys.exit(1)
-if ldap_secret_key:
-    ldap_secret = get_secret(ldap_secret_key)
-    LDAP_SERVER = ldap_secret['server']
-    BIND_USER = ldap_secret['bind_user']
-    BIND_PASS = ldap_secret['bind_password']
-    BASE_DN = ldap_secret['base_dn']
-    SKIP_CERT_VALIDATION = ldap_secret.get('skip_cert_validation', 'false').lower() == 'true'
-else:
-    LDAP_SERVER = config['ldap']['server']
-    BIND_USER = config['ldap']['bind_user']
-    BIND_PASS = config['ldap']['bind_password']
-    BASE_DN = config['ldap']['base_dn']
-    SKIP_CERT_VALIDATION = config['ldap'].getboolean('skip_cert_validation', fallback=False)
-
-# Group prefixes
-default_prefixes = config.get('groups', 'prefixes', fallback='SG_AWS').split(',')
-GROUP_PREFIXES = [p.strip() for p in override_group_prefixes] if override_group_prefixes else [p.strip() for p in default_prefixes]
-
-# Determine SSL usage and default port
-use_ssl = LDAP_SERVER.lower().startswith("ldaps")
-default_port = 636 if use_ssl else 389
-LDAP_PORT = config['ldap'].getint('port', fallback=default_port)
-
-EMAIL_MODE = config['email']['mode']
-FROM_ADDRESS = config['email']['from_address']
-REVIEW_URL = "https://audit.example.com/review?token="
-
-MIN_DAYS = int(config['audit'].get('min_days_between_audits', 30))
-MAX_EMAILS_PER_MANAGER = config['audit'].getint('max_audits_per_manager_per_day', fallback=5)
-
-# Stats tracking
-group_count = 0
-user_count = 0
-group_memberships = 0
-managers_contacted = set()
-emails_sent = 0
-emails_skipped = 0
-audits_logged = 0
-dry_run_emails = []
-manager_email_counts = defaultdict(int)
-user_current_groups = defaultdict(set)
+class Settings:
+    """
+    The run's settings, read from the command line and the config file. The LDAP
+    server and bind credentials stay None until load_ldap_settings() resolves them.
+    """
+    def __init__(self, args, config):
+        self.dry_run = args.dry_run
+        self.list_managers_mode = args.list_managers
+        self.list_manager_counts_mode = args.list_manager_counts
+        self.send_all = args.send_all_audit_emails
+        self.update_only = getattr(args, 'update_only', False)
+        self.user_limit = args.limit_users
+        self.filter_user_email = args.filter_user_email
+        self.override_recipient = args.override_recipient
+        self.debug_user_email = args.debug_user
+        self.drain_outbox_mode = args.drain_outbox
+        self.full_resync = args.full_resync
+        self.live_refresh = args.live
+        self.migrate_mode = args.migrate
+        self.archive_mode = args.archive
+
+        # LDAP configuration
+        ldap_secret_key = config['ldap'].get('secret_name', fallback=None)
+        ldap_has_plain = all(k in config['ldap'] for k in ('server', 'bind_user', 'bind_password', 'base_dn'))
+        if ldap_secret_key and ldap_has_plain:
+            print("[!] Both LDAP secret_name and plaintext credentials are configured. Please remove one.")
+            sys.exit(1)
+
+        # Server and bind credentials are resolved on first connection (load_ldap_settings),
+        # so modes that never reach the directory skip the LDAP secret fetch
+        self.LDAP_SERVER = self.BIND_USER = self.BIND_PASS = self.BASE_DN = self.LDAP_PORT = None
+        self.SKIP_CERT_VALIDATION = False
+        self.LDAP_SERVERS = []
+
+        # Group prefixes
+        default_prefixes = config.get('groups', 'prefixes', fallback='SG_AWS').split(',')
+        self.GROUP_PREFIXES = [p.strip() for p in args.group_prefix] if args.group_prefix else [p.strip() for p in default_prefixes]
+        self.COLLECTION_ENGINE = args.engine or config.get('groups', 'engine', fallback='members').strip().lower()
+        if self.COLLECTION_ENGINE not in ('members', 'memberof'):
+            print(f"[!] Unknown collection engine '{self.COLLECTION_ENGINE}'. Use 'members' or 'memberof'.")
+            sys.exit(1)
+        self.EXPAND_NESTED = args.expand_nested or config.getboolean('groups', 'expand_nested', fallback=False)
+        self.NESTED_FAST_PATH = config.getboolean('groups', 'nested_fast_path', fallback=True)
+
+        self.LDAP_MAX_CONNECTIONS = config['ldap'].getint('max_connections', fallback=1)
+        self.LDAP_BATCH_SIZE = config['ldap'].getint('batch_size', fallback=100)
+        self.LDAP_PAGE_SIZE = config['ldap'].getint('page_size', fallback=500)
+        self.LDAP_MOCK_DIRECTORY = config['ldap'].get('mock_directory', fallback=None)
+
+        self.USER_ATTRIBUTES = ['objectClass', 'sAMAccountName', 'mail', 'manager', 'givenName', 'sn']
+
+        self.EMAIL_MODE = config['email']['mode']
+        self.SMTP_POOL_SIZE = config['email'].getint('smtp_pool_size', fallback=4)
+        self.EMAIL_WORKERS = config['email'].getint('workers', fallback=self.SMTP_POOL_SIZE)
+        self.EMAIL_MAX_RETRIES = max(1, config['email'].getint('max_retries', fallback=3))
+        self.EMAIL_RETRY_BACKOFF = config['email'].getfloat('retry_backoff', fallback=2.0)
+        self.EMAIL_SINK_DIR = config['email'].get('sink_dir', fallback='mail_sink')
+        self.OUTBOX_MAX_ATTEMPTS = config['email'].getint('outbox_max_attempts', fallback=5)
+        self.OUTBOX_CLAIM_SIZE = max(1, config['email'].getint('outbox_claim_size', fallback=2 * self.EMAIL_WORKERS))
+        self.OUTBOX_CLAIM_SECONDS = config['email'].getint('outbox_claim_seconds', fallback=600)
+        self.OUTBOX_RETRY_BACKOFF = max(1, config['email'].getint('outbox_retry_backoff', fallback=300))
+        self.FROM_ADDRESS = config['email']['from_address']
+        self.TEMPLATE_DIR = config['email'].get('template_dir', fallback=mail_templates.DEFAULT_TEMPLATE_DIR)
+        self.REVIEW_URL = "https://audit.example.com/review?token="
+
+        self.MIN_DAYS = int(config['audit'].get('min_days_between_audits', 30))
+        self.DIGEST_MODE = args.digest or config['audit'].getboolean('digest', fallback=False)
+        self.MAX_EMAILS_PER_MANAGER = config['audit'].getint('max_audits_per_manager_per_day', fallback=5)
+        self.AUDIT_BATCH_SIZE = config['audit'].getint('batch_size', fallback=5)
+        self.AUDIT_DIGEST_BATCH_SIZE = config['audit'].getint('digest_batch_size', fallback=0)
+        self.MYSQL_BATCH_SIZE = config['mysql'].getint('batch_size', fallback=1000)
+        self.SNAPSHOT_PATH = config.get('cache', 'snapshot_path', fallback='ad_snapshot.sqlite')
+        self.SNAPSHOT_TTL_MINUTES = config.getint('cache', 'snapshot_ttl_minutes', fallback=1440)
+        self.INCREMENTAL_SYNC = args.incremental or config.getboolean('sync', 'incremental', fallback=False)
+        self.PIPELINE_MODE = args.pipeline or config.getboolean('sync', 'pipeline', fallback=False)
+        self.PIPELINE_QUEUE_SIZE = config.getint('sync', 'pipeline_queue_size', fallback=4)
+        self.METRICS_JSON_PATH = args.metrics_json or config.get('metrics', 'json_path', fallback=None)
+        self.METRICS_PROM_PATH = args.metrics_prom or config.get('metrics', 'prometheus_path', fallback=None)
+        self.SECRET_CACHE_PATH = config.get('aws', 'secret_cache_path', fallback='.secret_cache')
+        self.SECRET_CACHE_TTL_MINUTES = config.getint('aws', 'secret_cache_ttl_minutes', fallback=0)
+        self.SECRET_CACHE_KEY_ENV = config.get('aws', 'secret_cache_key_env', fallback='AD_AUDITOR_SECRET_CACHE_KEY')
+        self.SHARD_COUNT = max(1, args.shards or config.getint('shard', 'count', fallback=1))
+        self.SHARD_RUN_ID = args.run_id or date.today().isoformat()
+        self.SHARD_LEASE_SECONDS = config.getint('shard', 'lease_seconds', fallback=300)
+        self.SHARD_POLL_SECONDS = config.getfloat('shard', 'poll_seconds', fallback=10)
+        if self.SHARD_COUNT > 1 and (self.INCREMENTAL_SYNC or self.PIPELINE_MODE or self.dry_run):
+            print("[!] Sharded runs cannot be combined with --incremental, --pipeline or --dry-run.")
+            sys.exit(1)
+        self.ARCHIVE_RETENTION_DAYS = config.getint('archive', 'retention_days', fallback=365)
+        self.ARCHIVE_EXPORT_DIR = config.get('archive', 'export_dir', fallback='archive')
+        self.ARCHIVE_FORMAT = config.get('archive', 'format', fallback='ndjson').strip().lower()
+        if self.ARCHIVE_FORMAT not in ('ndjson', 'csv'):
+            print(f"[!] Unknown archive format '{self.ARCHIVE_FORMAT}'. Use 'ndjson' or 'csv'.")
+            sys.exit(1)
+        self.SEND_RATE = config.getfloat('schedule', 'messages_per_second', fallback=0)
+        self.SEND_BURST = max(1, config.getint('schedule', 'burst', fallback=1))
+        self.SEND_DOMAIN_CONCURRENCY = config.getint('schedule', 'max_concurrent_per_domain', fallback=0)
+        self.SEND_RUN_BUDGET = config.getint('schedule', 'max_emails_per_run', fallback=0)
+        if self.SHARD_COUNT > 1:
+            # Each email shard is sent by one worker process at a time, so giving every shard an
+            # equal share keeps the relay's total within the configured limits
+            if 0 < self.SEND_RUN_BUDGET < self.SHARD_COUNT or 0 < self.SEND_DOMAIN_CONCURRENCY < self.SHARD_COUNT:
+                print(f"[!] [schedule] max_emails_per_run and max_concurrent_per_domain must be 0 or at least the shard count ({self.SHARD_COUNT}).")
+                sys.exit(1)
+            self.SEND_RATE /= self.SHARD_COUNT
+            self.SEND_BURST = max(1, self.SEND_BURST // self.SHARD_COUNT)
+            self.SEND_DOMAIN_CONCURRENCY //= self.SHARD_COUNT
+            self.SEND_RUN_BUDGET //= self.SHARD_COUNT
+
+class RunState:
+    """
+    Counters and per-user bookkeeping for one run, reported in the summary and the
+    metrics. configure() starts a fresh one for every run.
+    """
+    def __init__(self):
+        self.group_count = 0
+        self.user_count = 0
+        self.group_memberships = 0
+        self.emails_sent = 0
+        self.emails_skipped = 0
+        self.emails_deferred = 0
+        self.audits_logged = 0
+        self.dry_run_emails = []
+        self.manager_email_counts = defaultdict(int)
+        self.user_current_groups = defaultdict(set)
+        self.membership_paths = {}
+        self.user_group_paths = {}
+        # The (shard, shard count) whose groups are being collected in a sharded run
+        self.group_shard = None
+
+def configure(argv=None):
+    """
+    Parses the command line and the config file into `settings` and starts a fresh
+    `run_state`. Nothing runs at import time, so the module can be imported (e.g. by
+    the benchmarks) and main() called repeatedly.
+    """
+    global args, config, settings, run_state, metrics, manager_cache, smtp_pool, send_limiter, domain_slots, \
+        TEMPLATES, message_builder, _secret_cache, _mock_server
+    args = build_parser().parse_args(argv)
+    config = configparser.ConfigParser()
+    if not config.read(args.config):
+        print(f"[!] Config file {args.config} not found or unreadable.")
+        sys.exit(1)
+    settings = Settings(args, config)
+    run_state = RunState()
+    _secret_cache = None
+    _mock_server = None
+
+    metrics = RunMetrics()
+    manager_cache = ManagerEmailCache()
+    smtp_pool = SMTPPool(settings.SMTP_POOL_SIZE)
+    send_limiter = TokenBucket(settings.SEND_RATE, settings.SEND_BURST) if settings.SEND_RATE > 0 else None
+    domain_slots = DomainSlots(settings.SEND_DOMAIN_CONCURRENCY)
+    TEMPLATES = mail_templates.TemplateSet(settings.TEMPLATE_DIR)
+    message_builder = mail_templates.MessageBuilder(
+        settings.FROM_ADDRESS,
+        from_name=config['email'].get('from_name', '').strip(),
+        cc_list=[x.strip() for x in config['email'].get('cc', '').split(',') if x.strip()],
+        bcc_list=[x.strip() for x in config['email'].get('bcc', '').split(',') if x.strip()],
+    )
 
 def log(msg):
     print(f"[+] {msg}")
 
-def ldap_connection():
-    log("Connecting to LDAP server...")
-    log(f"    Protocol: {'LDAPS' if use_ssl else 'LDAP'}")
-    log(f"    Certificate Validation: {'Skipped' if SKIP_CERT_VALIDATION else 'Enforced'}")
-    tls_config = Tls(validate=ssl.CERT_NONE if SKIP_CERT_VALIDATION else ssl.CERT_REQUIRED)
-    server = Server(LDAP_SERVER, port=LDAP_PORT, use_ssl=use_ssl, get_info=ALL, tls=tls_config)
-    conn = Connection(server, BIND_USER, BIND_PASS, auto_bind=True)
+class RunMetrics:
+    """
+    Run-wide timings and counters, written as a JSON report and/or a Prometheus
+    textfile at the end of a run so performance can be tracked across runs.
+
+    Phase times accumulate: a phase entered several times (or from several threads,
+    as in pipeline mode) reports the total time spent inside it.
+    """
+
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self):
+        self.started = time.time()
+        self._clock = time.perf_counter()
+        self._lock = threading.Lock()
+        self.phases = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.samples = defaultdict(list)
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.phases[name] += elapsed
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def observe(self, name, value):
+        with self._lock:
+            self.samples[name].append(value)
+
+    def peak(self, name, value):
+        """
+        Records the largest value seen, for gauges sampled more than once per run.
+        """
+        with self._lock:
+            self.counters[name] = max(self.counters[name], value)
+
+    @staticmethod
+    def percentile(values, q):
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def report(self, status, caches):
+        """
+        Args:
+            status (str): 'success' or 'error'.
+            caches (dict): cache name -> (hits, misses).
+        """
+        return {
+            'started_at': self.started,
+            'duration_seconds': round(time.perf_counter() - self._clock, 6),
+            'status': status,
+            'phases_seconds': {name: round(value, 6) for name, value in sorted(self.phases.items())},
+            'counters': dict(sorted(self.counters.items())),
+            'cache_hit_ratio': {
+                name: round(hits / (hits + misses), 4) if hits + misses else None
+                for name, (hits, misses) in sorted(caches.items())
+            },
+            'latency_seconds': {
+                name: {
+                    'count': len(values),
+                    'sum': round(sum(values), 6),
+                    'max': round(max(values), 6),
+                    **{f"p{int(q * 100)}": round(self.percentile(values, q), 6) for q in self.QUANTILES},
+                }
+                for name, values in sorted(self.samples.items()) if values
+            },
+        }
+
+    @staticmethod
+    def prometheus(report):
+        lines = [
+            '# HELP ad_auditor_last_run_timestamp_seconds Start time of the last run.',
+            '# TYPE ad_auditor_last_run_timestamp_seconds gauge',
+            f"ad_auditor_last_run_timestamp_seconds {report['started_at']:.3f}",
+            '# HELP ad_auditor_last_run_success Whether the last run completed without an unhandled error.',
+            '# TYPE ad_auditor_last_run_success gauge',
+            f"ad_auditor_last_run_success {1 if report['status'] == 'success' else 0}",
+            '# HELP ad_auditor_run_duration_seconds Wall time of the last run.',
+            '# TYPE ad_auditor_run_duration_seconds gauge',
+            f"ad_auditor_run_duration_seconds {report['duration_seconds']}",
+            '# HELP ad_auditor_phase_seconds Time spent in each phase of the last run.',
+            '# TYPE ad_auditor_phase_seconds gauge',
+        ]
+        lines += [f'ad_auditor_phase_seconds{{phase="{name}"}} {value}' for name, value in report['phases_seconds'].items()]
+        lines += ['# HELP ad_auditor_events Event counts for the last run.', '# TYPE ad_auditor_events gauge']
+        lines += [f'ad_auditor_events{{event="{name}"}} {value}' for name, value in report['counters'].items()]
+        lines += ['# HELP ad_auditor_cache_hit_ratio Cache hit ratio for the last run.', '# TYPE ad_auditor_cache_hit_ratio gauge']
+        lines += [f'ad_auditor_cache_hit_ratio{{cache="{name}"}} {value}' for name, value in report['cache_hit_ratio'].items() if value is not None]
+        for name, stats in report['latency_seconds'].items():
+            metric = f"ad_auditor_{name}_seconds"
+            lines += [f'# HELP {metric} Latency distribution for the last run.', f'# TYPE {metric} summary']
+            lines += [f'{metric}{{quantile="{q}"}} {stats[f"p{int(q * 100)}"]}' for q in RunMetrics.QUANTILES]
+            lines += [f"{metric}_sum {stats['sum']}", f"{metric}_count {stats['count']}"]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, status, caches, json_path=None, prom_path=None):
+        """
+        Writes the report to each configured path. Files are replaced atomically so a
+        textfile collector never reads a half-written file.
+        """
+        report = self.report(status, caches)
+        for path, content in ((json_path, lambda: json.dumps(report, indent=2) + '\n'), (prom_path, lambda: self.prometheus(report))):
+            if not path:
+                continue
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(content())
+            os.replace(tmp_path, path)
+            log(f"Metrics written to {path}")
+        return report
+
+metrics = RunMetrics()
+
+def load_ldap_settings():
+    """
+    Resolves the LDAP server, bind credentials and DC list the first time a mode
+    connects to the directory, fetching the [ldap] secret_name secret if configured.
+    """
+    if settings.LDAP_SERVER is not None:
+        return
+    ldap_secret_key = config['ldap'].get('secret_name', fallback=None)
+    if ldap_secret_key:
+        ldap_secret = get_secret(ldap_secret_key)
+        settings.BIND_USER = ldap_secret['bind_user']
+        settings.BIND_PASS = ldap_secret['bind_password']
+        settings.BASE_DN = ldap_secret['base_dn']
+        settings.SKIP_CERT_VALIDATION = ldap_secret.get('skip_cert_validation', 'false').lower() == 'true'
+        server = ldap_secret['server']
+    else:
+        settings.BIND_USER = config['ldap']['bind_user']
+        settings.BIND_PASS = config['ldap']['bind_password']
+        settings.BASE_DN = config['ldap']['base_dn']
+        settings.SKIP_CERT_VALIDATION = config['ldap'].getboolean('skip_cert_validation', fallback=False)
+        server = config['ldap']['server']
+
+    # Determine SSL usage and default port
+    use_ssl = server.lower().startswith("ldaps")
+    default_port = 636 if use_ssl else 389
+    settings.LDAP_PORT = config['ldap'].getint('port', fallback=default_port)
+    settings.LDAP_SERVERS = [server] + [x.strip() for x in config['ldap'].get('additional_servers', '').split(',') if x.strip()]
+    settings.LDAP_SERVER = server
+
+def escape_filter_chars(text):
+    from ldap3.utils.conv import escape_filter_chars as escape
+    return escape(text)
+
+def mock_ldap_connection():
+    """
+    Offline stand-in for a domain controller: an ldap3 MOCK_SYNC connection over the
+    entries in [ldap] mock_directory (ldap3's JSON entries format). The entries are
+    loaded once per run and shared by every pooled connection. Used by the benchmarks.
+    """
+    from ldap3 import Server, Connection, MOCK_SYNC
+    global _mock_server
+    first = _mock_server is None
+    if first:
+        log(f"Loading mock directory {settings.LDAP_MOCK_DIRECTORY}...")
+        _mock_server = Server('mock_directory')
+    conn = Connection(_mock_server, settings.BIND_USER, settings.BIND_PASS, client_strategy=MOCK_SYNC)
+    if first:
+        conn.strategy.entries_from_json(settings.LDAP_MOCK_DIRECTORY)
+        conn.strategy.add_entry(settings.BIND_USER, {'objectClass': ['top'], 'userPassword': settings.BIND_PASS})
+    conn.bind()
+    return conn
+
+def ldap_connection(server_uri=None):
+    load_ldap_settings()
+    if settings.LDAP_MOCK_DIRECTORY:
+        return mock_ldap_connection()
+    server_uri = server_uri or settings.LDAP_SERVER
+    server_ssl = server_uri.lower().startswith("ldaps")
+    port = settings.LDAP_PORT if server_uri == settings.LDAP_SERVER else (636 if server_ssl else 389)
+    log(f"Connecting to LDAP server {server_uri}...")
+    log(f"    Protocol: {'LDAPS' if server_ssl else 'LDAP'}")
+    log(f"    Certificate Validation: {'Skipped' if settings.SKIP_CERT_VALIDATION else 'Enforced'}")
+    from ldap3 import Server, Connection, ALL, Tls
+    tls_config = Tls(validate=ssl.CERT_NONE if settings.SKIP_CERT_VALIDATION else ssl.CERT_REQUIRED)
+    server = Server(server_uri, port=port, use_ssl=server_ssl, get_info=ALL, tls=tls_config)
+    conn = Connection(server, settings.BIND_USER, settings.BIND_PASS, auto_bind=True)
     log("LDAP bind successful.")
     return conn
 
-def search_groups_by_prefixes(conn, base_dn, prefixes):
+class LdapPool:
+    """
+    A bounded pool of bound LDAP connections, spread round-robin across the
+    configured DCs, used to fan out independent searches. Connections are
+    opened lazily up to `size`; the first one is opened eagerly so bind errors
+    surface immediately and its rootDSE can be read through `server`.
+    """
+
+    def __init__(self, size, servers):
+        self.size = size
+        self.servers = servers
+        self._lock = threading.Lock()
+        self._opened = []
+        self._idle = queue.Queue()
+        self._idle.put(self._open())
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='ldap')
+
+    def _open(self):
+        conn = ldap_connection(self.servers[len(self._opened) % len(self.servers)])
+        self._opened.append(conn)
+        return conn
+
+    @property
+    def server(self):
+        return self._opened[0].server
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                if len(self._opened) < self.size:
+                    conn = self._open()
+            if conn is None:
+                conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def map(self, fn, items):
+        def call(item):
+            with self.connection() as conn:
+                return fn(conn, item)
+        return list(self._executor.map(call, items))
+
+    def imap(self, fn, items):
+        """
+        Like map, but yields results in input order as they complete and keeps at most
+        two calls per connection in flight, so a slow consumer holds back the searches.
+        """
+        def call(item):
+            with self.connection() as conn:
+                return fn(conn, item)
+        pending = deque()
+        for item in items:
+            pending.append(self._executor.submit(call, item))
+            if len(pending) >= self.size * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def unbind(self):
+        self._executor.shutdown(wait=True)
+        for conn in self._opened:
+            conn.unbind()
+
+def ldap_pool():
+    """
+    Returns an LdapPool when [ldap] max_connections > 1, otherwise a single connection.
+    Incremental runs stay on the primary DC because USNs are local to each DC.
+    """
+    load_ldap_settings()
+    with metrics.phase('ldap_bind'):
+        if settings.LDAP_MAX_CONNECTIONS <= 1:
+            return ldap_connection()
+        servers = [settings.LDAP_SERVER] if settings.INCREMENTAL_SYNC else settings.LDAP_SERVERS
+        log(f"Using up to {settings.LDAP_MAX_CONNECTIONS} LDAP connections across {len(servers)} server(s).")
+        return LdapPool(settings.LDAP_MAX_CONNECTIONS, servers)
+
+def ldap_map(conn, fn, items):
+    """
+    Applies fn(connection, item) to every item, in parallel when conn is an LdapPool.
+    Results are returned in input order so merged output is deterministic.
+    """
+    items = list(items)
+    if isinstance(conn, LdapPool) and len(items) > 1:
+        return conn.map(fn, items)
+    return [fn(conn, item) for item in items]
+
+def ldap_imap(conn, fn, items):
+    """
+    Lazy counterpart of ldap_map: yields each result in input order as soon as it is ready.
+    """
+    if isinstance(conn, LdapPool):
+        yield from conn.imap(fn, items)
+        return
+    for item in items:
+        yield fn(conn, item)
+
+def paged_search(conn, search_base, search_filter, attributes, search_scope=SUBTREE):
+    """
+    Runs an LDAP search using the Simple Paged Results control and yields entries
+    one page at a time, so results are never truncated at the server's MaxPageSize
+    and never held in memory as a whole.
+
+    Args:
+        conn (ldap3.Connection): An active LDAP connection.
+        search_base (str): The base DN to search under.
+        search_filter (str): The LDAP filter.
+        attributes (list): Attributes to fetch.
+        search_scope: ldap3 search scope (default SUBTREE).
+
+    Yields:
+        tuple: (dn, attributes) for each entry returned.
+    """
+    if isinstance(conn, LdapPool):
+        with conn.connection() as pooled:
+            yield from paged_search(pooled, search_base, search_filter, attributes, search_scope)
+        return
+    metrics.count('ldap_searches')
+    results = conn.extend.standard.paged_search(
+        search_base,
+        search_filter,
+        search_scope=search_scope,
+        attributes=list(attributes),
+        paged_size=settings.LDAP_PAGE_SIZE,
+        generator=True
+    )
+    for entry in results:
+        if entry.get('type') == 'searchResEntry':
+            metrics.count('ldap_entries')
+            yield entry['dn'], entry['attributes']
+
+def search_groups_by_prefixes(conn, base_dn, prefixes, attributes=('member', 'cn'), extra_filter=''):
     """
     Searches for LDAP groups whose CN starts with any of the given prefixes.
     
@@ -134,252 +668,562 @@ def search_groups_by_prefixes(conn, base_dn, prefixes):
         conn (ldap3.Connection): An active LDAP connection.
         base_dn (str): The base DN to search under.
         prefixes (list): List of group name prefixes to search for.
+        attributes (tuple): Group attributes to fetch.
+        extra_filter (str): Additional LDAP filter component ANDed into the group filter.
 
-    Returns:
-        list: All matched group entries across prefixes.
+    Yields:
+        dict: One record per matched group with 'dn', 'cn' and 'members'.
     """
-    all_groups = []
     for prefix in prefixes:
         log(f"Searching for groups starting with prefix: {prefix}")
-        conn.search(base_dn, f'(&(objectClass=group)(cn={prefix}*))', attributes=['member', 'cn'])
-        all_groups.extend(conn.entries)
-    return all_groups
+        for dn, group_attributes in paged_search(conn, base_dn, f'(&(objectClass=group)(cn={escape_filter_chars(prefix)}*){extra_filter})', attributes):
+            yield {
+                'dn': dn,
+                'cn': _attr_value(group_attributes, 'cn'),
+                'members': [str(member_dn) for member_dn in group_attributes.get('member', [])],
+            }
+
+def _attr_value(attributes, name):
+    value = attributes.get(name)
+    if isinstance(value, list):
+        value = value[0] if value else None
+    if value is None or str(value).strip() == '':
+        return None
+    return str(value)
+
+def _user_record(dn, attributes):
+    given_name = _attr_value(attributes, 'givenName') or ''
+    surname = _attr_value(attributes, 'sn') or ''
+    return {
+        'dn': dn,
+        'object_classes': [str(oc).lower() for oc in attributes.get('objectClass', [])],
+        'username': _attr_value(attributes, 'sAMAccountName'),
+        'email': _attr_value(attributes, 'mail'),
+        'manager_dn': _attr_value(attributes, 'manager'),
+        'full_name': f"{given_name.capitalize()} {surname.capitalize()}".strip(),
+    }
+
+def is_person(record):
+    """
+    Whether a directory record is a person, matching the (objectCategory=person)
+    filters used by the memberOf and IN_CHAIN engines: computer accounts carry the
+    person objectClass too, but are not people.
+    """
+    return 'person' in record['object_classes'] and 'computer' not in record['object_classes']
 
+def resolve_dns(conn, dns, attributes):
+    """
+    Fetches many LDAP entries by DN using batched OR-filter subtree searches.
 
-def mysql_connection():
-    log("Connecting to MySQL database...")
-    mysql_secret_key = config['mysql'].get('secret_name', fallback=None)
-    mysql_has_plain = all(k in config['mysql'] for k in ('host', 'port', 'user', 'password', 'database'))
-    if mysql_secret_key and mysql_has_plain:
-        print("[!] Both MySQL secret_name and plaintext credentials are configured. Please remove one.")
-        sys.exit(1)
-    if mysql_secret_key:
-        db_secret = get_secret(mysql_secret_key)
-        return mysql.connector.connect(
-            host=db_secret['host'],
-            port=int(db_secret['port']),
-            user=db_secret['user'],
-            password=db_secret['password'],
-            database=db_secret['database']
-        )
-    else:
-        return mysql.connector.connect(
-            host=config['mysql']['host'],
-            port=config.getint('mysql', 'port'),
-            user=config['mysql']['user'],
-            password=config['mysql']['password'],
-            database=config['mysql']['database']
-        )
+    Args:
+        conn (ldap3.Connection): An active LDAP connection.
+        dns (iterable): DNs to resolve. Duplicates are only looked up once.
+        attributes (list): Attributes to fetch for each entry.
 
-def send_email(to, subject, plain_text, html_content):
-    msg = MIMEMultipart("alternative")
-    msg['Subject'] = subject
-    from_name = config['email'].get('from_name', '').strip()
-    if from_name:
-        msg['From'] = f"{from_name} <{FROM_ADDRESS}>"
-    else:
-        msg['From'] = FROM_ADDRESS
-    msg['To'] = to if isinstance(to, str) else ", ".join(to)
+    Returns:
+        dict: Lowercased DN -> attributes for every DN that could be resolved.
+    """
+    unique_dns = list({dn.lower(): dn for dn in dns}.values())
 
-    cc_list = [x.strip() for x in config['email'].get('cc', '').split(',') if x.strip()]
-    bcc_list = [x.strip() for x in config['email'].get('bcc', '').split(',') if x.strip()]
-    if cc_list:
-        msg['Cc'] = ", ".join(cc_list)
+    def search_chunk(c, chunk):
+        dn_filter = ''.join(f'(distinguishedName={escape_filter_chars(dn)})' for dn in chunk)
+        return [(dn.lower(), entry_attributes) for dn, entry_attributes in paged_search(c, settings.BASE_DN, f'(|{dn_filter})', attributes)]
 
-    recipients = []
-    if isinstance(to, str):
-        recipients.append(to)
-    else:
-        recipients.extend(to)
-    recipients.extend(cc_list)
-    recipients.extend(bcc_list)
+    def search_base(c, dn):
+        return [(dn.lower(), entry_attributes) for _, entry_attributes in paged_search(c, dn, '(objectClass=*)', attributes, search_scope=BASE)]
 
-    msg.attach(MIMEText(plain_text, "plain"))
-    msg.attach(MIMEText(html_content, "html"))
+    chunks = [unique_dns[i:i + settings.LDAP_BATCH_SIZE] for i in range(0, len(unique_dns), settings.LDAP_BATCH_SIZE)]
+    resolved = {}
+    for results in ldap_map(conn, search_chunk, chunks):
+        resolved.update(results)
 
-    try:
-        if EMAIL_MODE == 'localhost':
-            with smtplib.SMTP('localhost') as s:
-                s.send_message(msg, to_addrs=recipients)
-        elif EMAIL_MODE == 'smtp':
-            with smtplib.SMTP(config['email']['smtp_server'], config.getint('email', 'smtp_port')) as s:
-                s.ehlo()
-                try:
-                    s.starttls()
-                    smtp_user = config['email'].get('smtp_user', '').strip()
-                    smtp_pass = config['email'].get('smtp_password', '').strip()
-                    if smtp_user and smtp_pass:
-                        s.login(smtp_user, smtp_pass)
-                except smtplib.SMTPNotSupportedError:
-                    log("  [SMTP] TLS not supported, continuing without it.")
-                s.send_message(msg, to_addrs=recipients)
-        print(f"✔ Email sent to {msg['To']}")
-    except Exception as e:
-        print(f"✘ Failed to send email to {msg['To']}: {e}")
+    # Entries outside BASE_DN are not covered by the subtree search, so look those up individually
+    missing = [dn for dn in unique_dns if dn.lower() not in resolved]
+    for results in ldap_map(conn, search_base, missing):
+        resolved.update(results)
+    return resolved
 
+def resolve_members(conn, member_dns):
+    """
+    Resolves every distinct member DN once and returns user records keyed by lowercased DN.
+    """
+    resolved = resolve_dns(conn, member_dns, settings.USER_ATTRIBUTES)
+    return {dn: _user_record(dn, attributes) for dn, attributes in resolved.items()}
 
-def send_error_email(subject, message):
-    recipients = [x.strip() for x in config['alerts']['error_recipients'].split(',')]
-    send_email(recipients, subject, message, message)
+def search_groups_in_parallel(conn, base_dn, prefixes, attributes, group_filter=''):
+    """
+    Runs one group search per prefix, in parallel when conn is an LdapPool, and
+    returns the groups in prefix order.
 
-def send_minor_error(subject, message):
-    if config['alerts'].get('notify_on_minor_errors', 'no').lower() == 'yes':
-        send_error_email(subject, message)
+    In a sharded run only `cn` is searched for at first; member lists are then
+    fetched for the shard's own groups, so each shard does not download them all.
+    """
+    search_attributes = [a for a in attributes if a != 'member'] if run_state.group_shard else attributes
+    with metrics.phase('group_search'):
+        batches = ldap_map(conn, lambda c, prefix: list(search_groups_by_prefixes(c, base_dn, [prefix], search_attributes, group_filter)), prefixes)
+        groups = [group for batch in batches for group in batch]
+        if run_state.group_shard:
+            groups = [group for group in groups if shard_of(group['cn'], run_state.group_shard[1]) == run_state.group_shard[0]]
+            if 'member' in attributes:
+                resolved = resolve_dns(conn, [group['dn'] for group in groups], ['member'])
+                for group in groups:
+                    group['members'] = [str(member_dn) for member_dn in resolved.get(group['dn'].lower(), {}).get('member', [])]
+    metrics.count('ldap_groups_matched', len(groups))
+    return groups
+
+def collect_via_members(conn, base_dn, prefixes, group_filter=''):
+    """
+    Collects memberships by reading each group's member list and resolving the member DNs.
+
+    Returns:
+        tuple: (list of (group name, member DNs), dict of lowercased DN -> user record)
+    """
+    groups = search_groups_in_parallel(conn, base_dn, prefixes, ('member', 'cn'), group_filter)
+    group_members = [(group['cn'], group['members']) for group in groups]
+    log(f"Found {len(group_members)} groups.")
+    member_dns = {member_dn for _, members in group_members for member_dn in members}
+    log(f"Resolving {len(member_dns)} distinct member DNs...")
+    with metrics.phase('member_resolution'):
+        return group_members, resolve_members(conn, member_dns)
+
+def _memberof_batches(conn, base_dn, group_names):
+    """
+    Runs the paged memberOf person searches one chunk of groups at a time and yields
+    (group name -> member DNs, lowercased DN -> user record) per chunk. Users already
+    returned by an earlier chunk are skipped: their memberOf listed every group then.
+    """
+    seen = set()
+
+    def search_chunk(c, chunk):
+        member_of_filter = ''.join(f'(memberOf={escape_filter_chars(dn)})' for dn in chunk)
+        person_filter = f'(&(objectCategory=person)(|{member_of_filter}))'
+        return list(paged_search(c, base_dn, person_filter, settings.USER_ATTRIBUTES + ['memberOf']))
+
+    group_dns = list(group_names)
+    chunks = [group_dns[i:i + settings.LDAP_BATCH_SIZE] for i in range(0, len(group_dns), settings.LDAP_BATCH_SIZE)]
+    for results in ldap_imap(conn, search_chunk, chunks):
+        group_members = defaultdict(list)
+        members_by_dn = {}
+        for dn, attributes in results:
+            if dn.lower() in seen:
+                continue
+            seen.add(dn.lower())
+            members_by_dn[dn.lower()] = _user_record(dn, attributes)
+            for group_dn in attributes.get('memberOf', []):
+                group_name = group_names.get(str(group_dn).lower())
+                if group_name:
+                    group_members[group_name].append(dn)
+        yield group_members, members_by_dn
+
+def collect_via_memberof(conn, base_dn, prefixes, group_filter=''):
+    """
+    Collects memberships with paged person searches on memberOf, so group member
+    lists never have to be read. Each user is returned once with its matching groups.
+
+    Returns:
+        tuple: (list of (group name, member DNs), dict of lowercased DN -> user record)
+    """
+    group_names = {}
+    group_members = {}
+    for group in search_groups_in_parallel(conn, base_dn, prefixes, ('cn',), group_filter):
+        group_names[group['dn'].lower()] = group['cn']
+        group_members[group['cn']] = []
+    log(f"Found {len(group_members)} groups.")
+    members_by_dn = {}
+    with metrics.phase('member_resolution'):
+        for batch_members, batch_users in _memberof_batches(conn, base_dn, group_names):
+            members_by_dn.update(batch_users)
+            for group_name, member_dns in batch_members.items():
+                group_members[group_name].extend(member_dns)
+
+    log(f"Found {len(members_by_dn)} users via memberOf.")
+    return list(group_members.items()), members_by_dn
+
+def expand_nested_groups(conn, group_members, members_by_dn):
+    """
+    Replaces nested groups in each top-level group's member list with the people
+    they contain, transitively.
+
+    Every nested group is read once (level by level, in batches) and its effective
+    members are memoized. Cycles are detected through the active resolution stack
+    and logged; results computed while a cycle was open are not memoized, so they
+    cannot leak an incomplete member set into other groups.
+
+    Returns:
+        tuple: (expanded group_members, members_by_dn). The path through which each
+        person inherits a group is recorded in membership_paths.
+    """
+    nested = {}
+    pending = {dn for dn, record in members_by_dn.items() if 'group' in record['object_classes']}
+    while pending:
+        log(f"Expanding {len(pending)} nested groups...")
+        resolved = resolve_dns(conn, pending, ['cn', 'member'])
+        new_dns = set()
+        for dn in pending:
+            attributes = resolved.get(dn, {})
+            member_dns = [str(m) for m in attributes.get('member', [])]
+            nested[dn] = (_attr_value(attributes, 'cn') or dn, member_dns)
+            new_dns.update(m for m in member_dns if m.lower() not in members_by_dn)
+        members_by_dn.update(resolve_members(conn, new_dns))
+        pending = {
+            m.lower() for m in new_dns
+            if m.lower() in members_by_dn and 'group' in members_by_dn[m.lower()]['object_classes'] and m.lower() not in nested
+        }
+
+    memo = {}
+
+    def effective(group_dn, stack):
+        if group_dn in memo:
+            return memo[group_dn], True
+        if group_dn in stack:
+            cycle = ' > '.join(nested[dn][0] for dn in stack + [group_dn])
+            log(f"    [!] Nested group cycle detected: {cycle}")
+            return {}, False
+        result, complete = {}, True
+        for member_dn in nested.get(group_dn, (None, []))[1]:
+            key = member_dn.lower()
+            record = members_by_dn.get(key)
+            if not record:
+                continue
+            if 'group' in record['object_classes']:
+                inherited, inherited_complete = effective(key, stack + [group_dn])
+                complete = complete and inherited_complete
+                for person, path in inherited.items():
+                    result.setdefault(person, (nested[key][0],) + path)
+            elif is_person(record):
+                result.setdefault(key, ())
+        if complete:
+            memo[group_dn] = result
+        return result, complete
+
+    expanded = []
+    for group_name, members in group_members:
+        people = {}
+        for member_dn in members:
+            record = members_by_dn.get(member_dn.lower())
+            if not record or 'group' not in record['object_classes']:
+                people.setdefault(member_dn.lower(), member_dn)
+        for member_dn in members:
+            key = member_dn.lower()
+            record = members_by_dn.get(key)
+            if record and 'group' in record['object_classes']:
+                inherited, _ = effective(key, [])
+                for person, path in inherited.items():
+                    if person not in people:
+                        people[person] = members_by_dn[person]['dn']
+                        run_state.membership_paths[(person, group_name)] = (nested[key][0],) + path
+        expanded.append((group_name, list(people.values())))
+    return expanded, members_by_dn
+
+def server_supports_in_chain(conn):
+    """
+    LDAP_MATCHING_RULE_IN_CHAIN is an Active Directory extension; detect AD via its capability OID.
+    """
+    info = conn.server.info
+    capabilities = info.other.get('supportedCapabilities', []) if info else []
+    return '1.2.840.113556.1.4.800' in [str(c) for c in capabilities]
+
+def collect_via_in_chain(conn, base_dn, prefixes, group_filter=''):
+    """
+    Server-side nested expansion: one LDAP_MATCHING_RULE_IN_CHAIN person search per
+    prefixed group. Users whose own memberOf does not list the group inherited it
+    through nesting; AD does not return the intermediate groups, so the path is
+    recorded as '(nested)'.
+
+    Returns:
+        tuple: (list of (group name, member DNs), dict of lowercased DN -> user record)
+    """
+    groups = search_groups_in_parallel(conn, base_dn, prefixes, ('cn',), group_filter)
+    log(f"Found {len(groups)} groups.")
+
+    def search_group(c, group):
+        chain_filter = f'(&(objectCategory=person)(memberOf:1.2.840.113556.1.4.1941:={escape_filter_chars(group["dn"])}))'
+        return list(paged_search(c, base_dn, chain_filter, settings.USER_ATTRIBUTES + ['memberOf']))
+
+    group_members = []
+    members_by_dn = {}
+    with metrics.phase('member_resolution'):
+        group_results = ldap_map(conn, search_group, groups)
+    for group, results in zip(groups, group_results):
+        members = []
+        for dn, attributes in results:
+            key = dn.lower()
+            members_by_dn.setdefault(key, _user_record(dn, attributes))
+            members.append(dn)
+            if group['dn'].lower() not in [str(g).lower() for g in attributes.get('memberOf', [])]:
+                run_state.membership_paths[(key, group['cn'])] = ('(nested)',)
+        group_members.append((group['cn'], members))
+    log(f"Found {len(members_by_dn)} users via LDAP_MATCHING_RULE_IN_CHAIN.")
+    return group_members, members_by_dn
+
+def collect_memberships(conn, base_dn, prefixes, group_filter=''):
+    if settings.EXPAND_NESTED:
+        if settings.NESTED_FAST_PATH and server_supports_in_chain(conn):
+            return collect_via_in_chain(conn, base_dn, prefixes, group_filter)
+        group_members, members_by_dn = collect_via_members(conn, base_dn, prefixes, group_filter)
+        with metrics.phase('nested_expansion'):
+            return expand_nested_groups(conn, group_members, members_by_dn)
+    if settings.COLLECTION_ENGINE == 'memberof':
+        return collect_via_memberof(conn, base_dn, prefixes, group_filter)
+    return collect_via_members(conn, base_dn, prefixes, group_filter)
+
+def stream_memberships(conn, base_dn, prefixes, group_filter=''):
+    """
+    Streaming counterpart of collect_memberships for the pipeline. Yields
+    (group_members, members_by_dn) batches as each LDAP batch resolves, so the
+    database stage can start before collection finishes.
+
+    The first batch lists every matched group with no members. Nested expansion
+    needs the whole group graph, so it is yielded as a single batch.
+    """
+    if settings.EXPAND_NESTED:
+        yield collect_memberships(conn, base_dn, prefixes, group_filter)
+        return
+
+    if settings.COLLECTION_ENGINE == 'memberof':
+        group_names = {group['dn'].lower(): group['cn'] for group in search_groups_in_parallel(conn, base_dn, prefixes, ('cn',), group_filter)}
+        log(f"Found {len(group_names)} groups.")
+        yield [(group_name, []) for group_name in group_names.values()], {}
+        for batch_members, batch_users in _memberof_batches(conn, base_dn, group_names):
+            yield list(batch_members.items()), batch_users
+        return
+
+    groups = search_groups_in_parallel(conn, base_dn, prefixes, ('member', 'cn'), group_filter)
+    log(f"Found {len(groups)} groups.")
+    yield [(group['cn'], []) for group in groups], {}
+    groups_by_member = defaultdict(list)
+    for group in groups:
+        for member_dn in group['members']:
+            groups_by_member[member_dn.lower()].append((group['cn'], member_dn))
+    member_dns = list(groups_by_member)
+    log(f"Resolving {len(member_dns)} distinct member DNs...")
+    chunks = [member_dns[i:i + settings.LDAP_BATCH_SIZE] for i in range(0, len(member_dns), settings.LDAP_BATCH_SIZE)]
+    for chunk, resolved in zip(chunks, ldap_imap(conn, resolve_members, chunks)):
+        batch_members = defaultdict(list)
+        for key in chunk:
+            for group_name, member_dn in groups_by_member[key]:
+                batch_members[group_name].append(member_dn)
+        yield list(batch_members.items()), resolved
+
+def directory_usn_state(conn):
+    """
+    Returns the (highestCommittedUSN, dsServiceName) pair read from the rootDSE at bind time.
+    USNs are local to a domain controller, so the DC identity is stored alongside the watermark.
+    """
+    other = conn.server.info.other if conn.server.info else {}
+    usn = (other.get('highestCommittedUSN') or [None])[0]
+    dc = (other.get('dsServiceName') or [None])[0]
+    return (int(usn) if usn is not None else None), (str(dc) if dc else None)
+
+def sync_state_key():
+    return f"{settings.COLLECTION_ENGINE}:{','.join(sorted(p.lower() for p in settings.GROUP_PREFIXES))}"
 
-def get_manager_email_from_dn(conn, manager_dn):
-    if manager_dn and manager_dn.strip():
+def load_usn_watermark(cursor, conn):
+    """
+    Returns the stored USN high-water mark if it can be used for an incremental run
+    against this DC and prefix set, otherwise None (meaning a full sync is needed).
+    """
+    cursor.execute("SELECT name, value FROM sync_state WHERE name IN ('usn', 'usn_dc', 'usn_scope')")
+    state = dict(cursor.fetchall())
+    _, dc = directory_usn_state(conn)
+    if 'usn' not in state:
+        log("No USN high-water mark stored yet; running a full sync.")
+        return None
+    if state.get('usn_dc') != dc:
+        log(f"USN high-water mark was taken on a different DC ({state.get('usn_dc')}); running a full sync.")
+        return None
+    if state.get('usn_scope') != sync_state_key():
+        log("Group prefixes or engine changed since the last sync; running a full sync.")
+        return None
+    return int(state['usn'])
+
+def save_usn_watermark(cursor, usn, dc):
+    executemany_batched(cursor, '''
+        INSERT INTO sync_state (name, value, updated_at) VALUES (%s, %s, NOW())
+        ON DUPLICATE KEY UPDATE value = VALUES(value), updated_at = VALUES(updated_at)
+    ''', [('usn', str(usn)), ('usn_dc', dc), ('usn_scope', sync_state_key())])
+
+def refresh_changed_users(conn, cursor, base_dn, since_usn):
+    """
+    Updates email and manager for already-known users whose directory entry changed
+    since the watermark. Membership changes are picked up through the groups instead,
+    because memberOf is a back-link and does not bump the user's uSNChanged.
+    """
+    changed = []
+    person_filter = f'(&(objectCategory=person)(uSNChanged>={since_usn + 1}))'
+    for dn, attributes in paged_search(conn, base_dn, person_filter, settings.USER_ATTRIBUTES):
+        record = _user_record(dn, attributes)
+        if record['username']:
+            changed.append(record)
+    manager_cache.prime(conn, {u['manager_dn'] for u in changed if u['manager_dn']})
+    executemany_batched(cursor, 'UPDATE users SET email = %s, manager_email = %s, display_name = %s WHERE username = %s', [
+        (u['email'], manager_cache.get(conn, u['manager_dn']), u['full_name'], u['username']) for u in changed
+    ])
+    log(f"Refreshed attributes for {len(changed)} changed directory users.")
+    return len(changed)
+
+def resolve_manager_emails(conn, manager_dns):
+    """
+    Resolves manager DNs to email addresses in batches, keyed by lowercased DN.
+    """
+    manager_dns = [dn for dn in manager_dns if dn and dn.strip()]
+    emails = {}
+    for i in range(0, len(manager_dns), settings.LDAP_BATCH_SIZE):
+        chunk = manager_dns[i:i + settings.LDAP_BATCH_SIZE]
         try:
-            conn.search(manager_dn, '(objectClass=person)', attributes=['mail'])
-            if conn.entries:
-                return str(conn.entries[0].mail)
+            resolved = resolve_dns(conn, chunk, ['mail'])
         except Exception as e:
-            log(f"    [!] Error fetching manager details for DN {manager_dn}: {e}")
-    return None
+            log(f"    [!] Error fetching manager details: {e}")
+            send_minor_error("AD Audit: Manager Lookup Failed", "Failed to lookup managers:\n" + "\n".join(chunk) + f"\nError: {e}")
+            continue
+        for dn, attributes in resolved.items():
+            emails[dn] = _attr_value(attributes, 'mail')
+    return emails
 
-def list_managers_only():
-    conn = ldap_connection()
-    for prefix in GROUP_PREFIXES:
-        log(f"Searching for groups starting with prefix: {prefix}")
-        conn.search(BASE_DN, f'(&(objectClass=group)(cn={prefix}*))', attributes=['member', 'cn'])
-        log(f"Found {len(conn.entries)} groups.")
-
-        unique_managers = set()
-        for group in conn.entries:
-            members = group.member.values if 'member' in group else []
-            for member_dn in members:
-                conn.search(member_dn, '(objectClass=*)', attributes=['objectClass'])
-                if not conn.entries:
-                    log(f"    [-] Failed to fetch entry at: {member_dn}")
-                    continue
+class ManagerEmailCache:
+    """
+    Run-wide manager DN -> email memoization shared by every mode.
 
-                object_classes = [str(oc).lower() for oc in conn.entries[0]['objectClass']]
-                if 'person' not in object_classes:
-                    log(f"    [-] Skipping non-user entry: {member_dn} (objectClass: {object_classes})")
-                    continue
-                conn.search(member_dn, '(objectClass=person)', attributes=['manager'])
-                if not conn.entries:
-                    continue
-                user = conn.entries[0]
-                manager_dn = str(user.manager) if 'manager' in user else None
-                email = get_manager_email_from_dn(conn, manager_dn)
-                if email:
-                    unique_managers.add(email)
+    DNs that cannot be resolved (missing entry, no mail, or a failed lookup) are
+    cached as None, so they are only looked up and reported once per run.
+    """
 
-        print("\n=== Unique Manager Emails ===")
-        for email in sorted(unique_managers):
-            print(email)
-    conn.unbind()
+    def __init__(self):
+        self.emails = {}
+        self.hits = 0
+        self.misses = 0
+
+    def prime(self, conn, manager_dns):
+        """
+        Resolves every uncached DN in batched searches.
+        """
+        missing = {dn.lower(): dn for dn in manager_dns if dn and dn.strip() and dn.lower() not in self.emails}
+        if not missing:
+            return
+        self.misses += len(missing)
+        resolved = resolve_manager_emails(conn, missing.values())
+        for key, dn in missing.items():
+            email = resolved.get(key)
+            self.emails[key] = email
+            if not email:
+                log(f"    [!] Could not resolve manager email for DN {dn}; it will not be looked up again this run.")
+
+    def get(self, conn, manager_dn):
+        if not manager_dn or not manager_dn.strip():
+            return None
+        key = manager_dn.lower()
+        if key in self.emails:
+            self.hits += 1
+            return self.emails[key]
+        if conn is None:
+            return None
+        self.prime(conn, [manager_dn])
+        return self.emails.get(key)
+
+    @property
+    def negative(self):
+        return sum(1 for email in self.emails.values() if not email)
+
+    def summary(self):
+        return f"{self.hits} hits / {self.misses} misses ({self.negative} unresolved)"
+
+manager_cache = ManagerEmailCache()
+
+
+class CountingCursor:
+    """
+    Cursor wrapper that counts statements (and rows sent through executemany) in the run metrics.
+    """
 
-def list_manager_user_counts():
-    conn = ldap_connection()
-    for prefix in GROUP_PREFIXES:
-        log(f"Searching for groups starting with prefix: {prefix}")
-        conn.search(BASE_DN, f'(&(objectClass=group)(cn={prefix}*))', attributes=['member', 'cn'])
+    def __init__(self, cursor):
+        self._cursor = cursor
 
-        manager_user_counts = defaultdict(set)
-        for group in conn.entries:
-            members = group.member.values if 'member' in group else []
-            for member_dn in members:
-                conn.search(member_dn, '(objectClass=*)', attributes=['objectClass'])
-                if not conn.entries:
-                    log(f"    [-] Failed to fetch entry at: {member_dn}")
-                    continue
+    def execute(self, operation, params=None, *args, **kwargs):
+        metrics.count('sql_statements')
+        return self._cursor.execute(operation, params, *args, **kwargs)
 
-                object_classes = [str(oc).lower() for oc in conn.entries[0]['objectClass']]
-                if 'person' not in object_classes:
-                    log(f"    [-] Skipping non-user entry: {member_dn} (objectClass: {object_classes})")
-                    continue
-                
-                conn.search(member_dn, '(objectClass=person)', attributes=['manager', 'sAMAccountName'])
-                if not conn.entries:
-                    continue
-                user = conn.entries[0]
-                manager_dn = str(user.manager) if 'manager' in user else None
-                username = str(user.sAMAccountName) if 'sAMAccountName' in user else None
-                if manager_dn and username:
-                    email = get_manager_email_from_dn(conn, manager_dn)
-                    if email:
-                        manager_user_counts[email].add(username)
+    def executemany(self, operation, seq_params, *args, **kwargs):
+        metrics.count('sql_statements')
+        metrics.count('sql_batched_rows', len(seq_params))
+        return self._cursor.executemany(operation, seq_params, *args, **kwargs)
 
-        print("\n=== Manager Emails and Managed Users Count ===")
-        for email, users in sorted(manager_user_counts.items()):
-            print(f"{email:<40} | {len(users)} users")
-    conn.unbind()
+    def __iter__(self):
+        return iter(self._cursor)
 
-if list_managers_mode:
-    list_managers_only()
-    sys.exit(0)
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
 
-if list_manager_counts_mode:
-    list_manager_user_counts()
-    sys.exit(0)
+class CountingConnection:
+    """
+    MySQL connection wrapper whose cursors are CountingCursors. Everything else,
+    including attribute assignment such as `autocommit`, goes to the real connection.
+    """
 
-if 'debug_user_email' in locals() and debug_user_email:
-    db = mysql_connection()
-    conn = ldap_connection()
-    cursor = db.cursor()
+    def __init__(self, connection):
+        object.__setattr__(self, '_connection', connection)
 
-    # 1. Find matching username
-    cursor.execute('SELECT username, email FROM users WHERE LOWER(email) = %s', (debug_user_email.lower(),))
-    row = cursor.fetchone()
-    if not row:
-        print(f"[!] No user found in DB with email {debug_user_email}")
-        sys.exit(1)
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(self._connection.cursor(*args, **kwargs))
 
-    username = row[0]
-    print(f"\n=== DEBUG: {username} ({debug_user_email}) ===")
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
 
-    # 2. Collect LDAP groups by group prefix
-    user_current_groups = defaultdict(set)
-    all_groups = search_groups_by_prefixes(conn, BASE_DN, GROUP_PREFIXES)
-    for group in all_groups:
-        group_name = str(group.cn)
-        members = group.member.values if 'member' in group else []
-        for member_dn in members:
-            conn.search(member_dn, '(objectClass=person)', attributes=['mail', 'sAMAccountName'])
-            if conn.entries:
-                entry = conn.entries[0]
-                if 'mail' in entry and str(entry.mail).lower() == debug_user_email.lower():
-                    ldap_username = str(entry.sAMAccountName)
-                    user_current_groups[ldap_username].add(group_name)
-
-    ldap_groups = user_current_groups.get(username, set())
-    print(f"LDAP Groups: {ldap_groups}")
-
-    # 3. Load DB groups
-    cursor.execute('SELECT group_name FROM user_groups WHERE username = %s', (username,))
-    db_groups = set(row[0] for row in cursor.fetchall())
-    print(f"DB Groups:   {db_groups}")
-
-    # 4. Diff
-    if db_groups != ldap_groups:
-        print("Differences detected:")
-        print(f"  In DB not in LDAP:   {db_groups - ldap_groups}")
-        print(f"  In LDAP not in DB:   {ldap_groups - db_groups}")
+    def __setattr__(self, name, value):
+        setattr(self._connection, name, value)
+
+def mysql_connection():
+    with metrics.phase('mysql_connect'):
+        return CountingConnection(_mysql_connect())
+
+def _mysql_connect():
+    import mysql.connector
+    log("Connecting to MySQL database...")
+    mysql_secret_key = config['mysql'].get('secret_name', fallback=None)
+    mysql_has_plain = all(k in config['mysql'] for k in ('host', 'port', 'user', 'password', 'database'))
+    if mysql_secret_key and mysql_has_plain:
+        print("[!] Both MySQL secret_name and plaintext credentials are configured. Please remove one.")
+        sys.exit(1)
+    if mysql_secret_key:
+        db_secret = get_secret(mysql_secret_key)
+        return mysql.connector.connect(
+            host=db_secret['host'],
+            port=int(db_secret['port']),
+            user=db_secret['user'],
+            password=db_secret['password'],
+            database=db_secret['database']
+        )
     else:
-        print("Groups are consistent.")
+        return mysql.connector.connect(
+            host=config['mysql']['host'],
+            port=config.getint('mysql', 'port'),
+            user=config['mysql']['user'],
+            password=config['mysql']['password'],
+            database=config['mysql']['database']
+        )
 
-    # 5. Show audit history
-    cursor.execute('SELECT audit_date FROM audit_log WHERE username = %s ORDER BY audit_date DESC LIMIT 5', (username,))
-    audits = cursor.fetchall()
-    print("Recent Audits:")
-    for row in audits:
-        print(f" - {row[0]}")
+def _column_exists(cursor, table, column):
+    cursor.execute('''
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s
+    ''', (table, column))
+    return cursor.fetchone()[0] > 0
 
-    db.rollback()
-    cursor.close()
-    db.close()
-    conn.unbind()
-    sys.exit(0)
+def _index_exists(cursor, table, index):
+    cursor.execute('''
+        SELECT COUNT(*) FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s
+    ''', (table, index))
+    return cursor.fetchone()[0] > 0
 
-try:
-    conn = ldap_connection()
+def _add_column(cursor, table, column, definition):
+    if not _column_exists(cursor, table, column):
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
 
-    db = mysql_connection()
-    
-    cursor = db.cursor()
+def _add_index(cursor, table, index, columns):
+    if not _index_exists(cursor, table, index):
+        cursor.execute(f'ALTER TABLE {table} ADD INDEX {index} ({columns})')
 
-    log("Ensuring tables exist...")
+def _migration_base_tables(cursor):
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
             username VARCHAR(255) PRIMARY KEY,
@@ -405,236 +1249,1872 @@ try:
             secret VARCHAR(64)
         )
     ''')
-    db.commit()
 
-    log(f"Searching for groups starting with prefix: {GROUP_PREFIXES}")
-    groups = search_groups_by_prefixes(conn, BASE_DN, GROUP_PREFIXES)
-    log(f"Found {len(groups)} groups.")
+def _migration_outbox_and_sync_state(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            secret VARCHAR(64),
+            manager_email VARCHAR(255),
+            recipient VARCHAR(255),
+            subject VARCHAR(255),
+            plain_text MEDIUMTEXT,
+            html_content MEDIUMTEXT,
+            status VARCHAR(16) NOT NULL DEFAULT 'pending',
+            attempts INT NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            sent_at DATETIME NULL,
+            KEY idx_outbox_status (status, id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            name VARCHAR(64) PRIMARY KEY,
+            value VARCHAR(255),
+            updated_at DATETIME
+        )
+    ''')
 
-    user_display_names = {}
+def _migration_review_columns(cursor):
+    # Columns the frontend writes when a manager completes a review
+    _add_column(cursor, 'audit_log', 'date_reviewed', 'DATETIME NULL')
+    _add_column(cursor, 'audit_log', 'changes', 'TEXT NULL')
 
-    for group in groups:
-        group_name = str(group.cn)
-        log(f"\n[Group] {group_name}")
-        members = group.member.values if 'member' in group else []
+def _migration_hot_path_indexes(cursor):
+    _add_index(cursor, 'audit_log', 'idx_audit_manager_date', 'manager_email, audit_date')
+    _add_index(cursor, 'audit_log', 'idx_audit_manager_reviewed', 'manager_email, date_reviewed')
+    _add_index(cursor, 'audit_log', 'idx_audit_secret', 'secret')
+    _add_index(cursor, 'audit_log', 'idx_audit_username_date', 'username, audit_date')
+    _add_index(cursor, 'users', 'idx_users_last_audited', 'last_audited')
 
-        for member_dn in members:
-            conn.search(member_dn, '(objectClass=*)', attributes=['objectClass'])
-            if not conn.entries:
-                log(f"    [-] Failed to fetch entry at: {member_dn}")
-                continue
+def _migration_audit_date_index(cursor):
+    _add_index(cursor, 'audit_log', 'idx_audit_date_manager', 'audit_date, manager_email')
 
-            object_classes = [str(oc).lower() for oc in conn.entries[0]['objectClass']]
-            if 'person' not in object_classes:
-                log(f"    [-] Skipping non-user entry: {member_dn} (objectClass: {object_classes})")
-                continue
-            log(f"  [User DN] {member_dn}")
-            conn.search(member_dn, '(objectClass=person)', attributes=['sAMAccountName', 'mail', 'manager', 'givenName', 'sn'])
-            if not conn.entries:
-                log(f"    [-] Failed to fetch user at: {member_dn}")
-                continue
+def _migration_outbox_created_index(cursor):
+    _add_index(cursor, 'email_outbox', 'idx_outbox_created_manager', 'created_at, manager_email')
 
-            user = conn.entries[0]
-            username = str(user.sAMAccountName)
-            email = str(user.mail) if 'mail' in user else None
-            given_name = str(user.givenName) if 'givenName' in user else ''
-            surname = str(user.sn) if 'sn' in user else ''
-            full_name = f"{given_name.capitalize()} {surname.capitalize()}".strip()
-            user_display_names[username] = full_name
+def _migration_shard_leases(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS audit_leases (
+            run_id VARCHAR(64),
+            phase VARCHAR(16),
+            shard INT,
+            shard_count INT NOT NULL,
+            owner VARCHAR(255) NULL,
+            expires_at DATETIME NULL,
+            claims INT NOT NULL DEFAULT 0,
+            completed_at DATETIME NULL,
+            PRIMARY KEY (run_id, phase, shard)
+        )
+    ''')
+    # Lets a worker render emails for users another worker synced
+    _add_column(cursor, 'users', 'display_name', 'VARCHAR(255) NULL')
 
-            manager_dn = str(user.manager) if 'manager' in user else None
-            manager_email = None
+def _migration_review_snapshot(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS audit_review_snapshot (
+            secret VARCHAR(64) PRIMARY KEY,
+            username VARCHAR(255),
+            display_name VARCHAR(255),
+            email VARCHAR(255),
+            groups_json MEDIUMTEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
 
-            log(f"    [+] Found user: {full_name} ({email}, {username})")
-            user_count += 1
+def _migration_audit_log_archive(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS audit_log_archive (
+            id INT PRIMARY KEY,
+            username VARCHAR(255),
+            manager_email VARCHAR(255),
+            audit_date DATE,
+            secret VARCHAR(64),
+            date_reviewed DATETIME NULL,
+            changes TEXT NULL,
+            display_name VARCHAR(255) NULL,
+            email VARCHAR(255) NULL,
+            groups_json MEDIUMTEXT NULL,
+            archived_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            KEY idx_archive_username_date (username, audit_date)
+        )
+    ''')
 
-            if manager_dn and manager_dn.strip():
-                log(f"    [Manager DN] {manager_dn}")
-                try:
-                    conn.search(manager_dn, '(objectClass=person)', attributes=['mail'])
-                    if conn.entries:
-                        manager_email = str(conn.entries[0].mail)
-                        log(f"    [+] Manager Email: {manager_email}")
-                except Exception as e:
-                    log(f"    [!] Error fetching manager details: {e}")
-                    send_minor_error("AD Audit: Manager Lookup Failed", f"Failed to lookup manager for user DN: {member_dn}\nError: {e}")
-            else:
-                log("    [!] Manager DN is missing or invalid.")
+def _migration_outbox_claims(cursor):
+    # A drain claims rows before sending them, so concurrent drains never send the same row
+    _add_column(cursor, 'email_outbox', 'claimed_by', 'VARCHAR(64) NULL')
+    _add_column(cursor, 'email_outbox', 'claimed_until', 'DATETIME NULL')
+
+def _migration_audit_outbox_secret(cursor):
+    # Ties each audit to the email that carries it, so a permanently failed email's audits can be undone
+    _add_column(cursor, 'audit_log', 'outbox_secret', 'VARCHAR(64) NULL')
+    _add_index(cursor, 'audit_log', 'idx_audit_outbox_secret', 'outbox_secret')
+
+def _migration_outbox_retry_schedule(cursor):
+    # Failed sends wait out a backoff before any drain retries them
+    _add_column(cursor, 'email_outbox', 'next_attempt_at', 'DATETIME NULL')
+
+def _migration_archive_outbox_secret(cursor):
+    # Archived reviews keep the link to the email that carried them
+    _add_column(cursor, 'audit_log_archive', 'outbox_secret', 'VARCHAR(64) NULL')
+
+# Append-only: each entry runs once per database, in order, and is recorded in schema_version.
+# Steps must be idempotent so databases created before versioning existed can be brought up to date.
+SCHEMA_MIGRATIONS = [
+    (1, 'Base users, user_groups and audit_log tables', _migration_base_tables),
+    (2, 'email_outbox and sync_state tables', _migration_outbox_and_sync_state),
+    (3, 'audit_log review columns used by the frontend', _migration_review_columns),
+    (4, 'Indexes for audit_log and users hot query paths', _migration_hot_path_indexes),
+    (5, 'audit_log index for the per-day quota aggregate', _migration_audit_date_index),
+    (6, 'email_outbox index for the per-day digest quota', _migration_outbox_created_index),
+    (7, 'audit_leases table and users.display_name for sharded runs', _migration_shard_leases),
+    (8, 'audit_review_snapshot table read by the frontend', _migration_review_snapshot),
+    (9, 'audit_log_archive table for closed reviews past retention', _migration_audit_log_archive),
+    (10, 'email_outbox claim columns for concurrent drains', _migration_outbox_claims),
+    (11, 'audit_log.outbox_secret linking audits to their email', _migration_audit_outbox_secret),
+    (12, 'email_outbox.next_attempt_at for retries between drains', _migration_outbox_retry_schedule),
+    (13, 'audit_log_archive.outbox_secret kept from audit_log', _migration_archive_outbox_secret),
+]
+
+# Index builds on a large audit_log can take a while; a worker waits this long for another to finish migrating
+MIGRATION_LOCK_SECONDS = 3600
+
+def migrate_schema(db):
+    """
+    Brings the database schema up to the latest version in SCHEMA_MIGRATIONS.
 
-            cursor.execute('SELECT last_audited FROM users WHERE username = %s', (username,))
-            row = cursor.fetchone()
-            last_audited = row[0] if row else None
+    Migrations run under the named lock ad_auditor_migrate, so sharded workers
+    starting together apply each migration once. The version is read after the
+    lock is taken, so a worker that waited sees what the holder applied.
+    """
+    log("Checking database schema...")
+    cursor = db.cursor()
+    cursor.execute("SELECT GET_LOCK('ad_auditor_migrate', %s)", (MIGRATION_LOCK_SECONDS,))
+    if cursor.fetchone()[0] != 1:
+        cursor.close()
+        raise Exception(f"Timed out after {MIGRATION_LOCK_SECONDS}s waiting for another process to finish migrating the schema")
+    try:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INT PRIMARY KEY,
+                description VARCHAR(255),
+                applied_at DATETIME
+            )
+        ''')
+        cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+        current_version = cursor.fetchone()[0]
+        for version, description, migration in SCHEMA_MIGRATIONS:
+            if version <= current_version:
+                continue
+            log(f"Applying schema migration {version}: {description}")
+            migration(cursor)
+            cursor.execute('INSERT INTO schema_version (version, description, applied_at) VALUES (%s, %s, NOW())',
+                           (version, description))
+            db.commit()
+            current_version = version
+        log(f"Database schema is at version {current_version}.")
+    finally:
+        cursor.execute("SELECT RELEASE_LOCK('ad_auditor_migrate')")
+        cursor.fetchall()
+        cursor.close()
 
-            if row:
-                cursor.execute('UPDATE users SET email = %s, manager_email = %s WHERE username = %s', (email, manager_email, username))
-                if dry_run:
-                    log(f"    [DRY-RUN] Updated user: {username}")
-            else:
-                cursor.execute('INSERT INTO users (username, email, manager_email, last_audited) VALUES (%s, %s, %s, %s)',
-                               (username, email, manager_email, last_audited))
-                if dry_run:
-                    log(f"    [DRY-RUN] Inserted new user: {username}")
+ARCHIVE_COLUMNS = ('id', 'username', 'manager_email', 'audit_date', 'secret', 'date_reviewed', 'changes',
+                   'outbox_secret', 'display_name', 'email', 'groups_json')
 
-            cursor.execute('INSERT IGNORE INTO user_groups (username, group_name) VALUES (%s, %s)', (username, group_name))
-            if dry_run:
-                log(f"    [DRY-RUN] Inserted group: {username} -> {group_name}")
-            group_memberships += 1
+def archive_audit_log(db):
+    """
+    Moves closed reviews (date_reviewed set) with an audit_date older than
+    ARCHIVE_RETENTION_DAYS from audit_log and audit_review_snapshot into
+    audit_log_archive, and exports them to one gzip-compressed NDJSON or CSV file.
 
-            user_current_groups[username].add(group_name)
+    Candidates are streamed through an unbuffered cursor on a separate connection and
+    handled MYSQL_BATCH_SIZE rows at a time: each chunk is appended to the export and
+    then moved in its own transaction, so memory use does not grow with the backlog.
+    The export is renamed into place when complete; an interrupted run leaves a
+    .tmp file, and every row is either still in audit_log or in the archive table.
 
-    log("\n[✓] User and group import completed.\n")
+    Returns:
+        int: Number of reviews archived.
+    """
+    cutoff = date.today() - timedelta(days=settings.ARCHIVE_RETENTION_DAYS)
+    candidates = '''
+        FROM audit_log a
+        LEFT JOIN audit_review_snapshot s ON s.secret = a.secret
+        WHERE a.date_reviewed IS NOT NULL AND a.audit_date < %s
+    '''
+    cursor = db.cursor()
+    if settings.dry_run:
+        cursor.execute(f'SELECT COUNT(*) {candidates}', (cutoff,))
+        log(f"[DRY-RUN] Would archive {cursor.fetchone()[0]} closed reviews from before {cutoff}.")
+        cursor.close()
+        return 0
+
+    log(f"Archiving closed reviews from before {cutoff}...")
+    os.makedirs(settings.ARCHIVE_EXPORT_DIR, exist_ok=True)
+    path = os.path.join(settings.ARCHIVE_EXPORT_DIR, f"audit_log_before_{cutoff}_{time.strftime('%Y%m%dT%H%M%S')}.{settings.ARCHIVE_FORMAT}.gz")
+    tmp_path = f"{path}.tmp"
+    reader = mysql_connection()
+    read_cursor = reader.cursor(buffered=False)
+    archived = 0
+    try:
+        read_cursor.execute(f'''
+            SELECT a.id, a.username, a.manager_email, a.audit_date, a.secret, a.date_reviewed, a.changes,
+                   a.outbox_secret, s.display_name, s.email, s.groups_json
+            {candidates}
+            ORDER BY a.id
+        ''', (cutoff,))
+        with gzip.open(tmp_path, 'wt', encoding='utf-8', newline='') as out:
+            writer = csv.writer(out) if settings.ARCHIVE_FORMAT == 'csv' else None
+            if writer:
+                writer.writerow(ARCHIVE_COLUMNS)
+            while True:
+                rows = read_cursor.fetchmany(settings.MYSQL_BATCH_SIZE)
+                if not rows:
+                    break
+                with metrics.phase('archive_export'):
+                    for row in rows:
+                        if writer:
+                            writer.writerow(row)
+                        else:
+                            out.write(json.dumps(dict(zip(ARCHIVE_COLUMNS, row)), default=str) + '\n')
+                with metrics.phase('archive_move'):
+                    ids = [row[0] for row in rows]
+                    secrets = [row[4] for row in rows if row[4]]
+                    cursor.executemany(f'''
+                        INSERT IGNORE INTO audit_log_archive ({', '.join(ARCHIVE_COLUMNS)})
+                        VALUES ({', '.join(['%s'] * len(ARCHIVE_COLUMNS))})
+                    ''', rows)
+                    if secrets:
+                        cursor.execute(f"DELETE FROM audit_review_snapshot WHERE secret IN ({', '.join(['%s'] * len(secrets))})", secrets)
+                    cursor.execute(f"DELETE FROM audit_log WHERE id IN ({', '.join(['%s'] * len(ids))})", ids)
+                    db.commit()
+                archived += len(rows)
+                metrics.count('archived_reviews', len(rows))
+                log(f"    Archived {archived} reviews...")
+        read_cursor.close()
+    finally:
+        # On error the unbuffered cursor may still have unread rows, and closing it
+        # would raise "Unread result found" over the real error; closing the reader
+        # connection discards them
+        reader.close()
+        cursor.close()
 
-    log("\n[✓] Checking for stale group mappings...")
-    cursor.execute('SELECT DISTINCT username FROM user_groups')
-    all_usernames = [row[0] for row in cursor.fetchall()]
-
-    for username in all_usernames:
-        current_groups = user_current_groups.get(username, set())
-        cursor.execute('SELECT group_name FROM user_groups WHERE username = %s', (username,))
-        db_groups = set(row[0] for row in cursor.fetchall())
-
-        # Only consider groups that match the provided prefixes
-        db_groups_filtered = {
-            g for g in db_groups
-            if any(g.lower().startswith(p.lower()) for p in GROUP_PREFIXES)
-        }
+    if archived:
+        os.replace(tmp_path, path)
+        log(f"Archived {archived} closed reviews; exported to {path}")
+    else:
+        os.remove(tmp_path)
+        log("No closed reviews past the retention window.")
+    return archived
+
+def executemany_batched(cursor, sql, rows):
+    for i in range(0, len(rows), settings.MYSQL_BATCH_SIZE):
+        cursor.executemany(sql, rows[i:i + settings.MYSQL_BATCH_SIZE])
+
+def create_snapshot_table(cursor):
+    cursor.execute('DROP TEMPORARY TABLE IF EXISTS snapshot_user_groups')
+    cursor.execute('''
+        CREATE TEMPORARY TABLE snapshot_user_groups (
+            username VARCHAR(255),
+            group_name VARCHAR(255),
+            PRIMARY KEY (username, group_name)
+        )
+    ''')
 
-        stale_groups = db_groups_filtered - current_groups
+def append_snapshot(cursor, user_groups):
+    rows = sorted((username, group_name) for username, groups in user_groups.items() for group_name in groups)
+    executemany_batched(cursor, 'INSERT IGNORE INTO snapshot_user_groups (username, group_name) VALUES (%s, %s)', rows)
+    return rows
 
-        for stale_group in stale_groups:
-            if dry_run:
-                log(f"    [DRY-RUN] Would remove group: {username} -> {stale_group}")
+def stage_snapshot(cursor, user_groups):
+    """
+    Loads the current LDAP memberships into a session-scoped temporary table so
+    they can be applied and diffed with set-based statements.
+
+    Args:
+        cursor: An open MySQL cursor.
+        user_groups (dict): username -> set of group names.
+    """
+    create_snapshot_table(cursor)
+    return len(append_snapshot(cursor, user_groups))
+
+UPSERT_USERS_SQL = '''
+    INSERT INTO users (username, email, manager_email, display_name) VALUES (%s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE email = VALUES(email), manager_email = VALUES(manager_email), display_name = VALUES(display_name)
+'''
+
+# Compares last_audited against a constant so idx_users_last_audited can serve the range;
+# bench/audit_log_query_plans.py times this exact statement
+DUE_USERS_SQL = '''
+    SELECT u.username, u.email, u.manager_email, u.display_name
+    FROM users u
+    WHERE u.manager_email IS NOT NULL
+    AND (
+        u.last_audited IS NULL
+        OR u.last_audited <= CURDATE() - INTERVAL %s DAY
+    ) {shard_clause}
+    ORDER BY u.last_audited IS NOT NULL, u.last_audited ASC
+'''
+
+def sync_snapshot(cursor, users, user_groups):
+    """
+    Applies an LDAP snapshot to `users` and `user_groups` with batched upserts
+    instead of per-membership statements.
+
+    Args:
+        cursor: An open MySQL cursor.
+        users (dict): username -> (email, manager_email, display_name).
+        user_groups (dict): username -> set of group names.
+    """
+    user_rows = [(username, *user) for username, user in sorted(users.items())]
+    executemany_batched(cursor, UPSERT_USERS_SQL, user_rows)
+
+    staged = stage_snapshot(cursor, user_groups)
+    cursor.execute('''
+        INSERT IGNORE INTO user_groups (username, group_name)
+        SELECT username, group_name FROM snapshot_user_groups
+    ''')
+    added = cursor.rowcount
+
+    if settings.dry_run:
+        log(f"    [DRY-RUN] Upserted {len(user_rows)} users")
+        log(f"    [DRY-RUN] Inserted {added} new group mappings ({staged} current)")
+    else:
+        log(f"    Upserted {len(user_rows)} users, added {added} new group mappings ({staged} current)")
+
+def sync_snapshot_batch(cursor, users, user_groups):
+    """
+    Pipeline counterpart of sync_snapshot: upserts one batch of users, appends their
+    memberships to the already-created `snapshot_user_groups` table and inserts new
+    mappings directly, so each batch costs the same however many came before it.
+    """
+    user_rows = [(username, *user) for username, user in sorted(users.items())]
+    executemany_batched(cursor, UPSERT_USERS_SQL, user_rows)
+    rows = append_snapshot(cursor, user_groups)
+    executemany_batched(cursor, 'INSERT IGNORE INTO user_groups (username, group_name) VALUES (%s, %s)', rows)
+    log(f"    {'[DRY-RUN] ' if settings.dry_run else ''}Upserted {len(user_rows)} users, {len(rows)} group mappings")
+
+def like_prefix(prefix):
+    escaped = prefix.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"{escaped}%"
+
+def prune_stale_groups(cursor, prefixes, group_names=None, shard=None):
+    """
+    Removes prefixed `user_groups` rows that are missing from the staged LDAP
+    snapshot, diffing both sides inside MySQL in a single query and deleting in batches.
+
+    Args:
+        cursor: An open MySQL cursor with `snapshot_user_groups` already staged.
+        prefixes (list): Only mappings for groups with these prefixes are considered.
+        group_names (list): If given, only mappings for these groups are considered
+            (used by incremental runs, where only changed groups were staged).
+        shard (tuple): (index, count); only mappings for groups in this shard are
+            considered (used by sharded runs, where only the shard's groups were staged).
+    """
+    if not prefixes or group_names == []:
+        return 0
+    prefix_clause = ' OR '.join('LOWER(g.group_name) LIKE %s' for _ in prefixes)
+    params = [like_prefix(p) for p in prefixes]
+    group_clause = ''
+    if group_names is not None:
+        group_clause = f"AND g.group_name IN ({', '.join(['%s'] * len(group_names))})"
+        params.extend(group_names)
+    cursor.execute(f'''
+        SELECT g.id, g.username, g.group_name
+        FROM user_groups g
+        LEFT JOIN snapshot_user_groups s
+            ON s.username = g.username AND s.group_name = g.group_name
+        WHERE s.username IS NULL AND ({prefix_clause}) {group_clause}
+        ORDER BY g.username, g.group_name
+    ''', params)
+    stale = cursor.fetchall()
+    if shard:
+        # Filtered here rather than with MySQL's CRC32, whose input depends on the
+        # column charset: the shard that prunes a group must be the one that staged it
+        stale = [row for row in stale if shard_of(row[2], shard[1]) == shard[0]]
+
+    for _, username, stale_group in stale:
+        if settings.dry_run:
+            log(f"    [DRY-RUN] Would remove group: {username} -> {stale_group}")
+        else:
+            log(f"    [-] Removed stale group: {username} -> {stale_group}")
+
+    if not settings.dry_run:
+        stale_ids = [row[0] for row in stale]
+        for i in range(0, len(stale_ids), settings.MYSQL_BATCH_SIZE):
+            chunk = stale_ids[i:i + settings.MYSQL_BATCH_SIZE]
+            cursor.execute(f"DELETE FROM user_groups WHERE id IN ({', '.join(['%s'] * len(chunk))})", chunk)
+    return len(stale)
+
+class FileSink:
+    """
+    Offline stand-in for an SMTP session: writes each message to EMAIL_SINK_DIR as an .eml file.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def send_message(self, msg, to_addrs):
+        path = os.path.join(self.directory, f"{uuid.uuid4().hex}.eml")
+        with open(path, 'w') as f:
+            f.write(f"X-Envelope-To: {', '.join(to_addrs)}\n")
+            f.write(msg.as_string())
+
+    def quit(self):
+        pass
+
+class SMTPPool:
+    """
+    A small pool of long-lived, authenticated SMTP sessions shared by the send workers.
+    Sessions are opened lazily and reused until they fail, at which point they are discarded.
+    """
+
+    def __init__(self, size):
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _open(self):
+        if settings.EMAIL_MODE == 'file':
+            return FileSink(settings.EMAIL_SINK_DIR)
+        if settings.EMAIL_MODE == 'localhost':
+            return smtplib.SMTP('localhost')
+        s = smtplib.SMTP(config['email']['smtp_server'], config.getint('email', 'smtp_port'))
+        s.ehlo()
+        try:
+            s.starttls()
+            s.ehlo()
+            smtp_user = config['email'].get('smtp_user', '').strip()
+            smtp_pass = config['email'].get('smtp_password', '').strip()
+            if smtp_user and smtp_pass:
+                s.login(smtp_user, smtp_pass)
+        except smtplib.SMTPNotSupportedError:
+            log("  [SMTP] TLS not supported, continuing without it.")
+        return s
+
+    def acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._open()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, session, broken=False):
+        if broken:
+            try:
+                session.quit()
+            except Exception:
+                pass
+        else:
+            self._idle.put(session)
+        self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                session = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                session.quit()
+            except Exception:
+                pass
+
+class TokenBucket:
+    """
+    Paces send attempts across all mail workers to `rate` per second on average,
+    allowing bursts of up to `burst`, so the relay sees a steady stream instead of
+    a burst it throttles and defers.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    break
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+        if waited:
+            metrics.observe('send_throttle_wait', waited)
+
+class DomainSlots:
+    """
+    Caps the sends in flight per recipient domain. A limit of 0 means no cap.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, address):
+        if not self.limit:
+            yield
+            return
+        domain = address.rpartition('@')[2].lower()
+        with self._lock:
+            slot = self._slots.get(domain)
+            if slot is None:
+                slot = self._slots[domain] = threading.BoundedSemaphore(self.limit)
+        with slot:
+            yield
+
+def deliver(msg, recipients):
+    """
+    Sends a prepared message over a pooled session, retrying with exponential backoff.
+    Every attempt is paced by the send rate limit and counts against the recipient
+    domain's concurrency limit while it is in flight.
+
+    Returns:
+        bool: True if the message was accepted by the relay.
+    """
+    error = None
+    for attempt in range(1, settings.EMAIL_MAX_RETRIES + 1):
+        if send_limiter:
+            send_limiter.acquire()
+        with domain_slots.hold(recipients[0]):
+            try:
+                session = smtp_pool.acquire()
+            except Exception as e:
+                error = e
             else:
-                cursor.execute('DELETE FROM user_groups WHERE username = %s AND group_name = %s', (username, stale_group))
-                log(f"    [-] Removed stale group: {username} -> {stale_group}")
+                started = time.perf_counter()
+                try:
+                    session.send_message(msg, to_addrs=recipients)
+                    smtp_pool.release(session)
+                    metrics.observe('smtp_send', time.perf_counter() - started)
+                    metrics.count('smtp_messages_sent')
+                    print(f"✔ Email sent to {msg['To']}")
+                    return True
+                except Exception as e:
+                    smtp_pool.release(session, broken=True)
+                    metrics.count('smtp_attempts_failed')
+                    error = e
+        if attempt < settings.EMAIL_MAX_RETRIES:
+            delay = settings.EMAIL_RETRY_BACKOFF * (2 ** (attempt - 1))
+            log(f"  [SMTP] Attempt {attempt} to {msg['To']} failed ({error}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+    metrics.count('smtp_messages_failed')
+    print(f"✘ Failed to send email to {msg['To']}: {error}")
+    return False
 
-    log(f"Finding users who haven't been audited in the last {MIN_DAYS} days...")
+def send_email(to, subject, plain_text, html_content):
+    msg, recipients = message_builder.build(to, subject, plain_text, html_content)
+    return deliver(msg, recipients)
+
+class MailDispatcher:
+    """
+    Bounded worker pool that sends messages in parallel over the shared SMTP pool.
+    """
+
+    def __init__(self, workers):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='mail')
+
+    def submit(self, to, subject, plain_text, html_content):
+        msg, recipients = message_builder.build(to, subject, plain_text, html_content)
+        return self._executor.submit(deliver, msg, recipients)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        smtp_pool.close()
+
+
+def audit_counts_for_date(cursor, audit_date):
+    """
+    Loads the number of audits already logged per manager for a date in one query.
+    """
     cursor.execute('''
-        SELECT u.username, u.email, u.manager_email
-        FROM users u
-        WHERE u.manager_email IS NOT NULL
-        AND (
-            u.last_audited IS NULL
-            OR DATEDIFF(CURDATE(), u.last_audited) >= %s
-        )
-        ORDER BY u.last_audited IS NOT NULL, u.last_audited ASC
-    ''', (MIN_DAYS,))
-    rows = cursor.fetchall()
+        SELECT manager_email, COUNT(*) FROM audit_log
+        WHERE audit_date = %s
+        GROUP BY manager_email
+    ''', (audit_date,))
+    return dict(cursor.fetchall())
 
-    if filter_user_email:
-        rows = [r for r in rows if r[1] and r[1].lower() == filter_user_email.lower()]
+def digest_counts_for_date(cursor, audit_date):
+    """
+    Loads the number of emails (digests) already queued per manager for a date in one query.
+    """
+    cursor.execute('''
+        SELECT manager_email, COUNT(*) FROM email_outbox
+        WHERE created_at >= %s AND created_at < %s + INTERVAL 1 DAY
+        GROUP BY manager_email
+    ''', (audit_date, audit_date))
+    return dict(cursor.fetchall())
 
-    if user_limit:
-        rows = rows[:user_limit]
+def render_audit_email(display_name, username, email, groups, review_link):
+    return mail_templates.render_audit_email(TEMPLATES, display_name, username, email, groups, review_link)
 
-    manager_batches = defaultdict(list)
-    for username, email, manager_email in rows:
-        if len(manager_batches[manager_email]) < 5:
-            manager_batches[manager_email].append((username, email))
+def render_digest_email(entries):
+    return mail_templates.render_digest_email(TEMPLATES, entries)
 
-    today = date.today()
-    for manager_email, users in manager_batches.items():
-        cursor.execute('SELECT COUNT(*) FROM audit_log WHERE manager_email = %s AND audit_date = %s', (manager_email, today))
-        count_today = cursor.fetchone()[0]
+def planned_user_groups(cursor, usernames, full_sync=True):
+    """
+    Returns username -> sorted prefixed groups for the users about to be emailed.
+
+    After a full sync, groups come from the in-memory membership map collected this
+    run. After an incremental sync that map only holds the groups that changed, so
+    every user's groups are loaded from `user_groups` instead, which the sync has
+    just brought up to date. Users not in the map are loaded the same way, in
+    batches rather than one query per user.
+    """
+    groups = {}
+    missing = []
+    for username in usernames:
+        if full_sync and username in run_state.user_current_groups:
+            groups[username] = sorted(g for g in run_state.user_current_groups[username] if matches_prefixes(g, settings.GROUP_PREFIXES))
+        else:
+            missing.append(username)
+
+    loaded = defaultdict(list)
+    for i in range(0, len(missing), settings.MYSQL_BATCH_SIZE):
+        chunk = missing[i:i + settings.MYSQL_BATCH_SIZE]
+        cursor.execute(f"SELECT username, group_name FROM user_groups WHERE username IN ({', '.join(['%s'] * len(chunk))})", chunk)
+        for username, group_name in cursor.fetchall():
+            if matches_prefixes(group_name, settings.GROUP_PREFIXES):
+                loaded[username].append(group_name)
+    for username in missing:
+        groups[username] = sorted(loaded.get(username, []))
+    return groups
+
+def queue_audit_emails(cursor, planned_messages, planned_audits, audit_date):
+    """
+    Writes planned emails to the outbox together with their audit_log rows, review
+    snapshots and last_audited updates, so they are committed as one unit before
+    anything is sent. The review snapshot keeps what the email listed (keyed by the
+    review secret), so the frontend reads one row per review and shows the same
+    groups even if user_groups changes before the manager responds.
+
+    Args:
+        cursor: An open MySQL cursor.
+        planned_messages (list): (secret, manager_email, recipient, subject, plain_text, html_content) tuples.
+        planned_audits (list): (username, manager_email, secret, display_name, email, groups, outbox_secret)
+            tuples, one per reviewed user. `outbox_secret` is the secret of the email carrying the
+            review (the digest's own secret in digest mode).
+        audit_date (date): The audit date to record.
+
+    Returns:
+        int: Number of audits queued.
+    """
+    if not planned_audits:
+        return 0
+    executemany_batched(cursor, '''
+        INSERT INTO email_outbox (secret, manager_email, recipient, subject, plain_text, html_content)
+        VALUES (%s, %s, %s, %s, %s, %s)
+    ''', planned_messages)
+    executemany_batched(cursor, '''
+        INSERT INTO audit_log (username, manager_email, audit_date, secret, outbox_secret) VALUES (%s, %s, %s, %s, %s)
+    ''', [
+        (username, manager_email, audit_date, secret, outbox_secret)
+        for username, manager_email, secret, *_, outbox_secret in planned_audits
+    ])
+    executemany_batched(cursor, '''
+        INSERT INTO audit_review_snapshot (secret, username, display_name, email, groups_json) VALUES (%s, %s, %s, %s, %s)
+    ''', [
+        (secret, username, display_name, email, json.dumps(groups))
+        for username, _, secret, display_name, email, groups, _ in planned_audits
+    ])
+    executemany_batched(cursor, 'UPDATE users SET last_audited = %s WHERE username = %s',
+                        [(audit_date, username) for username, *_ in planned_audits])
+    return len(planned_audits)
+
+def void_undelivered_audits(cursor, outbox_secret):
+    """
+    Undoes the audits carried by an email that failed permanently: their audit_log
+    and review snapshot rows are deleted and each user's last_audited goes back to
+    their latest remaining audit, so they are due again instead of being skipped
+    for MIN_DAYS with a review nobody was told about. Audits queued before
+    audit_log.outbox_secret existed are matched by their own secret.
+
+    Returns:
+        list: Usernames whose audits were undone.
+    """
+    cursor.execute('''
+        SELECT username, secret FROM audit_log
+        WHERE (outbox_secret = %s OR (outbox_secret IS NULL AND secret = %s)) AND date_reviewed IS NULL
+    ''', (outbox_secret, outbox_secret))
+    audits = cursor.fetchall()
+    if not audits:
+        return []
+    usernames = sorted({username for username, _ in audits})
+    secrets = [secret for _, secret in audits]
+    placeholders = ', '.join(['%s'] * len(secrets))
+    cursor.execute(f"DELETE FROM audit_review_snapshot WHERE secret IN ({placeholders})", secrets)
+    cursor.execute(f"DELETE FROM audit_log WHERE secret IN ({placeholders})", secrets)
+    cursor.execute(f'''
+        UPDATE users u
+        SET last_audited = (SELECT MAX(a.audit_date) FROM audit_log a WHERE a.username = u.username)
+        WHERE u.username IN ({', '.join(['%s'] * len(usernames))})
+    ''', usernames)
+    return usernames
+
+def projected_drain(messages):
+    """
+    Describes how long `messages` take to send at the configured send rate, for the logs.
+    """
+    if not settings.SEND_RATE:
+        return "time unknown (no [schedule] messages_per_second)"
+    return f"~{timedelta(seconds=round(messages / settings.SEND_RATE))} at {settings.SEND_RATE:g} msg/s"
+
+def drain_outbox(db, dispatcher=None, shard=None):
+    """
+    Sends pending outbox messages concurrently. Rows are claimed OUTBOX_CLAIM_SIZE
+    at a time (status 'sending', with an owner and an expiry) before anything is
+    sent, so drains that overlap (a cron --drain-outbox, the pipeline's send stage)
+    never send the same row. Each row is marked as soon as its send completes, so a
+    crash resends at most the messages that were in flight. Claims left behind by a
+    crashed drain can be taken over after OUTBOX_CLAIM_SECONDS. A failed send is
+    retried by a later drain, not this one: it waits OUTBOX_RETRY_BACKOFF seconds,
+    doubling per attempt, so a relay outage spends attempts slowly instead of
+    failing the whole outbox in one drain. Messages that keep failing are marked
+    'failed' after OUTBOX_MAX_ATTEMPTS tries; their audits are
+    undone (void_undelivered_audits) and one alert lists them. Rows go out in id
+    order, which is the order schedule_sends queued them in, paced by the
+    [schedule] limits in deliver().
+
+    Args:
+        db: An open MySQL connection.
+        dispatcher (MailDispatcher): Reused and left open when given (the pipeline
+            drains repeatedly); otherwise one is created and closed here.
+        shard (tuple): (index, count); only messages for managers in this shard are sent.
+
+    Returns:
+        int: Number of messages delivered.
+    """
+    with metrics.phase('send'):
+        return _drain_outbox(db, dispatcher, shard)
+
+def _drain_outbox(db, dispatcher, shard):
+    cursor = db.cursor()
+    owns_dispatcher = dispatcher is None
+    if owns_dispatcher:
+        dispatcher = MailDispatcher(settings.EMAIL_WORKERS)
+    delivered_total = 0
+    retried = 0
+    undone = []
+    claim_owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    # Pending rows due for an attempt, and rows whose claim expired with a crashed drain.
+    # Due as of the drain's start, so rows this drain fails are not retried by it.
+    claimable = '''status IN ('pending', 'sending') AND (
+        (status = 'pending' AND (next_attempt_at IS NULL OR next_attempt_at <= %s)) OR claimed_until < NOW()
+    )'''
+    shard_clause = 'AND MOD(CRC32(manager_email), %s) = %s' if shard else ''
+    try:
+        cursor.execute('SELECT NOW()')
+        started_at = cursor.fetchone()[0]
+        claim_params = (started_at, shard[1], shard[0]) if shard else (started_at,)
+        cursor.execute(f"SELECT COUNT(*) FROM email_outbox WHERE {claimable} {shard_clause}", claim_params)
+        pending = cursor.fetchone()[0]
+        if pending:
+            log(f"Outbox: {pending} pending message(s), projected drain {projected_drain(pending)}.")
+            metrics.peak('outbox_pending', pending)
+        while True:
+            cursor.execute(f'''
+                UPDATE email_outbox
+                SET status = 'sending', claimed_by = %s, claimed_until = NOW() + INTERVAL %s SECOND
+                WHERE {claimable} {shard_clause}
+                ORDER BY id
+                LIMIT %s
+            ''', (claim_owner, settings.OUTBOX_CLAIM_SECONDS, *claim_params, settings.OUTBOX_CLAIM_SIZE))
+            claimed = cursor.rowcount
+            db.commit()
+            if not claimed:
+                break
+            cursor.execute('''
+                SELECT id, recipient, subject, plain_text, html_content
+                FROM email_outbox
+                WHERE claimed_by = %s AND status = 'sending'
+                ORDER BY id
+            ''', (claim_owner,))
+            futures = {dispatcher.submit(row[1], row[2], row[3], row[4]): row[0] for row in cursor.fetchall()}
+
+            for future in as_completed(futures):
+                # Only while the claim is still ours: an expired claim may have been taken over
+                if future.result():
+                    cursor.execute('''
+                        UPDATE email_outbox
+                        SET status = 'sent', sent_at = NOW(), attempts = attempts + 1, claimed_by = NULL
+                        WHERE id = %s AND claimed_by = %s
+                    ''', (futures[future], claim_owner))
+                    delivered_total += 1
+                else:
+                    cursor.execute('''
+                        UPDATE email_outbox
+                        SET attempts = attempts + 1, status = IF(attempts >= %s, 'failed', 'pending'), claimed_by = NULL,
+                            next_attempt_at = NOW() + INTERVAL (%s * POW(2, attempts - 1)) SECOND
+                        WHERE id = %s AND claimed_by = %s
+                    ''', (settings.OUTBOX_MAX_ATTEMPTS, settings.OUTBOX_RETRY_BACKOFF, futures[future], claim_owner))
+                    retried += 1
+                    cursor.execute("SELECT secret, recipient, subject FROM email_outbox WHERE id = %s AND status = 'failed'",
+                                   (futures[future],))
+                    failed = cursor.fetchone()
+                    if failed:
+                        retried -= 1
+                        undone.append((failed[1], failed[2], void_undelivered_audits(cursor, failed[0])))
+                db.commit()
+        if retried:
+            log(f"[!] {retried} message(s) failed and will be retried by a later drain.")
+        if undone:
+            metrics.count('outbox_failed', len(undone))
+            report = '\n'.join(
+                f"{recipient}: {subject} (audits undone for: {', '.join(usernames) or 'none'})"
+                for recipient, subject, usernames in undone
+            ) + f"\n\nEach failed {settings.OUTBOX_MAX_ATTEMPTS} times. The users are due again and will be picked up by the next run."
+            # Logged as well: the alert goes through the relay that has just been failing
+            log(f"[!] {len(undone)} audit email(s) could not be delivered:\n{report}")
+            send_error_email(f"AD Audit: {len(undone)} audit email(s) could not be delivered", report)
+    finally:
+        if owns_dispatcher:
+            dispatcher.close()
+        cursor.close()
+    log(f"Outbox drained: {delivered_total} delivered.")
+    return delivered_total
+
+def send_error_email(subject, message):
+    recipients = [x.strip() for x in config['alerts']['error_recipients'].split(',')]
+    send_email(recipients, subject, message, message)
+
+def send_minor_error(subject, message):
+    if config['alerts'].get('notify_on_minor_errors', 'no').lower() == 'yes':
+        send_error_email(subject, message)
+
+def matches_prefixes(group_name, prefixes):
+    return any(group_name.lower().startswith(p.lower()) for p in prefixes)
+
+def group_label(username, group_name):
+    path = run_state.user_group_paths.get((username, group_name))
+    return f"{group_name} (via {' > '.join(path)})" if path else group_name
+
+def snapshot_scope():
+    # Nested expansion changes which members a group has, and the fast path is the
+    # expansion mode the members were collected with; the prefixes alone don't cover that
+    prefixes = ','.join(sorted(p.lower() for p in settings.GROUP_PREFIXES))
+    return f"{prefixes};nested={int(settings.EXPAND_NESTED)};fast_path={int(settings.EXPAND_NESTED and settings.NESTED_FAST_PATH)}"
 
-        if not send_all and count_today >= MAX_EMAILS_PER_MANAGER:
-            log(f"[SKIPPED] {manager_email} has already received {count_today} audit emails today (limit: {MAX_EMAILS_PER_MANAGER})")
+def write_snapshot(group_members, members_by_dn):
+    """
+    Persists the collected directory view (people, group members and resolved
+    manager emails) to SNAPSHOT_PATH so read-only modes can answer without AD.
+    The file is written to a temporary path and swapped in atomically.
+    """
+    tmp_path = f"{settings.SNAPSHOT_PATH}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    snap = sqlite3.connect(tmp_path)
+    os.chmod(tmp_path, 0o600)
+    try:
+        snap.executescript('''
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE people (dn TEXT PRIMARY KEY, username TEXT, email TEXT, manager_dn TEXT, full_name TEXT);
+            CREATE TABLE group_members (group_name TEXT, dn TEXT);
+            CREATE TABLE managers (dn TEXT PRIMARY KEY, email TEXT);
+            CREATE INDEX idx_people_email ON people (email COLLATE NOCASE);
+            CREATE INDEX idx_group_members_dn ON group_members (dn);
+        ''')
+        snap.executemany('INSERT INTO meta VALUES (?, ?)', [('created_at', str(time.time())), ('scope', snapshot_scope())])
+        snap.executemany('INSERT INTO people VALUES (?, ?, ?, ?, ?)', [
+            (dn, m['username'], m['email'], m['manager_dn'], m['full_name'])
+            for dn, m in members_by_dn.items() if is_person(m)
+        ])
+        snap.executemany('INSERT INTO group_members VALUES (?, ?)', [
+            (group_name, member_dn.lower()) for group_name, members in group_members for member_dn in members
+        ])
+        snap.executemany('INSERT INTO managers VALUES (?, ?)', list(manager_cache.emails.items()))
+        snap.commit()
+    finally:
+        snap.close()
+    os.replace(tmp_path, settings.SNAPSHOT_PATH)
+    log(f"Directory snapshot written to {settings.SNAPSHOT_PATH}.")
+
+def snapshot_unreadable(error, counted_hit=False):
+    """
+    Records a corrupt, truncated or foreign snapshot file as a miss, so the caller
+    falls back to a live query. The next full import overwrites the file.
+    """
+    log(f"[!] Snapshot {settings.SNAPSHOT_PATH} is unreadable ({error}); querying the directory instead.")
+    if counted_hit:
+        metrics.count('snapshot_hits', -1)
+    metrics.count('snapshot_misses')
+
+def open_snapshot():
+    """
+    Opens the on-disk snapshot if it exists, is within SNAPSHOT_TTL_MINUTES and
+    was collected with the current group prefixes and nesting settings. Returns
+    None otherwise, including when the file is not a readable snapshot.
+    """
+    if not os.path.exists(settings.SNAPSHOT_PATH):
+        metrics.count('snapshot_misses')
+        return None
+    snap = sqlite3.connect(settings.SNAPSHOT_PATH)
+    try:
+        meta = dict(snap.execute('SELECT key, value FROM meta'))
+    except sqlite3.DatabaseError as e:
+        snap.close()
+        snapshot_unreadable(e)
+        return None
+    age_minutes = (time.time() - float(meta.get('created_at', 0))) / 60
+    if age_minutes > settings.SNAPSHOT_TTL_MINUTES or meta.get('scope') != snapshot_scope():
+        snap.close()
+        metrics.count('snapshot_misses')
+        return None
+    metrics.count('snapshot_hits')
+    log(f"Using directory snapshot {settings.SNAPSHOT_PATH} ({age_minutes:.0f} minutes old, --live to bypass)")
+    return snap
+
+def load_snapshot(snap):
+    """
+    Rebuilds (group_members, members_by_dn) from the snapshot and primes the manager cache.
+    """
+    members_by_dn = {}
+    for dn, username, email, manager_dn, full_name in snap.execute('SELECT dn, username, email, manager_dn, full_name FROM people'):
+        members_by_dn[dn] = {
+            'dn': dn, 'object_classes': ['person'], 'username': username,
+            'email': email, 'manager_dn': manager_dn, 'full_name': full_name,
+        }
+    group_members = defaultdict(list)
+    for group_name, dn in snap.execute('SELECT group_name, dn FROM group_members ORDER BY rowid'):
+        group_members[group_name].append(dn)
+    manager_cache.emails.update(dict(snap.execute('SELECT dn, email FROM managers')))
+    return list(group_members.items()), members_by_dn
+
+def directory_view():
+    """
+    Returns (group_members, members_by_dn, conn) for read-only modes, answering from
+    the snapshot when it is fresh and falling back to a live collection otherwise.
+    conn is None when the snapshot was used.
+    """
+    snap = None if settings.live_refresh else open_snapshot()
+    if snap:
+        try:
+            group_members, members_by_dn = load_snapshot(snap)
+            return group_members, members_by_dn, None
+        except sqlite3.DatabaseError as e:
+            snapshot_unreadable(e, counted_hit=True)
+        finally:
+            snap.close()
+
+    conn = ldap_pool()
+    group_members, members_by_dn = collect_memberships(conn, settings.BASE_DN, settings.GROUP_PREFIXES)
+    manager_cache.prime(conn, {
+        m['manager_dn'] for m in members_by_dn.values() if is_person(m) and m['manager_dn']
+    })
+    write_snapshot(group_members, members_by_dn)
+    return group_members, members_by_dn, conn
+
+def people_in_groups(group_members, members_by_dn, prefixes):
+    """
+    Returns the distinct person records that belong to groups matching the prefixes.
+    """
+    people = {}
+    for group_name, members in group_members:
+        if not matches_prefixes(group_name, prefixes):
             continue
+        for member_dn in members:
+            member = members_by_dn.get(member_dn.lower())
+            if member and is_person(member):
+                people[member_dn.lower()] = member
+    return list(people.values())
+
+def lookup_user_groups(email):
+    """
+    Finds the prefixed groups of a single user by email, without scanning any group.
+
+    Uses the snapshot's indexed email lookup when it is fresh; otherwise searches
+    for the user on `mail`, reads `memberOf` and resolves just those group CNs.
+    With EXPAND_NESTED, groups inherited through nesting are included too, as in
+    the snapshot: server-side with LDAP_MATCHING_RULE_IN_CHAIN when available,
+    otherwise by following each group's own `memberOf` upwards.
+
+    Returns:
+        tuple: (set of group names, LDAP connection or None if the snapshot was used)
+    """
+    snap = None if settings.live_refresh else open_snapshot()
+    if snap:
+        try:
+            rows = snap.execute('''
+                SELECT gm.group_name FROM people p
+                JOIN group_members gm ON gm.dn = p.dn
+                WHERE p.email = ? COLLATE NOCASE
+            ''', (email,)).fetchall()
+            return {row[0] for row in rows if matches_prefixes(row[0], settings.GROUP_PREFIXES)}, None
+        except sqlite3.DatabaseError as e:
+            snapshot_unreadable(e, counted_hit=True)
+        finally:
+            snap.close()
+
+    conn = ldap_connection()
+    user_dns = []
+    group_dns = []
+    user_filter = f'(&(objectCategory=person)(mail={escape_filter_chars(email)}))'
+    for dn, attributes in paged_search(conn, settings.BASE_DN, user_filter, ['sAMAccountName', 'memberOf']):
+        user_dns.append(dn)
+        group_dns.extend(str(group_dn) for group_dn in attributes.get('memberOf', []))
+
+    names = []
+    if settings.EXPAND_NESTED and settings.NESTED_FAST_PATH and server_supports_in_chain(conn):
+        for user_dn in user_dns:
+            chain_filter = f'(&(objectClass=group)(member:1.2.840.113556.1.4.1941:={escape_filter_chars(user_dn)}))'
+            names.extend(_attr_value(attributes, 'cn') for _, attributes in paged_search(conn, settings.BASE_DN, chain_filter, ['cn']))
+    else:
+        seen = set()
+        while group_dns:
+            pending = {dn.lower(): dn for dn in group_dns if dn.lower() not in seen}
+            seen.update(pending)
+            group_dns = []
+            for attributes in resolve_dns(conn, pending.values(), ['cn', 'memberOf']).values():
+                names.append(_attr_value(attributes, 'cn'))
+                if settings.EXPAND_NESTED:
+                    group_dns.extend(str(group_dn) for group_dn in attributes.get('memberOf', []))
+    return {name for name in names if name and matches_prefixes(name, settings.GROUP_PREFIXES)}, conn
+
+def list_managers_only():
+    group_members, members_by_dn, conn = directory_view()
+    for prefix in settings.GROUP_PREFIXES:
+        people = people_in_groups(group_members, members_by_dn, [prefix])
+        unique_managers = {manager_cache.get(conn, p['manager_dn']) for p in people if p['manager_dn']}
+        unique_managers.discard(None)
+
+        print("\n=== Unique Manager Emails ===")
+        for email in sorted(unique_managers):
+            print(email)
+    log(f"Manager cache: {manager_cache.summary()}")
+    if conn:
+        conn.unbind()
+
+def list_manager_user_counts():
+    group_members, members_by_dn, conn = directory_view()
+    for prefix in settings.GROUP_PREFIXES:
+        people = [p for p in people_in_groups(group_members, members_by_dn, [prefix]) if p['manager_dn'] and p['username']]
+
+        manager_user_counts = defaultdict(set)
+        for person in people:
+            email = manager_cache.get(conn, person['manager_dn'])
+            if email:
+                manager_user_counts[email].add(person['username'])
+
+        print("\n=== Manager Emails and Managed Users Count ===")
+        for email, users in sorted(manager_user_counts.items()):
+            print(f"{email:<40} | {len(users)} users")
+    log(f"Manager cache: {manager_cache.summary()}")
+    if conn:
+        conn.unbind()
 
-        for username, email in users:
-            display_name = user_display_names.get(username, username)
-            cursor.execute('SELECT group_name FROM user_groups WHERE username = %s', (username,))
-            all_groups = [row[0] for row in cursor.fetchall()]
-            groups = [g for g in all_groups if any(g.lower().startswith(p.lower()) for p in GROUP_PREFIXES)]
-            group_list = ''.join(f"<li>{g}</li>" for g in groups)
-            plain_groups = '\n'.join(groups)
+def import_memberships(conn, group_members, members_by_dn, user_display_names, snapshot_users):
+    """
+    Turns collected (group, member DNs) pairs into user rows, recording each user's
+    display name, (email, manager email) and current groups.
 
+    Args:
+        conn: LDAP connection or pool, used for manager lookups the cache cannot answer.
+        group_members (list): (group name, member DNs) pairs.
+        members_by_dn (dict): Lowercased DN -> user record.
+        user_display_names (dict): Filled with username -> full name.
+        snapshot_users (dict): Filled with username -> (email, manager_email, display_name).
+    """
+    for group_name, members in group_members:
+        log(f"\n[Group] {group_name}")
+
+        for member_dn in members:
+            user = members_by_dn.get(member_dn.lower())
+            if not user:
+                log(f"    [-] Failed to fetch entry at: {member_dn}")
+                continue
+
+            object_classes = user['object_classes']
+            if not is_person(user):
+                log(f"    [-] Skipping non-user entry: {member_dn} (objectClass: {object_classes})")
+                continue
+            log(f"  [User DN] {member_dn}")
+            if not user['username']:
+                log(f"    [-] Failed to fetch user at: {member_dn}")
+                continue
+
+            username = user['username']
+            email = user['email']
+            full_name = user['full_name']
+            user_display_names[username] = full_name
+
+            manager_dn = user['manager_dn']
+            manager_email = None
+
+            log(f"    [+] Found user: {full_name} ({email}, {username})")
+            run_state.user_count += 1
+
+            nested_path = run_state.membership_paths.get((member_dn.lower(), group_name))
+            if nested_path:
+                log(f"    [Nested] via {' > '.join(nested_path)}")
+                run_state.user_group_paths[(username, group_name)] = nested_path
+
+            if manager_dn:
+                log(f"    [Manager DN] {manager_dn}")
+                manager_email = manager_cache.get(conn, manager_dn)
+                if manager_email:
+                    log(f"    [+] Manager Email: {manager_email}")
+            else:
+                log("    [!] Manager DN is missing or invalid.")
+
+            snapshot_users[username] = (email, manager_email, full_name)
+            run_state.group_memberships += 1
+
+            run_state.user_current_groups[username].add(group_name)
+
+def plan_audit_emails(cursor, user_display_names, today, shard=None, full_sync=True):
+    """
+    Selects the users due for review, applies the per-manager batch size and daily
+    limit, and renders their emails in the order schedule_sends picks. With `shard`
+    as (index, count), only managers in that shard are planned, so each manager's
+    daily limit is applied by one worker. `full_sync` is False after an incremental
+    sync (see planned_user_groups).
+
+    Yields:
+        tuple: (planned_messages, planned_audits) chunks in the shape
+        queue_audit_emails expects, roughly MYSQL_BATCH_SIZE audits at a time.
+    """
+    log(f"Finding users who haven't been audited in the last {settings.MIN_DAYS} days...")
+    shard_clause = 'AND MOD(CRC32(u.manager_email), %s) = %s' if shard else ''
+    cursor.execute(DUE_USERS_SQL.format(shard_clause=shard_clause),
+                   (settings.MIN_DAYS, shard[1], shard[0]) if shard else (settings.MIN_DAYS,))
+    rows = cursor.fetchall()
+
+    if settings.filter_user_email:
+        rows = [r for r in rows if r[1] and r[1].lower() == settings.filter_user_email.lower()]
+
+    if settings.user_limit:
+        rows = rows[:settings.user_limit]
+
+    batch_size = settings.AUDIT_DIGEST_BATCH_SIZE if settings.DIGEST_MODE else settings.AUDIT_BATCH_SIZE
+    manager_batches = defaultdict(list)
+    for username, email, manager_email, display_name in rows:
+        if not batch_size or len(manager_batches[manager_email]) < batch_size:
+            manager_batches[manager_email].append((username, email, display_name))
+
+    counts_today = digest_counts_for_date(cursor, today) if settings.DIGEST_MODE else audit_counts_for_date(cursor, today)
+    for manager_email, users in list(manager_batches.items()):
+        count_today = counts_today.get(manager_email, 0)
+        if settings.send_all:
+            continue
+        if count_today >= settings.MAX_EMAILS_PER_MANAGER:
+            log(f"[SKIPPED] {manager_email} has already received {count_today} audit emails today (limit: {settings.MAX_EMAILS_PER_MANAGER})")
+            del manager_batches[manager_email]
+        elif not settings.DIGEST_MODE and count_today + len(users) > settings.MAX_EMAILS_PER_MANAGER:
+            # The rest stay due and are picked up by a later run
+            manager_batches[manager_email] = users[:settings.MAX_EMAILS_PER_MANAGER - count_today]
+            log(f"[LIMITED] {manager_email}: {len(manager_batches[manager_email])} of {len(users)} audits fit under today's limit ({settings.MAX_EMAILS_PER_MANAGER})")
+
+    planned_messages = []
+    planned_audits = []
+    sends = schedule_sends(manager_batches, {username: rank for rank, (username, *_) in enumerate(rows)})
+    groups_for_email = planned_user_groups(cursor, [username for _, users in sends for username, *_ in users], full_sync)
+    for manager_email, users in sends:
+        recipient = settings.override_recipient if settings.override_recipient else manager_email
+        entries = []
+        digest_secret = uuid.uuid4().hex if settings.DIGEST_MODE else None
+        for username, email, stored_name in users:
+            display_name = user_display_names.get(username) or stored_name or username
+            groups = [group_label(username, g) for g in groups_for_email.get(username, [])]
             secret = uuid.uuid4().hex
-            review_link = f"{REVIEW_URL}{secret}"
-
-            subject = f"Access Review: {display_name}"
-            plain_text = f"""Access Review Required for {display_name} ({username})
-
-Email: {email}
-Groups:
-{plain_groups}
-
-Please confirm if this access is still valid:
-{review_link}
-
-This is an automated message generated by the TechOps Team."""
-
-            html_content = f"""
-            <html>
-            <body>
-                <p><strong>Access Review Required for {display_name} ({username})</strong></p>
-                <p><strong>Email:</strong> {email}</p>
-                <p><strong>Groups:</strong></p>
-                <ul>{group_list}</ul>
-                <p>
-                    <a href="{review_link}" style="background-color:#1a73e8;color:#fff;padding:10px 20px;
-                    text-decoration:none;border-radius:4px;">Review Access</a>
-                </p>
-                <p style="font-size: small; color: #777;">This is an automated message generated by the TechOps Team.</p>
-            </body>
-            </html>
-            """
-
-            if dry_run:
-                dry_run_emails.append((manager_email, username))
+            entries.append((display_name, username, email, groups, f"{settings.REVIEW_URL}{secret}"))
+
+            if settings.dry_run:
+                run_state.dry_run_emails.append((manager_email, username))
                 log(f"[DRY-RUN] Would send audit email to {manager_email} for user {username} ({display_name})")
-                emails_skipped += 1
-            elif update_only:
+                run_state.emails_skipped += 1
+            elif settings.update_only:
                 log(f"[SKIPPED] Email to {manager_email} for {username} skipped due to --update-only")
-                emails_skipped += 1
+                run_state.emails_skipped += 1
             else:
-                recipient = override_recipient if override_recipient else manager_email
-                send_email(recipient, subject, plain_text, html_content)
-                emails_sent += 1
-                cursor.execute('UPDATE users SET last_audited = %s WHERE username = %s', (date.today(), username))
-                cursor.execute('INSERT INTO audit_log (username, manager_email, audit_date, secret) VALUES (%s, %s, %s, %s)',
-                            (username, manager_email, date.today(), secret))
-                audits_logged += 1
+                planned_audits.append((username, manager_email, secret, display_name, email,
+                                       groups_for_email.get(username, []), digest_secret or secret))
+                if not settings.DIGEST_MODE:
+                    subject, plain_text, html_content = render_audit_email(*entries[-1])
+                    planned_messages.append((secret, manager_email, recipient, subject, plain_text, html_content))
 
-            manager_email_counts[manager_email] += 1
+            run_state.manager_email_counts[manager_email] += 1
 
+        if settings.DIGEST_MODE and entries and not settings.dry_run and not settings.update_only:
+            subject, plain_text, html_content = render_digest_email(entries)
+            planned_messages.append((digest_secret, manager_email, recipient, subject, plain_text, html_content))
 
-    if dry_run:
-        db.rollback()
-        log("[DRY-RUN] Skipping commit — all changes rolled back.")
+        if len(planned_audits) >= settings.MYSQL_BATCH_SIZE:
+            yield planned_messages, planned_audits
+            planned_messages = []
+            planned_audits = []
+
+    yield planned_messages, planned_audits
+
+def schedule_sends(manager_batches, due_rank):
+    """
+    Picks this run's emails and the order they are queued (and so sent) in.
+
+    The most overdue users go first: never audited, then oldest `last_audited`. Past
+    SEND_RUN_BUDGET emails the rest are deferred; their users stay due, so they head
+    the next run's due list. The picked emails are then interleaved round-robin
+    across managers, so one manager's batch does not hold up everyone else's. A
+    digest is one email, ranked by its most overdue user.
+
+    Args:
+        manager_batches (dict): manager email -> [(username, email, display_name)], in due order.
+        due_rank (dict): username -> position in the due list.
+
+    Returns:
+        list: (manager_email, users) tuples, one per email.
+    """
+    if settings.DIGEST_MODE:
+        sends = list(manager_batches.items())
     else:
-        db.commit()
+        sends = sorted(
+            ((manager_email, [user]) for manager_email, users in manager_batches.items() for user in users),
+            key=lambda send: due_rank[send[1][0][0]],
+        )
+    if settings.SEND_RUN_BUDGET and len(sends) > settings.SEND_RUN_BUDGET:
+        deferred = len(sends) - settings.SEND_RUN_BUDGET
+        run_state.emails_deferred += deferred
+        log(f"[DEFERRED] {deferred} audit emails exceed this run's budget of {settings.SEND_RUN_BUDGET}; "
+            f"at this budget they need {-(-deferred // settings.SEND_RUN_BUDGET)} more run(s).")
+        sends = sends[:settings.SEND_RUN_BUDGET]
+    turns = defaultdict(list)
+    for send in sends:
+        turns[send[0]].append(send)
+    return [send for round_sends in zip_longest(*turns.values()) for send in round_sends if send]
+
+def prime_managers(conn, members_by_dn):
+    manager_dns = {
+        member['manager_dn'] for member in members_by_dn.values()
+        if is_person(member) and member['manager_dn']
+    }
+    log(f"Resolving {len(manager_dns)} distinct manager DNs...")
+    with metrics.phase('manager_resolution'):
+        manager_cache.prime(conn, manager_dns)
+
+def run_sequential(conn, db, cursor, since_usn, current_usn, current_dc):
+    """
+    Runs collection, database sync and email planning one after another in a single
+    transaction; the caller commits (or rolls back) and drains the outbox.
+    """
+    if since_usn is not None:
+        group_members, members_by_dn = collect_memberships(conn, settings.BASE_DN, settings.GROUP_PREFIXES, f'(uSNChanged>={since_usn + 1})')
+    else:
+        group_members, members_by_dn = collect_memberships(conn, settings.BASE_DN, settings.GROUP_PREFIXES)
+    run_state.group_count = len(group_members)
+
+    user_display_names = {}
+    snapshot_users = {}
+    prime_managers(conn, members_by_dn)
+    import_memberships(conn, group_members, members_by_dn, user_display_names, snapshot_users)
+
+    if since_usn is None:
+        with metrics.phase('snapshot_write'):
+            write_snapshot(group_members, members_by_dn)
+
+    log("Syncing LDAP snapshot to the database...")
+    with metrics.phase('db_sync'):
+        sync_snapshot(cursor, snapshot_users, run_state.user_current_groups)
+        if since_usn is not None:
+            refresh_changed_users(conn, cursor, settings.BASE_DN, since_usn)
+
+    log("\n[✓] User and group import completed.\n")
+
+    log("\n[✓] Checking for stale group mappings...")
+    with metrics.phase('stale_prune'):
+        if since_usn is not None:
+            prune_stale_groups(cursor, settings.GROUP_PREFIXES, [group_name for group_name, _ in group_members])
+        else:
+            prune_stale_groups(cursor, settings.GROUP_PREFIXES)
+
+    if current_usn is not None and not settings.dry_run:
+        save_usn_watermark(cursor, current_usn, current_dc)
+
+    today = date.today()
+    with metrics.phase('planning'):
+        for planned_messages, planned_audits in plan_audit_emails(cursor, user_display_names, today, full_sync=since_usn is None):
+            run_state.audits_logged += queue_audit_emails(cursor, planned_messages, planned_audits, today)
+
+def shard_of(key, count):
+    """
+    Shard index of a group name or manager email. Matches MySQL's MOD(CRC32(key), count)
+    for ASCII keys only; group names can be non-ASCII, so group shards are always
+    computed here.
+    """
+    return zlib.crc32((key or '').encode('utf-8')) % count
+
+class LeaseLost(Exception):
+    pass
+
+class ShardLeases:
+    """
+    Hands out the shards of a sharded run to cooperating workers through the
+    audit_leases table: one row per (run, phase, shard). A worker claims a shard by
+    taking a row that is unowned or whose lease has expired, keeps it alive with a
+    heartbeat while it works, and marks it complete in the same transaction as the
+    shard's work, so a worker that lost its lease to another cannot commit.
+
+    Claims and heartbeats use a separate autocommit connection, so they are visible
+    to other workers immediately and are not rolled back with a failed shard.
+    """
+
+    PHASES = ('sync', 'email')
+
+    def __init__(self, run_id, shard_count, lease_seconds):
+        self.run_id = run_id
+        self.shard_count = shard_count
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._db = mysql_connection()
+        self._db.autocommit = True
+        self._cursor = self._db.cursor()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._renew, name='lease-heartbeat', daemon=True)
+
+    def start(self):
+        """
+        Creates the run's lease rows (first worker wins) and starts the heartbeat.
+        """
+        rows = [(self.run_id, phase, shard, self.shard_count) for phase in self.PHASES for shard in range(self.shard_count)]
+        with self._lock:
+            self._cursor.executemany(
+                'INSERT IGNORE INTO audit_leases (run_id, phase, shard, shard_count) VALUES (%s, %s, %s, %s)', rows)
+            self._cursor.execute('SELECT DISTINCT shard_count FROM audit_leases WHERE run_id = %s', (self.run_id,))
+            counts = [row[0] for row in self._cursor.fetchall()]
+        if counts != [self.shard_count]:
+            raise Exception(f"Run {self.run_id} was started with {counts} shard(s), not {self.shard_count}. Use another --run-id.")
+        log(f"Sharded run {self.run_id}: {self.shard_count} shards, worker {self.owner}.")
+        self._heartbeat.start()
+
+    def claim(self, phase):
+        """
+        Returns the index of a shard of `phase` now leased to this worker, or None if
+        every remaining shard is held by a live worker.
+        """
+        with self._lock:
+            self._cursor.execute('''
+                SELECT shard, owner FROM audit_leases
+                WHERE run_id = %s AND phase = %s AND completed_at IS NULL
+                AND (owner IS NULL OR expires_at < NOW())
+                ORDER BY shard
+            ''', (self.run_id, phase))
+            candidates = self._cursor.fetchall()
+            for shard, previous_owner in candidates:
+                # claims changes on every claim, so rowcount tells whether this worker won the row
+                self._cursor.execute('''
+                    UPDATE audit_leases SET owner = %s, expires_at = NOW() + INTERVAL %s SECOND, claims = claims + 1
+                    WHERE run_id = %s AND phase = %s AND shard = %s AND completed_at IS NULL
+                    AND (owner IS NULL OR expires_at < NOW())
+                ''', (self.owner, self.lease_seconds, self.run_id, phase, shard))
+                if self._cursor.rowcount == 1:
+                    if previous_owner:
+                        log(f"Took over expired {phase} shard {shard} from {previous_owner}.")
+                    return shard
+        return None
+
+    def pending(self, phase):
+        """
+        Number of shards of `phase` not yet completed by any worker.
+        """
+        with self._lock:
+            self._cursor.execute(
+                'SELECT COUNT(*) FROM audit_leases WHERE run_id = %s AND phase = %s AND completed_at IS NULL',
+                (self.run_id, phase))
+            return self._cursor.fetchone()[0]
+
+    def fence(self, cursor, phase, shard):
+        """
+        Locks the shard's lease row inside the caller's transaction and checks that this
+        worker still holds it; raises LeaseLost otherwise. The row stays locked until the
+        caller commits, so the lease cannot be taken over between the check and the commit.
+        """
+        cursor.execute('''
+            SELECT owner, completed_at IS NULL AND expires_at > NOW() FROM audit_leases
+            WHERE run_id = %s AND phase = %s AND shard = %s FOR UPDATE
+        ''', (self.run_id, phase, shard))
+        row = cursor.fetchone()
+        if not row or row[0] != self.owner or not row[1]:
+            raise LeaseLost(f"Lost the lease on {phase} shard {shard}")
+
+    def complete(self, cursor, phase, shard):
+        """
+        Marks the shard done as part of the caller's transaction, after fencing it.
+        """
+        self.fence(cursor, phase, shard)
+        cursor.execute('''
+            UPDATE audit_leases SET completed_at = NOW()
+            WHERE run_id = %s AND phase = %s AND shard = %s
+        ''', (self.run_id, phase, shard))
+
+    def release(self, phase, shard):
+        """
+        Gives an unfinished shard back so another worker can claim it without waiting for expiry.
+        """
+        with self._lock:
+            self._cursor.execute('''
+                UPDATE audit_leases SET owner = NULL, expires_at = NULL
+                WHERE run_id = %s AND phase = %s AND shard = %s AND owner = %s AND completed_at IS NULL
+            ''', (self.run_id, phase, shard, self.owner))
+
+    def _renew(self):
+        while not self._stop.wait(max(1, self.lease_seconds / 3)):
+            try:
+                with self._lock:
+                    self._cursor.execute('''
+                        UPDATE audit_leases SET expires_at = NOW() + INTERVAL %s SECOND
+                        WHERE run_id = %s AND owner = %s AND completed_at IS NULL
+                    ''', (self.lease_seconds, self.run_id, self.owner))
+            except Exception as e:
+                log(f"[!] Lease heartbeat failed: {e}")
+
+    def close(self):
+        self._stop.set()
+        if self._heartbeat.is_alive():
+            self._heartbeat.join()
+        self._cursor.close()
+        self._db.close()
+
+def sync_shard(conn, db, cursor, leases, shard):
+    """
+    Collects, imports and prunes the groups in one shard, then commits the shard's
+    changes together with its lease completion.
+    """
+    run_state.group_shard = (shard, settings.SHARD_COUNT)
+    try:
+        group_members, members_by_dn = collect_memberships(conn, settings.BASE_DN, settings.GROUP_PREFIXES)
+    finally:
+        run_state.group_shard = None
+    run_state.group_count += len(group_members)
+
+    snapshot_users = {}
+    prime_managers(conn, members_by_dn)
+    import_memberships(conn, group_members, members_by_dn, {}, snapshot_users)
+    with metrics.phase('db_sync'):
+        sync_snapshot(cursor, snapshot_users, run_state.user_current_groups)
+    with metrics.phase('stale_prune'):
+        prune_stale_groups(cursor, settings.GROUP_PREFIXES, shard=(shard, settings.SHARD_COUNT))
+    leases.complete(cursor, 'sync', shard)
+    db.commit()
+
+def email_shard(db, cursor, leases, shard):
+    """
+    Plans and queues the audit emails of the managers in one shard and sends them.
+    The shard is marked complete only after its outbox has been drained, so a
+    worker that dies mid-send leaves the shard for another worker to finish.
+    """
+    today = date.today()
+    queued = 0
+    with metrics.phase('planning'):
+        for planned_messages, planned_audits in plan_audit_emails(cursor, {}, today, (shard, settings.SHARD_COUNT)):
+            queued += queue_audit_emails(cursor, planned_messages, planned_audits, today)
+    leases.fence(cursor, 'email', shard)
+    db.commit()
+    run_state.audits_logged += queued
+    if not settings.update_only:
+        run_state.emails_sent += drain_outbox(db, shard=(shard, settings.SHARD_COUNT))
+    leases.complete(cursor, 'email', shard)
+    db.commit()
+
+# ER_LOCK_WAIT_TIMEOUT, ER_LOCK_DEADLOCK
+MYSQL_RETRYABLE_ERRORS = (1205, 1213)
+
+def run_sharded(conn, db, cursor):
+    """
+    Works through a sharded run alongside any other workers with the same run ID.
+
+    Sync shards split the prefixed groups by CRC32(group name); email shards split the
+    users due for review by CRC32(manager email), so each manager's daily limit is
+    applied by exactly one worker. Email shards are only handed out once every sync
+    shard is complete, because selecting who is due needs the whole users table.
+    While the remaining shards are leased to other workers this worker waits, so it
+    can take over any whose lease expires because its worker died.
+    """
+    leases = ShardLeases(settings.SHARD_RUN_ID, settings.SHARD_COUNT, settings.SHARD_LEASE_SECONDS)
+    try:
+        leases.start()
+        for phase in ShardLeases.PHASES:
+            while True:
+                shard = leases.claim(phase)
+                if shard is None:
+                    remaining = leases.pending(phase)
+                    if not remaining:
+                        break
+                    log(f"Waiting for {remaining} {phase} shard(s) leased to other workers...")
+                    time.sleep(settings.SHARD_POLL_SECONDS)
+                    continue
+                log(f"Claimed {phase} shard {shard + 1}/{settings.SHARD_COUNT}.")
+                # Per shard: planning must read other shards' memberships from user_groups
+                run_state.user_current_groups.clear()
+                try:
+                    if phase == 'sync':
+                        sync_shard(conn, db, cursor, leases, shard)
+                    else:
+                        email_shard(db, cursor, leases, shard)
+                except LeaseLost as e:
+                    db.rollback()
+                    log(f"[!] {e}; another worker has taken it over.")
+                except Exception as e:
+                    db.rollback()
+                    leases.release(phase, shard)
+                    # Workers upsert overlapping users, so InnoDB may pick one as a deadlock victim
+                    if getattr(e, 'errno', None) not in MYSQL_RETRYABLE_ERRORS:
+                        raise
+                    log(f"[!] {phase} shard {shard} hit a lock conflict ({e}); it will be retried.")
+        log(f"Sharded run {settings.SHARD_RUN_ID} complete.")
+    finally:
+        leases.close()
+
+def write_metrics(status='success'):
+    """
+    Writes the run metrics report when --metrics-json / --metrics-prom (or [metrics]) ask for it.
+    """
+    if not settings.METRICS_JSON_PATH and not settings.METRICS_PROM_PATH:
+        return
+    metrics.counters.update({
+        'groups_matched': run_state.group_count,
+        'users_processed': run_state.user_count,
+        'group_mappings': run_state.group_memberships,
+        'managers_contacted': len(run_state.manager_email_counts),
+        'audits_queued': run_state.audits_logged,
+        'emails_sent': run_state.emails_sent,
+        'emails_deferred': run_state.emails_deferred,
+    })
+    if settings.SEND_RATE and metrics.counters.get('outbox_pending'):
+        metrics.counters['projected_drain_seconds'] = round(metrics.counters['outbox_pending'] / settings.SEND_RATE)
+    caches = {
+        'manager_email': (manager_cache.hits, manager_cache.misses),
+        'snapshot': (metrics.counters.get('snapshot_hits', 0), metrics.counters.get('snapshot_misses', 0)),
+    }
+    metrics.write(status, caches, settings.METRICS_JSON_PATH, settings.METRICS_PROM_PATH)
+
+async def run_pipeline(conn, db, since_usn, current_usn, current_dc):
+    """
+    Runs a full audit as three concurrent stages joined by bounded queues:
+
+      collect: streams membership batches out of LDAP, resolving each batch's managers;
+      store:   upserts each batch as it arrives, then prunes, plans and queues the
+               audit emails, committing every chunk of queued emails;
+      send:    drains the outbox whenever a chunk is committed, starting with
+               anything left pending by an earlier run.
+
+    Selecting who is due waits for the sync to finish, because the per-manager
+    batches and daily limits need the whole users table. Blocking LDAP, MySQL and
+    SMTP calls run on one executor thread per stage, and a full queue pauses the
+    stage feeding it. The send stage uses its own autocommit MySQL connection.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    ldap_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pipeline-ldap')
+    db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pipeline-db')
+    mail_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pipeline-mail')
+    collected = asyncio.Queue(maxsize=settings.PIPELINE_QUEUE_SIZE)
+    committed = asyncio.Queue(maxsize=settings.PIPELINE_QUEUE_SIZE)
+    cursor = db.cursor()
+    group_filter = f'(uSNChanged>={since_usn + 1})' if since_usn is not None else ''
+    today = date.today()
+    user_display_names = {}
+    all_group_members = {}
+    all_members_by_dn = {}
+
+    def next_batch(batches):
+        with metrics.phase('pipeline_collect'):
+            batch = next(batches, None)
+        if batch:
+            with metrics.phase('manager_resolution'):
+                manager_cache.prime(conn, {
+                    member['manager_dn'] for member in batch[1].values()
+                    if is_person(member) and member['manager_dn']
+                })
+        return batch
+
+    def store_batch(batch):
+        group_members, members_by_dn = batch
+        for group_name, members in group_members:
+            all_group_members.setdefault(group_name, []).extend(members)
+        all_members_by_dn.update(members_by_dn)
+        snapshot_users = {}
+        import_memberships(conn, group_members, members_by_dn, user_display_names, snapshot_users)
+        with metrics.phase('db_sync'):
+            sync_snapshot_batch(cursor, snapshot_users, {username: run_state.user_current_groups[username] for username in snapshot_users})
+
+    def finish_sync():
+        run_state.group_count = len(all_group_members)
+        if since_usn is None:
+            with metrics.phase('snapshot_write'):
+                write_snapshot(list(all_group_members.items()), all_members_by_dn)
+        else:
+            with metrics.phase('db_sync'):
+                refresh_changed_users(conn, cursor, settings.BASE_DN, since_usn)
+        log("\n[✓] User and group import completed.\n")
+        log("\n[✓] Checking for stale group mappings...")
+        with metrics.phase('stale_prune'):
+            prune_stale_groups(cursor, settings.GROUP_PREFIXES, list(all_group_members) if since_usn is not None else None)
+        if current_usn is not None and not settings.dry_run:
+            save_usn_watermark(cursor, current_usn, current_dc)
+        if not settings.dry_run:
+            db.commit()
+
+    def queue_next_chunk(chunks):
+        with metrics.phase('planning'):
+            chunk = next(chunks, None)
+            if chunk is None:
+                return None
+            queued = queue_audit_emails(cursor, chunk[0], chunk[1], today)
+            if not settings.dry_run:
+                db.commit()
+            return queued
+
+    async def collect():
+        batches = stream_memberships(conn, settings.BASE_DN, settings.GROUP_PREFIXES, group_filter)
+        while True:
+            batch = await loop.run_in_executor(ldap_executor, next_batch, batches)
+            if batch is None:
+                break
+            await collected.put(batch)
+        await collected.put(None)
+
+    async def store():
+        await loop.run_in_executor(db_executor, create_snapshot_table, cursor)
+        while True:
+            batch = await collected.get()
+            if batch is None:
+                break
+            await loop.run_in_executor(db_executor, store_batch, batch)
+        await loop.run_in_executor(db_executor, finish_sync)
+
+        chunks = plan_audit_emails(cursor, user_display_names, today, full_sync=since_usn is None)
+        while True:
+            queued = await loop.run_in_executor(db_executor, queue_next_chunk, chunks)
+            if queued is None:
+                break
+            run_state.audits_logged += queued
+            if queued:
+                await committed.put(queued)
+        await committed.put(None)
+
+    async def send():
+        if settings.dry_run or settings.update_only:
+            while await committed.get() is not None:
+                pass
+            return
+        sender_db = await loop.run_in_executor(mail_executor, mysql_connection)
+        sender_db.autocommit = True
+        dispatcher = MailDispatcher(settings.EMAIL_WORKERS)
+        try:
+            done = False
+            while True:
+                run_state.emails_sent += await loop.run_in_executor(mail_executor, drain_outbox, sender_db, dispatcher)
+                if done:
+                    break
+                # Several chunks committed while the last drain ran are covered by one pass
+                done = await committed.get() is None
+                while not done and not committed.empty():
+                    done = committed.get_nowait() is None
+        finally:
+            await loop.run_in_executor(mail_executor, dispatcher.close)
+            sender_db.close()
+
+    tasks = [asyncio.ensure_future(stage) for stage in (collect(), store(), send())]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    finally:
+        for executor in (ldap_executor, db_executor, mail_executor):
+            executor.shutdown(wait=True)
         cursor.close()
+
+def main(argv=None):
+    """
+    Entry point: runs the mode selected on the command line.
+
+    Returns:
+        int: Process exit code.
+    """
+    configure(argv)
+
+    if settings.list_managers_mode:
+        list_managers_only()
+        return 0
+
+    if settings.list_manager_counts_mode:
+        list_manager_user_counts()
+        return 0
+
+    if settings.migrate_mode:
+        db = mysql_connection()
+        migrate_schema(db)
         db.close()
-        conn.unbind()
+        return 0
+
+    if settings.archive_mode:
+        db = mysql_connection()
+        migrate_schema(db)
+        archive_audit_log(db)
+        db.close()
+        write_metrics()
+        return 0
+
+    if settings.drain_outbox_mode:
+        db = mysql_connection()
+        migrate_schema(db)
+        run_state.emails_sent = drain_outbox(db)
+        db.close()
+        write_metrics()
+        return 0
+
+    if settings.debug_user_email:
+        db = mysql_connection()
+        cursor = db.cursor()
+
+        # 1. Find matching username and DB groups in one query
+        cursor.execute('''
+            SELECT u.username, g.group_name
+            FROM users u
+            LEFT JOIN user_groups g ON g.username = u.username
+            WHERE LOWER(u.email) = %s
+        ''', (settings.debug_user_email.lower(),))
+        rows = cursor.fetchall()
+        if not rows:
+            print(f"[!] No user found in DB with email {settings.debug_user_email}")
+            return 1
+
+        username = rows[0][0]
+        db_groups = set(row[1] for row in rows if row[0] == username and row[1] is not None)
+        print(f"\n=== DEBUG: {username} ({settings.debug_user_email}) ===")
+
+        # 2. Look up this user's prefixed LDAP groups directly
+        ldap_groups, conn = lookup_user_groups(settings.debug_user_email)
+        print(f"LDAP Groups: {ldap_groups}")
+
+        # 3. DB groups
+        print(f"DB Groups:   {db_groups}")
+
+        # 4. Diff
+        if db_groups != ldap_groups:
+            print("Differences detected:")
+            print(f"  In DB not in LDAP:   {db_groups - ldap_groups}")
+            print(f"  In LDAP not in DB:   {ldap_groups - db_groups}")
+        else:
+            print("Groups are consistent.")
+
+        # 5. Show audit history
+        cursor.execute('SELECT audit_date FROM audit_log WHERE username = %s ORDER BY audit_date DESC LIMIT 5', (username,))
+        audits = cursor.fetchall()
+        print("Recent Audits:")
+        for row in audits:
+            print(f" - {row[0]}")
+
+        db.rollback()
+        cursor.close()
+        db.close()
+        if conn:
+            conn.unbind()
+        return 0
+
+    try:
+        conn = ldap_pool()
+
+        db = mysql_connection()
+    
+        cursor = db.cursor()
+
+        migrate_schema(db)
+
+        current_usn, current_dc = directory_usn_state(conn)
+        since_usn = None
+        if settings.INCREMENTAL_SYNC and not settings.full_resync:
+            since_usn = load_usn_watermark(cursor, conn)
+
+        log(f"Searching for groups starting with prefix: {settings.GROUP_PREFIXES} (engine: {settings.COLLECTION_ENGINE})")
+        if since_usn is not None:
+            log(f"Incremental sync: only groups changed since USN {since_usn}")
+
+        if settings.SHARD_COUNT > 1:
+            run_sharded(conn, db, cursor)
+        elif settings.PIPELINE_MODE:
+            log(f"Pipeline mode: collection, database sync and sending overlap (queue size {settings.PIPELINE_QUEUE_SIZE}).")
+            import asyncio
+            asyncio.run(run_pipeline(conn, db, since_usn, current_usn, current_dc))
+        else:
+            run_sequential(conn, db, cursor, since_usn, current_usn, current_dc)
+
+        if settings.dry_run:
+            db.rollback()
+            log("[DRY-RUN] Skipping commit — all changes rolled back.")
+        else:
+            db.commit()
+            if run_state.audits_logged:
+                log(f"Queued {run_state.audits_logged} audit emails in the outbox.")
+            if not settings.update_only and not settings.PIPELINE_MODE and settings.SHARD_COUNT <= 1:
+                run_state.emails_sent = drain_outbox(db)
+            cursor.close()
+            db.close()
+            conn.unbind()
+
+        log("\n[✓] Audit complete.\n")
+
+        print("=== Summary ===")
+        print(f"Groups matched:      {run_state.group_count}")
+        print(f"Users processed:     {run_state.user_count}")
+        print(f"Group mappings:      {run_state.group_memberships}")
+        print(f"Managers contacted:  {len(run_state.manager_email_counts)}")
+        print(f"Audit emails queued: {run_state.audits_logged}")
+        print(f"Audit emails sent:   {run_state.emails_sent}")
+        print(f"Audit emails skipped (dry-run): {run_state.emails_skipped}")
+        print(f"Audit emails deferred: {run_state.emails_deferred}")
+        print(f"Audit entries added: {run_state.audits_logged}")
+        print(f"Manager cache:       {manager_cache.summary()}")
+        print(f"LDAP searches:       {metrics.counters.get('ldap_searches', 0)}")
+        print(f"SQL statements:      {metrics.counters.get('sql_statements', 0)}")
+
+        if metrics.phases:
+            print("\n=== Phase Timings ===")
+            for phase, seconds in sorted(metrics.phases.items(), key=lambda item: -item[1]):
+                print(f"{phase:<22} | {seconds:>9.2f}s")
+
+        if settings.dry_run and run_state.dry_run_emails:
+            print("\n=== Emails That Would Have Been Sent ===")
+            for mgr, user in run_state.dry_run_emails:
+                print(f"  -> To: {mgr} | For User: {user}")
+
+        if run_state.manager_email_counts:
+            print("\n=== Manager Audit Summary ===")
+            print(f"{'Manager Email':<40} | {'# of Audits'}")
+            print("-" * 55)
+            for mgr, count in sorted(run_state.manager_email_counts.items()):
+                print(f"{mgr:<40} | {count}")
+
+        write_metrics()
+
+    except Exception as e:
+        log("[!] Unhandled error occurred.")
+        error_details = traceback.format_exc()
+        log(error_details)
+        try:
+            write_metrics('error')
+        except Exception as metrics_error:
+            log(f"[!] Could not write metrics: {metrics_error}")
+        if not settings.dry_run:
+            send_error_email("AD Audit Script Error", error_details)
+        raise
+
+    return 0
 
-    log("\n[✓] Audit complete.\n")
-
-    print("=== Summary ===")
-    print(f"Groups matched:      {group_count}")
-    print(f"Users processed:     {user_count}")
-    print(f"Group mappings:      {group_memberships}")
-    print(f"Managers contacted:  {len(manager_email_counts)}")
-    print(f"Audit emails sent:   {emails_sent}")
-    print(f"Audit emails skipped (dry-run): {emails_skipped}")
-    print(f"Audit entries added: {audits_logged}")
-
-    if dry_run and dry_run_emails:
-        print("\n=== Emails That Would Have Been Sent ===")
-        for mgr, user in dry_run_emails:
-            print(f"  -> To: {mgr} | For User: {user}")
-
-    if manager_email_counts:
-        print("\n=== Manager Audit Summary ===")
-        print(f"{'Manager Email':<40} | {'# of Audits'}")
-        print("-" * 55)
-        for mgr, count in sorted(manager_email_counts.items()):
-            print(f"{mgr:<40} | {count}")
-
-except Exception as e:
-    log("[!] Unhandled error occurred.")
-    error_details = traceback.format_exc()
-    log(error_details)
-    if not dry_run:
-        send_error_email("AD Audit Script Error", error_details)
-    raise
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Seeds a scratch MySQL database with a large audit_log, captures query plans and
+timings for the hot query paths, applies the ad_auditor.py schema migrations,
+and captures them again.
+
+Run against a throwaway database only: the users and audit_log tables in it are dropped.
+
+    python3 bench/audit_log_query_plans.py --host 127.0.0.1 --user root --password secret --database ad_audit_bench
+"""
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import date, timedelta
+
+import mysql.connector
+
+AD_AUDITOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ad_auditor.py')
+sys.path.insert(0, os.path.dirname(AD_AUDITOR))
+import ad_auditor
+
+# Hot paths from ad_auditor.py and fe/index.php
+QUERIES = [
+    ('quota check (manager_email, audit_date)',
+     'SELECT COUNT(*) FROM audit_log WHERE manager_email = %s AND audit_date = %s'),
+    ('review page by secret',
+     'SELECT * FROM audit_log WHERE secret = %s'),
+    ('pending reviews for manager',
+     "SELECT a.username, a.secret, u.email, a.id, a.audit_date FROM audit_log a "
+     "LEFT JOIN users u ON a.username = u.username "
+     "WHERE a.manager_email = %s AND a.date_reviewed IS NULL ORDER BY a.audit_date ASC"),
+    ('debug-user audit history',
+     'SELECT audit_date FROM audit_log WHERE username = %s ORDER BY audit_date DESC LIMIT 5'),
+    # The statement plan_audit_emails runs, unsharded
+    ('users due for audit',
+     ad_auditor.DUE_USERS_SQL.format(shard_clause='')),
+]
+
+def log(msg):
+    print(f"[+] {msg}")
+
+def create_unindexed_schema(cursor):
+    # The pre-migration shape: base tables plus the columns the timed queries read, no secondary indexes
+    cursor.execute('DROP TABLE IF EXISTS audit_log')
+    cursor.execute('DROP TABLE IF EXISTS users')
+    cursor.execute('DROP TABLE IF EXISTS schema_version')
+    cursor.execute('''
+        CREATE TABLE users (
+            username VARCHAR(255) PRIMARY KEY,
+            email VARCHAR(255),
+            manager_email VARCHAR(255),
+            display_name VARCHAR(255) NULL,
+            last_audited DATE
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE audit_log (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            username VARCHAR(255),
+            manager_email VARCHAR(255),
+            audit_date DATE,
+            secret VARCHAR(64),
+            date_reviewed DATETIME NULL,
+            changes TEXT NULL
+        )
+    ''')
+
+def seed(db, cursor, rows, users, managers, batch_size):
+    rng = random.Random(42)
+    today = date.today()
+    usernames = [f"user{i:07d}" for i in range(users)]
+    manager_emails = [f"manager{i:05d}@example.com" for i in range(managers)]
+
+    log(f"Seeding {users} users...")
+    user_rows = [(u, f"{u}@example.com", rng.choice(manager_emails), today - timedelta(days=rng.randint(0, 400)))
+                 for u in usernames]
+    for i in range(0, len(user_rows), batch_size):
+        cursor.executemany('INSERT INTO users (username, email, manager_email, last_audited) VALUES (%s, %s, %s, %s)',
+                           user_rows[i:i + batch_size])
+    db.commit()
+
+    log(f"Seeding {rows} audit_log rows...")
+    started = time.perf_counter()
+    for i in range(0, rows, batch_size):
+        batch = []
+        for _ in range(min(batch_size, rows - i)):
+            audit_date = today - timedelta(days=rng.randint(0, 1500))
+            reviewed = None if rng.random() < 0.05 else audit_date + timedelta(days=rng.randint(0, 30))
+            batch.append((rng.choice(usernames), rng.choice(manager_emails), audit_date, uuid.uuid4().hex, reviewed))
+        cursor.executemany('INSERT INTO audit_log (username, manager_email, audit_date, secret, date_reviewed) '
+                           'VALUES (%s, %s, %s, %s, %s)', batch)
+        db.commit()
+    log(f"Seeded in {time.perf_counter() - started:.1f}s")
+    cursor.execute('ANALYZE TABLE audit_log, users')
+    cursor.fetchall()
+
+def sample_params(cursor):
+    cursor.execute('SELECT manager_email, audit_date, secret, username FROM audit_log ORDER BY id DESC LIMIT 1')
+    manager_email, audit_date, secret, username = cursor.fetchone()
+    return [
+        (manager_email, audit_date),
+        (secret,),
+        (manager_email,),
+        (username,),
+        (30,),
+    ]
+
+def measure(cursor, params, repeat):
+    results = []
+    for (name, sql), query_params in zip(QUERIES, params):
+        cursor.execute(f'EXPLAIN {sql}', query_params)
+        plan = cursor.fetchall()
+        columns = [c[0] for c in cursor.description]
+        plan_rows = [dict(zip(columns, row)) for row in plan]
+        started = time.perf_counter()
+        for _ in range(repeat):
+            cursor.execute(sql, query_params)
+            cursor.fetchall()
+        elapsed_ms = (time.perf_counter() - started) * 1000 / repeat
+        results.append((name, plan_rows, elapsed_ms))
+    return results
+
+def print_results(title, results):
+    print(f"\n=== {title} ===")
+    print(f"{'Query':<42} | {'type':<6} | {'key':<28} | {'rows':>9} | {'ms/query':>9}")
+    print("-" * 107)
+    for name, plan_rows, elapsed_ms in results:
+        first = plan_rows[0]
+        print(f"{name:<42} | {str(first.get('type')):<6} | {str(first.get('key')):<28} | {str(first.get('rows')):>9} | {elapsed_ms:>9.2f}")
+
+def run_migrations(args):
+    # Run the real migration code path against the scratch database via a throwaway config.ini
+    with tempfile.TemporaryDirectory() as workdir:
+        with open(os.path.join(workdir, 'config.ini'), 'w') as f:
+            f.write(f"""[ldap]
+server = ldap://unused.invalid
+bind_user = unused
+bind_password = unused
+base_dn = DC=unused
+
+[mysql]
+host = {args.host}
+port = {args.port}
+user = {args.user}
+password = {args.password}
+database = {args.database}
+
+[email]
+mode = file
+from_address = bench@example.com
+
+[alerts]
+error_recipients = bench@example.com
+
+[audit]
+""")
+        started = time.perf_counter()
+        subprocess.run([sys.executable, os.path.abspath(AD_AUDITOR), '--migrate'], cwd=workdir, check=True)
+        log(f"Migrations applied in {time.perf_counter() - started:.1f}s")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--user', required=True)
+    parser.add_argument('--password', default='')
+    parser.add_argument('--database', required=True, help='Scratch database; its users and audit_log tables are dropped')
+    parser.add_argument('--rows', type=int, default=2_000_000, help='audit_log rows to seed')
+    parser.add_argument('--users', type=int, default=50_000)
+    parser.add_argument('--managers', type=int, default=2_000)
+    parser.add_argument('--batch-size', type=int, default=10_000)
+    parser.add_argument('--repeat', type=int, default=20, help='Executions per query when timing')
+    args = parser.parse_args()
+
+    db = mysql.connector.connect(host=args.host, port=args.port, user=args.user, password=args.password, database=args.database)
+    cursor = db.cursor()
+    create_unindexed_schema(cursor)
+    seed(db, cursor, args.rows, args.users, args.managers, args.batch_size)
+    params = sample_params(cursor)
+
+    before = measure(cursor, params, args.repeat)
+    print_results('Before migrations', before)
+
+    run_migrations(args)
+    cursor.execute('ANALYZE TABLE audit_log, users')
+    cursor.fetchall()
+
+    after = measure(cursor, params, args.repeat)
+    print_results('After migrations', after)
+
+    print("\n=== Speed-up ===")
+    for (name, _, before_ms), (_, _, after_ms) in zip(before, after):
+        print(f"{name:<42} | {before_ms / after_ms if after_ms else float('inf'):>8.1f}x")
+
+    cursor.close()
+    db.close()
+
+if __name__ == '__main__':
+    main()
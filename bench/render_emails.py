@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Times email rendering and MIME construction for a large synthetic population,
+comparing the cached templates in mail_templates.py against rebuilding the
+inline f-string bodies and re-reading header config for every message.
+
+    python3 bench/render_emails.py --users 50000
+"""
+import argparse
+import configparser
+import os
+import random
+import sys
+import time
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mail_templates
+
+FROM_ADDRESS = 'audit@example.com'
+
+def log(msg):
+    print(f"[+] {msg}")
+
+def synthetic_users(count, groups_per_user):
+    rng = random.Random(42)
+    group_pool = [f"SG_App{i:04d}" for i in range(500)]
+    return [
+        (f"User {i}", f"user{i:07d}", f"user{i:07d}@example.com",
+         sorted(rng.sample(group_pool, groups_per_user)), f"https://audit.example.com/review?token={i:032x}")
+        for i in range(count)
+    ]
+
+def email_config():
+    config = configparser.ConfigParser()
+    config.read_string("[email]\nfrom_name = TechOps\ncc = audit-cc@example.com\nbcc = audit-bcc@example.com\n")
+    return config
+
+def inline_render(display_name, username, email, groups, review_link):
+    # The per-message f-string rendering ad_auditor.py used before templates were cached
+    group_list = ''.join(f"<li>{g}</li>" for g in groups)
+    plain_groups = '\n'.join(groups)
+    subject = f"Access Review: {display_name}"
+    plain_text = f"""Access Review Required for {display_name} ({username})
+
+Email: {email}
+Groups:
+{plain_groups}
+
+Please confirm if this access is still valid:
+{review_link}
+
+This is an automated message generated by the TechOps Team."""
+    html_content = f"""
+            <html>
+            <body>
+                <p><strong>Access Review Required for {display_name} ({username})</strong></p>
+                <p><strong>Email:</strong> {email}</p>
+                <p><strong>Groups:</strong></p>
+                <ul>{group_list}</ul>
+                <p>
+                    <a href="{review_link}" style="background-color:#1a73e8;color:#fff;padding:10px 20px;
+                    text-decoration:none;border-radius:4px;">Review Access</a>
+                </p>
+                <p style="font-size: small; color: #777;">This is an automated message generated by the TechOps Team.</p>
+            </body>
+            </html>
+            """
+    return subject, plain_text, html_content
+
+def inline_build(config, to, subject, plain_text, html_content):
+    # The per-message header construction ad_auditor.py used before MessageBuilder
+    msg = MIMEMultipart("alternative")
+    msg['Subject'] = subject
+    from_name = config['email'].get('from_name', '').strip()
+    msg['From'] = f"{from_name} <{FROM_ADDRESS}>" if from_name else FROM_ADDRESS
+    msg['To'] = to
+    cc_list = [x.strip() for x in config['email'].get('cc', '').split(',') if x.strip()]
+    bcc_list = [x.strip() for x in config['email'].get('bcc', '').split(',') if x.strip()]
+    if cc_list:
+        msg['Cc'] = ", ".join(cc_list)
+    msg.attach(MIMEText(plain_text, "plain"))
+    msg.attach(MIMEText(html_content, "html"))
+    return msg, [to] + cc_list + bcc_list
+
+def timed(label, fn, users):
+    started = time.perf_counter()
+    for user in users:
+        fn(user)
+    elapsed = time.perf_counter() - started
+    log(f"{label:<36} {elapsed:>7.2f}s  {len(users) / elapsed:>10.0f} msg/s")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50_000)
+    parser.add_argument('--groups-per-user', type=int, default=8)
+    parser.add_argument('--template-dir', default=mail_templates.DEFAULT_TEMPLATE_DIR)
+    args = parser.parse_args()
+
+    users = synthetic_users(args.users, args.groups_per_user)
+    config = email_config()
+    templates = mail_templates.TemplateSet(args.template_dir)
+    builder = mail_templates.MessageBuilder(FROM_ADDRESS, 'TechOps', ['audit-cc@example.com'], ['audit-bcc@example.com'])
+    log(f"Rendering {len(users)} users with {args.groups_per_user} groups each")
+
+    timed('render: inline f-strings', lambda u: inline_render(*u), users)
+    timed('render: cached templates', lambda u: mail_templates.render_audit_email(templates, *u), users)
+    before = timed('render + MIME: inline', lambda u: inline_build(config, u[2], *inline_render(*u)), users)
+    after = timed('render + MIME: templates + builder',
+                  lambda u: builder.build(u[2], *mail_templates.render_audit_email(templates, *u)), users)
+    log(f"End-to-end speed-up: {before / after:.2f}x")
+
+if __name__ == '__main__':
+    main()
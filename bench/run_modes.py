@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Offline end-to-end benchmark of ad_auditor.py's run modes.
+
+A synthetic directory (bench/synthetic_directory.py) is served through ldap3's
+MOCK_SYNC strategy ([ldap] mock_directory). Mail goes to a local SMTP sink
+(bench/smtp_sink.py). Data goes to a scratch MySQL database. The schema uses
+MySQL-specific SQL, so SQLite cannot stand in for it. Each mode runs in-process
+through ad_auditor.main() and is timed. Its throughput and the run metrics are
+then reported.
+
+The ldap3 mock evaluates every filter against every entry in Python, so LDAP-heavy
+phases scale far worse than against a real DC. Compare results between commits
+at the same directory size rather than reading them as production timings.
+
+Run against a throwaway database only: every table in it is dropped between modes.
+
+    python3 bench/run_modes.py --user root --password secret --database ad_audit_bench --users 500 --groups 50
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+import mysql.connector
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ad_auditor
+from smtp_sink import SMTPSink
+from synthetic_directory import BASE_DN, BIND_PASSWORD, BIND_USER, GROUP_PREFIX, generate_directory
+
+# (key, label, extra arguments, start from an empty database)
+MODES = [
+    ('members', 'full sync + send (members)', [], True),
+    ('memberof', 'full sync + send (memberof)', ['--engine', 'memberof'], True),
+    ('pipeline', 'full sync + send (pipeline)', ['--pipeline'], True),
+    ('nested', 'full sync + send (nested)', ['--expand-nested'], True),
+    ('digest', 'full sync + send (digest)', ['--digest'], True),
+    ('dry-run', 'dry run', ['--dry-run'], True),
+    ('steady', 'steady state (nothing due)', [], False),
+    ('list-live', 'list managers (live)', ['--list-managers', '--live'], False),
+    ('list-snapshot', 'list managers (snapshot)', ['--list-managers'], False),
+]
+
+def log(msg):
+    print(f"[+] {msg}")
+
+def reset_database(args):
+    db = mysql.connector.connect(host=args.host, port=args.port, user=args.user, password=args.password, database=args.database)
+    cursor = db.cursor()
+    cursor.execute('SHOW TABLES')
+    tables = [row[0] for row in cursor.fetchall()]
+    cursor.execute('SET FOREIGN_KEY_CHECKS = 0')
+    for table in tables:
+        cursor.execute(f'DROP TABLE `{table}`')
+    db.commit()
+    cursor.close()
+    db.close()
+
+def write_config(args, workdir, directory_path, smtp_port):
+    path = os.path.join(workdir, 'config.ini')
+    with open(path, 'w') as f:
+        f.write(f"""[groups]
+prefixes = {GROUP_PREFIX}
+
+[ldap]
+server = ldap://mock.invalid
+bind_user = {BIND_USER}
+bind_password = {BIND_PASSWORD}
+base_dn = {BASE_DN}
+mock_directory = {directory_path}
+max_connections = {args.ldap_connections}
+
+[mysql]
+host = {args.host}
+port = {args.port}
+user = {args.user}
+password = {args.password}
+database = {args.database}
+
+[email]
+mode = smtp
+smtp_server = 127.0.0.1
+smtp_port = {smtp_port}
+from_address = bench@bench.local
+smtp_pool_size = {args.smtp_pool_size}
+
+[alerts]
+error_recipients = bench@bench.local
+
+[audit]
+batch_size = {args.audit_batch_size}
+max_audits_per_manager_per_day = {args.audit_batch_size}
+
+[cache]
+snapshot_path = {os.path.join(workdir, 'ad_snapshot.sqlite')}
+""")
+    return path
+
+def run_mode(config_path, extra_args, log_path):
+    with open(log_path, 'w') as out, contextlib.redirect_stdout(out):
+        started = time.perf_counter()
+        exit_code = ad_auditor.main(['--config', config_path] + extra_args)
+        elapsed = time.perf_counter() - started
+    return exit_code, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--user', required=True)
+    parser.add_argument('--password', default='')
+    parser.add_argument('--database', required=True, help='Scratch database; all of its tables are dropped')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--groups-per-user', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=8, help='Direct reports per manager')
+    parser.add_argument('--nested-groups', type=int, default=10)
+    parser.add_argument('--nesting-depth', type=int, default=3)
+    parser.add_argument('--ldap-connections', type=int, default=1)
+    parser.add_argument('--smtp-pool-size', type=int, default=4)
+    parser.add_argument('--smtp-delay', type=float, default=0.0, help='Simulated relay latency per message, in seconds')
+    parser.add_argument('--audit-batch-size', type=int, default=5)
+    parser.add_argument('--mode', action='append', choices=[key for key, *_ in MODES], help='Modes to run (default: all)')
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    modes = [mode for mode in MODES if not args.mode or mode[0] in args.mode]
+    results = []
+    with tempfile.TemporaryDirectory() as workdir, SMTPSink(delay=args.smtp_delay) as sink:
+        directory_path = os.path.join(workdir, 'directory.json')
+        entries = generate_directory(args.users, args.groups, args.groups_per_user, args.fanout,
+                                     args.nested_groups, args.nesting_depth)
+        with open(directory_path, 'w') as f:
+            json.dump({'entries': entries}, f)
+        log(f"Synthetic directory: {args.users} users, {args.groups} groups, {args.nested_groups} nested groups ({len(entries)} entries)")
+        config_path = write_config(args, workdir, directory_path, sink.port)
+
+        for key, label, extra_args, fresh in modes:
+            if fresh:
+                reset_database(args)
+            sent_before = sink.messages
+            log(f"Running {label}...")
+            exit_code, elapsed = run_mode(config_path, extra_args, os.path.join(workdir, f"{key}.log"))
+            metrics = ad_auditor.metrics
+            users = ad_auditor.run_state.user_count
+            results.append({
+                'mode': key,
+                'label': label,
+                'exit_code': exit_code,
+                'seconds': round(elapsed, 3),
+                'users_processed': users,
+                'users_per_second': round(users / elapsed, 1) if elapsed else None,
+                'emails_accepted': sink.messages - sent_before,
+                'ldap_searches': metrics.counters.get('ldap_searches', 0),
+                'sql_statements': metrics.counters.get('sql_statements', 0),
+                'phases_seconds': {name: round(value, 3) for name, value in sorted(metrics.phases.items())},
+            })
+
+    print(f"\n{'Mode':<30} | {'Seconds':>8} | {'Users/s':>9} | {'Emails':>6} | {'LDAP':>6} | {'SQL':>6} | Slowest phase")
+    print("-" * 110)
+    for r in results:
+        slowest = max(r['phases_seconds'].items(), key=lambda item: item[1], default=('-', 0))
+        print(f"{r['label']:<30} | {r['seconds']:>8.2f} | {r['users_per_second'] or 0:>9.1f} | {r['emails_accepted']:>6} | "
+              f"{r['ldap_searches']:>6} | {r['sql_statements']:>6} | {slowest[0]} ({slowest[1]:.2f}s)")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        log(f"Results written to {args.json}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+A minimal SMTP sink: accepts every message on a local port and discards it,
+counting messages and recipients. It lets the benchmarks exercise the real
+smtplib/SMTPPool path without a mail relay. No TLS and no AUTH are offered.
+
+    python3 bench/smtp_sink.py --port 2525
+"""
+import argparse
+import asyncio
+import threading
+
+class SMTPSink:
+    """
+    Runs the sink on its own event loop thread; use start()/stop() or as a context manager.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0.0):
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.messages = 0
+        self.recipients = 0
+        self._loop = asyncio.new_event_loop()
+        self._server = None
+        self._thread = threading.Thread(target=self._loop.run_forever, name='smtp-sink', daemon=True)
+
+    async def _session(self, reader, writer):
+        async def reply(line):
+            writer.write(f"{line}\r\n".encode())
+            await writer.drain()
+
+        await reply('220 smtp-sink ready')
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode(errors='replace').strip().upper()
+                if command.startswith('EHLO'):
+                    await reply('250-smtp-sink\r\n250-8BITMIME\r\n250 SIZE 52428800')
+                elif command.startswith('HELO'):
+                    await reply('250 smtp-sink')
+                elif command.startswith('RCPT'):
+                    self.recipients += 1
+                    await reply('250 OK')
+                elif command.startswith(('MAIL', 'RSET', 'NOOP')):
+                    await reply('250 OK')
+                elif command == 'DATA':
+                    await reply('354 End data with <CR><LF>.<CR><LF>')
+                    while (await reader.readline()) not in (b'.\r\n', b'.\n', b''):
+                        pass
+                    if self.delay:
+                        await asyncio.sleep(self.delay)
+                    self.messages += 1
+                    await reply('250 OK queued')
+                elif command == 'QUIT':
+                    await reply('221 Bye')
+                    break
+                else:
+                    await reply('502 Command not implemented')
+        finally:
+            writer.close()
+
+    def start(self):
+        self._thread.start()
+        self._server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._session, self.host, self.port), self._loop
+        ).result()
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    def stop(self):
+        self._server.close()
+        asyncio.run_coroutine_threadsafe(self._server.wait_closed(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2525)
+    parser.add_argument('--delay', type=float, default=0.0, help='Seconds to wait before accepting each message (simulated relay latency)')
+    args = parser.parse_args()
+    sink = SMTPSink(args.host, args.port, args.delay).start()
+    print(f"[+] SMTP sink listening on {args.host}:{sink.port} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.stop()
+        print(f"[+] Accepted {sink.messages} messages for {sink.recipients} recipients")
+
+if __name__ == '__main__':
+    main()
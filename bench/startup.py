@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Times ad_auditor.py's startup in fresh interpreters: importing the module, parsing
+config, and the first LDAP bind, MySQL connection and secret fetch, along with
+which of the heavy modules (ldap3, mysql.connector, boto3, asyncio) each step
+actually loaded.
+
+    python3 bench/startup.py --compare-rev HEAD~1
+    python3 bench/startup.py --mysql-user root --mysql-database ad_audit_bench
+    AD_AUDITOR_SECRET_CACHE_KEY=... python3 bench/startup.py --secret prod/ad-auditor/mysql --region eu-west-1
+
+The LDAP step binds to a small synthetic directory through the ldap3 mock, so it
+measures import and client setup rather than network latency. The MySQL and secret
+steps run only when their options are given. With --secret and a cache key in the
+environment, the secret step runs twice: the second process should be served from
+the encrypted local cache. --compare-rev runs the same steps against ad_auditor.py
+from an earlier commit, for a before/after comparison.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from synthetic_directory import BASE_DN, BIND_PASSWORD, BIND_USER, GROUP_PREFIX, generate_directory
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+HEAVY_MODULES = ['ldap3', 'mysql.connector', 'boto3', 'asyncio']
+
+# Runs in a fresh interpreter; {action} is indented into the timed block
+SCRIPT = """
+import contextlib, io, json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, {root!r})
+import ad_auditor
+imported = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    ad_auditor.configure(['--config', {config!r}])
+    configured = time.perf_counter()
+{action}
+finished = time.perf_counter()
+print(json.dumps({{
+    'import': imported - started,
+    'configure': configured - imported,
+    'first_call': finished - configured,
+    'total': finished - started,
+    'loaded': [m for m in {heavy!r} if m in sys.modules],
+}}))
+"""
+
+STEPS = {
+    'import': '    pass',
+    'ldap': '    ad_auditor.ldap_pool()',
+    'mysql': '    ad_auditor.mysql_connection()',
+    'secret': '    ad_auditor.get_secret({secret!r})',
+}
+
+def log(msg):
+    print(f"[+] {msg}")
+
+def write_config(args, workdir, directory_path):
+    path = os.path.join(workdir, 'config.ini')
+    with open(path, 'w') as f:
+        f.write(f"""[groups]
+prefixes = {GROUP_PREFIX}
+
+[ldap]
+server = ldap://mock.invalid
+bind_user = {BIND_USER}
+bind_password = {BIND_PASSWORD}
+base_dn = {BASE_DN}
+mock_directory = {directory_path}
+
+[mysql]
+host = {args.mysql_host}
+port = {args.mysql_port}
+user = {args.mysql_user or 'unused'}
+password = {args.mysql_password}
+database = {args.mysql_database or 'unused'}
+
+[email]
+mode = file
+from_address = bench@bench.local
+
+[audit]
+
+[aws]
+{f'region = {args.region}' if args.region else ''}
+secret_cache_path = {os.path.join(workdir, 'secret_cache')}
+secret_cache_ttl_minutes = {args.secret_cache_ttl}
+""")
+    return path
+
+def run_step(root, config_path, step, secret=None):
+    script = SCRIPT.format(root=root, config=config_path, action=STEPS[step].format(secret=secret), heavy=HEAVY_MODULES)
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def measure(root, config_path, step, repeat, secret=None):
+    runs = [run_step(root, config_path, step, secret) for _ in range(repeat)]
+    if any(run is None for run in runs):
+        return None
+    summary = {key: statistics.median(run[key] for run in runs) for key in ('import', 'configure', 'first_call', 'total')}
+    summary['loaded'] = runs[0]['loaded']
+    return summary
+
+def checkout(rev, workdir):
+    root = os.path.join(workdir, rev.replace('/', '_'))
+    os.makedirs(root)
+    for name in ('ad_auditor.py', 'mail_templates.py'):
+        source = subprocess.run(['git', 'show', f'{rev}:{name}'], cwd=REPO, capture_output=True, text=True)
+        if source.returncode == 0:
+            with open(os.path.join(root, name), 'w') as f:
+                f.write(source.stdout)
+    shutil.copytree(os.path.join(REPO, 'templates'), os.path.join(root, 'templates'))
+    return root
+
+def interpreter_startup(repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        subprocess.run([sys.executable, '-c', 'pass'])
+    return (time.perf_counter() - started) / repeat
+
+def module_import_times():
+    times = {}
+    for module in HEAVY_MODULES:
+        script = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+        result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True)
+        times[module] = float(result.stdout) if result.returncode == 0 else None
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='Fresh interpreters per step; the median is reported')
+    parser.add_argument('--compare-rev', help='Also time ad_auditor.py as of this git revision')
+    parser.add_argument('--mysql-host', default='127.0.0.1')
+    parser.add_argument('--mysql-port', type=int, default=3306)
+    parser.add_argument('--mysql-user')
+    parser.add_argument('--mysql-password', default='')
+    parser.add_argument('--mysql-database')
+    parser.add_argument('--secret', help='Secrets Manager secret to fetch (needs AWS credentials)')
+    parser.add_argument('--region')
+    parser.add_argument('--secret-cache-ttl', type=int, default=60, help='[aws] secret_cache_ttl_minutes for the secret step')
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    steps = ['import', 'ldap']
+    if args.mysql_user and args.mysql_database:
+        steps.append('mysql')
+    if args.secret:
+        steps += ['secret', 'secret']
+
+    results = {'interpreter_seconds': None, 'module_import_seconds': module_import_times(), 'revisions': {}}
+    with tempfile.TemporaryDirectory() as workdir:
+        directory_path = os.path.join(workdir, 'directory.json')
+        with open(directory_path, 'w') as f:
+            json.dump({'entries': generate_directory(users=100, groups=10)}, f)
+        config_path = write_config(args, workdir, directory_path)
+        results['interpreter_seconds'] = interpreter_startup(args.repeat)
+
+        roots = [('working tree', REPO)]
+        if args.compare_rev:
+            roots.insert(0, (args.compare_rev, checkout(args.compare_rev, workdir)))
+        for label, root in roots:
+            rows = results['revisions'][label] = []
+            for i, step in enumerate(steps):
+                name = 'secret (cached)' if step == 'secret' and steps[:i].count('secret') else step
+                # The secret steps share one cache file, so they must not repeat within a revision
+                repeat = 1 if step == 'secret' else args.repeat
+                if step == 'secret' and i == steps.index('secret'):
+                    cache_path = os.path.join(workdir, 'secret_cache')
+                    if os.path.exists(cache_path):
+                        os.remove(cache_path)
+                log(f"{label}: {name}...")
+                rows.append({'step': name, **(measure(root, config_path, step, repeat, args.secret) or {'error': True})})
+
+    print(f"\nInterpreter startup (python -c pass): {results['interpreter_seconds'] * 1000:.0f} ms")
+    print("Heavy module import cost (fresh interpreter): " + ", ".join(
+        f"{module} {seconds * 1000:.0f} ms" if seconds is not None else f"{module} n/a"
+        for module, seconds in results['module_import_seconds'].items()))
+    for label, rows in results['revisions'].items():
+        print(f"\n{label}")
+        print(f"{'Step':<16} | {'Import':>8} | {'Configure':>9} | {'First call':>10} | {'Total':>8} | Heavy modules loaded")
+        print("-" * 100)
+        for row in rows:
+            if row.get('error'):
+                print(f"{row['step']:<16} | failed (see the step's requirements in --help)")
+                continue
+            print(f"{row['step']:<16} | {row['import'] * 1000:>5.0f} ms | {row['configure'] * 1000:>6.0f} ms | "
+                  f"{row['first_call'] * 1000:>7.0f} ms | {row['total'] * 1000:>5.0f} ms | {', '.join(row['loaded']) or '-'}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        log(f"Results written to {args.json}")
+
+if __name__ == '__main__':
+    main()
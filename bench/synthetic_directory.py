@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Generates a synthetic Active Directory in ldap3's JSON entries format, for use as
+[ldap] mock_directory (an ldap3 MOCK_SYNC stand-in for a domain controller).
+
+    python3 bench/synthetic_directory.py --users 5000 --groups 200 --fanout 8 --nested-groups 20 -o directory.json
+
+Users get `groups_per_user` direct memberships in prefixed groups. Managers are
+ordinary users with `fanout` direct reports each. Nested groups hang off prefixed
+groups in chains up to `nesting_depth` deep, and hold some of the users directly.
+"""
+import argparse
+import json
+import random
+
+BIND_USER = 'CN=ad-auditor,OU=Service Accounts,DC=bench,DC=local'
+BIND_PASSWORD = 'bench'
+BASE_DN = 'DC=bench,DC=local'
+GROUP_PREFIX = 'SG_BENCH'
+
+def _user(dn, username, given_name, surname, manager_dn=None):
+    raw = {
+        'objectClass': ['top', 'person', 'organizationalPerson', 'user'],
+        'objectCategory': ['person'],
+        'distinguishedName': [dn],
+        'sAMAccountName': [username],
+        'mail': [f"{username}@bench.local"],
+        'givenName': [given_name],
+        'sn': [surname],
+        'memberOf': [],
+    }
+    if manager_dn:
+        raw['manager'] = [manager_dn]
+    return {'dn': dn, 'raw': raw}
+
+def _group(dn, cn):
+    return {'dn': dn, 'raw': {
+        'objectClass': ['top', 'group'],
+        'objectCategory': ['group'],
+        'distinguishedName': [dn],
+        'cn': [cn],
+        'member': [],
+        'memberOf': [],
+    }}
+
+def _add_member(group, entry):
+    group['raw']['member'].append(entry['dn'])
+    entry['raw']['memberOf'].append(group['dn'])
+
+def generate_directory(users=1000, groups=50, groups_per_user=3, fanout=8, nested_groups=0, nesting_depth=2,
+                       nested_members=10, base_dn=BASE_DN, prefix=GROUP_PREFIX, seed=42):
+    """
+    Builds the directory entries.
+
+    Args:
+        users (int): Number of people (managers included).
+        groups (int): Number of groups whose CN starts with `prefix`.
+        groups_per_user (int): Direct prefixed-group memberships per user.
+        fanout (int): Direct reports per manager.
+        nested_groups (int): Number of unprefixed groups nested under prefixed groups.
+        nesting_depth (int): Longest chain of nested groups.
+        nested_members (int): Users placed directly in each nested group.
+        base_dn (str): Directory base DN.
+        prefix (str): Prefix of the audited groups.
+        seed (int): Random seed, so the same arguments always give the same directory.
+
+    Returns:
+        list: ldap3 JSON entries ({'dn': ..., 'raw': {...}}).
+    """
+    rng = random.Random(seed)
+    people = []
+    managers = max(1, users // (fanout + 1))
+    for i in range(users):
+        dn = f"CN=User {i:07d},OU=Users,{base_dn}"
+        manager_dn = None if i < managers else people[rng.randrange(managers)]['dn']
+        people.append(_user(dn, f"user{i:07d}", f"given{i}", f"surname{i}", manager_dn))
+
+    audited = [_group(f"CN={prefix}_{i:05d},OU=Groups,{base_dn}", f"{prefix}_{i:05d}") for i in range(groups)]
+    for person in people[managers:]:
+        for group in rng.sample(audited, min(groups_per_user, len(audited))):
+            _add_member(group, person)
+
+    nested = [_group(f"CN=NG_{i:05d},OU=Groups,{base_dn}", f"NG_{i:05d}") for i in range(nested_groups)]
+    for i, group in enumerate(nested):
+        # Chains of nesting_depth: the head of each chain sits in a prefixed group
+        parent = rng.choice(audited) if i % max(1, nesting_depth) == 0 or not audited else nested[i - 1]
+        _add_member(parent, group)
+        for person in rng.sample(people, min(nested_members, len(people))):
+            _add_member(group, person)
+
+    return people + audited + nested
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--groups-per-user', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=8, help='Direct reports per manager')
+    parser.add_argument('--nested-groups', type=int, default=0)
+    parser.add_argument('--nesting-depth', type=int, default=2)
+    parser.add_argument('--nested-members', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('-o', '--output', required=True)
+    args = parser.parse_args()
+
+    entries = generate_directory(args.users, args.groups, args.groups_per_user, args.fanout, args.nested_groups,
+                                 args.nesting_depth, args.nested_members, seed=args.seed)
+    with open(args.output, 'w') as f:
+        json.dump({'entries': entries}, f)
+    print(f"[+] Wrote {len(entries)} entries to {args.output}")
+
+if __name__ == '__main__':
+    main()
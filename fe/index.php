@@ -62,6 +62,19 @@ function send_smtp_notification($to, $subject, $body) {
     }
 }
 
+// Outstanding reviews for a manager. The email comes from the review snapshot written
+// at audit time; users is only joined for audits created before snapshots existed.
+function fetch_outstanding_reviews($pdo, $managerEmail) {
+    $stmt = $pdo->prepare("SELECT a.username, a.secret, COALESCE(s.email, u.email) AS email, COALESCE(s.display_name, CONCAT(u.username, ' (', u.email, ')')) AS display_name, a.id, a.audit_date FROM audit_log a LEFT JOIN audit_review_snapshot s ON s.secret = a.secret LEFT JOIN users u ON s.secret IS NULL AND a.username = u.username WHERE a.manager_email = ? AND a.date_reviewed IS NULL ORDER BY a.audit_date ASC");
+    $stmt->execute([$managerEmail]);
+    return $stmt->fetchAll(PDO::FETCH_ASSOC);
+}
+
+// Drops a just-reviewed audit from the list instead of querying it again
+function without_review($reviews, $auditId) {
+    return array_values(array_filter($reviews, fn($r) => $r['id'] != $auditId));
+}
+
 // Initialisation flags and container variables
 $show_form = false;
 $show_reviews_table = false;
@@ -69,9 +82,7 @@ $outstandingReviews = [];
 $has_other_reviews = false;
 
 // Fetch all outstanding reviews for the current manager
-$stmt = $pdo->prepare("SELECT a.username, a.secret, u.email, CONCAT(u.username, ' (', u.email, ')') AS display_name, a.id, a.audit_date FROM audit_log a LEFT JOIN users u ON a.username = u.username WHERE a.manager_email = ? AND a.date_reviewed IS NULL ORDER BY a.audit_date ASC");
-$stmt->execute([$email]);
-$outstandingReviews = $stmt->fetchAll(PDO::FETCH_ASSOC);
+$outstandingReviews = fetch_outstanding_reviews($pdo, $email);
 
 // Display list if no token is provided
 if (!$secret) {
@@ -88,10 +99,10 @@ if (!$secret) {
     }
 }
 
-// If a token is provided, fetch that specific audit
+// If a token is provided, fetch that specific audit with its review snapshot (one indexed row)
 $audit = null;
 if ($secret) {
-    $stmt = $pdo->prepare("SELECT * FROM audit_log WHERE secret = ?");
+    $stmt = $pdo->prepare("SELECT a.*, s.display_name AS snapshot_display_name, s.email AS snapshot_email, s.groups_json FROM audit_log a LEFT JOIN audit_review_snapshot s ON s.secret = a.secret WHERE a.secret = ?");
     $stmt->execute([$secret]);
     $audit = $stmt->fetch(PDO::FETCH_ASSOC);
 
@@ -117,6 +128,9 @@ if ($secret && $audit) {
 // Show review form if applicable
 if ($audit) {
     $username = htmlspecialchars($audit['username']);
+    // Name and email as they were when the review was emailed; older audits have no snapshot
+    $display_name = htmlspecialchars($audit['snapshot_display_name'] ?? $audit['username']);
+    $user_email = htmlspecialchars($audit['snapshot_email'] ?? '');
     $manager_email = htmlspecialchars($audit['manager_email']);
     $already_reviewed = !empty($audit['date_reviewed']);
 
@@ -149,9 +163,7 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
 
     log_action($pdo, 'Audit', "Submitted group removal for $username. Groups: $json", $email);
 
-    $stmt = $pdo->prepare("SELECT a.username, a.secret, u.email, CONCAT(u.username, ' (', u.email, ')') AS display_name, a.id, a.audit_date FROM audit_log a LEFT JOIN users u ON a.username = u.username WHERE a.manager_email = ? AND a.date_reviewed IS NULL ORDER BY a.audit_date ASC");
-    $stmt->execute([$email]);
-    $outstandingReviews = $stmt->fetchAll(PDO::FETCH_ASSOC);
+    $outstandingReviews = without_review($outstandingReviews, $audit['id']);
     $show_reviews_table = !empty($outstandingReviews);
     $has_other_reviews = count($outstandingReviews) > 0;
 }
@@ -168,19 +180,22 @@ if ($action === 'approve' && isset($audit) && !$already_reviewed) {
 
     log_action($pdo, 'Audit', "Access approved for $username", $email);
 
-    $stmt = $pdo->prepare("SELECT a.username, a.secret, u.email, CONCAT(u.username, ' (', u.email, ')') AS display_name, a.id, a.audit_date FROM audit_log a LEFT JOIN users u ON a.username = u.username WHERE a.manager_email = ? AND a.date_reviewed IS NULL ORDER BY a.audit_date ASC");
-    $stmt->execute([$email]);
-    $outstandingReviews = $stmt->fetchAll(PDO::FETCH_ASSOC);
+    $outstandingReviews = without_review($outstandingReviews, $audit['id']);
     $show_reviews_table = !empty($outstandingReviews);
     $has_other_reviews = count($outstandingReviews) > 0;
 }
 
-// Fetch group membership for audit display
+// Groups under review: the list emailed to the manager, from the review snapshot
 $groups = [];
 if ($audit) {
-    $stmt = $pdo->prepare("SELECT group_name FROM user_groups WHERE username = ?");
-    $stmt->execute([$audit['username']]);
-    $groups = $stmt->fetchAll(PDO::FETCH_COLUMN);
+    if ($audit['groups_json'] !== null) {
+        $groups = json_decode($audit['groups_json'], true) ?? [];
+    } else {
+        // Audits created before review snapshots were written
+        $stmt = $pdo->prepare("SELECT group_name FROM user_groups WHERE username = ?");
+        $stmt->execute([$audit['username']]);
+        $groups = $stmt->fetchAll(PDO::FETCH_COLUMN);
+    }
 }
 
 // Show final message if audit already reviewed and no other messages exist
@@ -236,7 +251,7 @@ if (isset($already_reviewed) && $already_reviewed && !$message) {
 <div class="container mt-4">
     <div class="card shadow">
         <div class="card-header bg-primary text-white text-center">
-            <h4><?php echo $application_name; if ($audit): ?> for <?= $username ?> <?php endif ?></h4>
+            <h4><?php echo $application_name; if ($audit): ?> for <?= $display_name ?><?php if ($user_email): ?> (<?= $user_email ?>)<?php endif ?> <?php endif ?></h4>
         </div>
         <div class="card-body">
             <?php if ($message && $message_class !== 'none'): ?>
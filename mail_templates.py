@@ -0,0 +1,154 @@
+"""
+Email templates and MIME construction for ad_auditor.py.
+
+Templates are loaded from disk and compiled once per run; every field filled into
+an HTML template is escaped. MessageBuilder computes the invariant headers and
+CC/BCC recipient lists once instead of re-reading them from config per message.
+"""
+import html
+import os
+from email.message import Message
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from string import Template
+
+DEFAULT_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+def compile_template(text):
+    """
+    Compiles `string.Template` syntax (`${name}`, `$name`, `$$`) into an equivalent
+    `str.format` string, which renders several times faster than `Template.substitute`.
+    """
+    parts = []
+    pos = 0
+    for match in Template.pattern.finditer(text):
+        parts.append(text[pos:match.start()].replace('{', '{{').replace('}', '}}'))
+        name = match.group('named') or match.group('braced')
+        if name:
+            parts.append('{' + name + '}')
+        elif match.group('escaped') is not None:
+            parts.append('$')
+        else:
+            raise ValueError(f"Invalid placeholder in template at offset {match.start()}")
+        pos = match.end()
+    parts.append(text[pos:].replace('{', '{{').replace('}', '}}'))
+    return ''.join(parts)
+
+class TemplateSet:
+    """
+    Lazily loads, compiles and caches templates from a directory.
+    """
+
+    def __init__(self, directory=DEFAULT_TEMPLATE_DIR):
+        self.directory = directory
+        self._compiled = {}
+
+    def get(self, name):
+        template = self._compiled.get(name)
+        if template is None:
+            with open(os.path.join(self.directory, name), encoding='utf-8') as f:
+                template = compile_template(f.read().rstrip('\n'))
+            self._compiled[name] = template
+        return template
+
+def _html_fields(display_name, username, email, groups, review_link):
+    return {
+        'display_name': html.escape(display_name),
+        'username': html.escape(username),
+        'email': html.escape(email or ''),
+        'groups': ''.join(f"<li>{html.escape(g)}</li>" for g in groups),
+        'review_link': html.escape(review_link),
+    }
+
+def render_audit_email(templates, display_name, username, email, groups, review_link):
+    """
+    Renders the single-user audit email.
+
+    Returns:
+        tuple: (subject, plain_text, html_content)
+    """
+    subject = f"Access Review: {display_name}"
+    plain_text = templates.get('audit_email.txt').format(
+        display_name=display_name,
+        username=username,
+        email=email,
+        groups='\n'.join(groups),
+        review_link=review_link,
+    )
+    html_content = templates.get('audit_email.html').format(
+        **_html_fields(display_name, username, email, groups, review_link)
+    )
+    return subject, plain_text, html_content
+
+def render_digest_email(templates, entries):
+    """
+    Renders one digest email listing several users, each with its own review link.
+
+    Args:
+        templates (TemplateSet): Compiled templates.
+        entries (list): (display_name, username, email, groups, review_link) tuples.
+
+    Returns:
+        tuple: (subject, plain_text, html_content)
+    """
+    plain_entry = templates.get('digest_entry.txt')
+    html_entry = templates.get('digest_entry.html')
+    plain_sections = []
+    html_sections = []
+    for display_name, username, email, groups, review_link in entries:
+        plain_sections.append(plain_entry.format(
+            display_name=display_name,
+            username=username,
+            email=email,
+            groups='\n'.join(f"  {g}" for g in groups),
+            review_link=review_link,
+        ))
+        html_sections.append(html_entry.format(
+            **_html_fields(display_name, username, email, groups, review_link)
+        ))
+
+    subject = f"Access Review: {len(entries)} user{'s' if len(entries) != 1 else ''} awaiting review"
+    plain_text = templates.get('digest_email.txt').format(entries='\n\n'.join(plain_sections))
+    html_content = templates.get('digest_email.html').format(entries='\n'.join(html_sections))
+    return subject, plain_text, html_content
+
+def _text_part(text, subtype):
+    """
+    Builds a text/* MIME part. ASCII bodies get the headers MIMEText would produce set
+    directly, skipping its per-message Content-Type re-parsing; anything else goes
+    through MIMEText so the charset and transfer encoding are chosen as before.
+    """
+    if not text.isascii():
+        return MIMEText(text, subtype)
+    part = Message()
+    part['Content-Type'] = f'text/{subtype}; charset="us-ascii"'
+    part['MIME-Version'] = '1.0'
+    part['Content-Transfer-Encoding'] = '7bit'
+    part.set_payload(text)
+    return part
+
+class MessageBuilder:
+    """
+    Builds outbound MIME messages with the From header and CC/BCC lists computed once.
+    """
+
+    def __init__(self, from_address, from_name='', cc_list=(), bcc_list=()):
+        self.from_header = f"{from_name} <{from_address}>" if from_name else from_address
+        self.cc_header = ", ".join(cc_list)
+        self.extra_recipients = list(cc_list) + list(bcc_list)
+
+    def build(self, to, subject, plain_text, html_content):
+        """
+        Returns:
+            tuple: (MIMEMultipart message, list of envelope recipients)
+        """
+        to_list = [to] if isinstance(to, str) else list(to)
+        msg = MIMEMultipart("alternative")
+        msg['Subject'] = subject
+        msg['From'] = self.from_header
+        msg['To'] = ", ".join(to_list)
+        if self.cc_header:
+            msg['Cc'] = self.cc_header
+        msg.attach(_text_part(plain_text, "plain"))
+        msg.attach(_text_part(html_content, "html"))
+        return msg, to_list + self.extra_recipients
@@ -0,0 +1,69 @@
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+import ad_auditor
+from synthetic_directory import BASE_DN, BIND_PASSWORD, BIND_USER, GROUP_PREFIX, generate_directory
+
+def write_config(path, directory_path, snapshot_path, groups_config='', extra_config=''):
+    with open(path, 'w') as f:
+        f.write(f"""[ldap]
+server = ldap://mock.invalid
+bind_user = {BIND_USER}
+bind_password = {BIND_PASSWORD}
+base_dn = {BASE_DN}
+mock_directory = {directory_path}
+
+[groups]
+prefixes = {GROUP_PREFIX}
+{groups_config}
+
+[mysql]
+host = 127.0.0.1
+port = 3306
+user = unused
+password = unused
+database = unused
+
+[email]
+mode = file
+from_address = audit@bench.local
+
+[alerts]
+error_recipients = audit@bench.local
+
+[audit]
+
+[cache]
+snapshot_path = {snapshot_path}
+
+{extra_config}
+""")
+
+@pytest.fixture
+def mock_directory(tmp_path):
+    """
+    Writes a synthetic directory for ldap3's MOCK_SYNC strategy ([ldap] mock_directory)
+    and configures ad_auditor against it. `extra_config` is appended to the config
+    file, and `edit` can change the generated entries before they are written.
+    Returns the entries.
+    """
+    def build(groups_config='', extra_config='', argv=(), edit=None, **directory_args):
+        entries = generate_directory(**directory_args)
+        if edit:
+            edit(entries)
+        directory_path = tmp_path / 'directory.json'
+        with open(directory_path, 'w') as f:
+            json.dump({'entries': entries}, f)
+        config_path = tmp_path / 'config.ini'
+        write_config(config_path, directory_path, tmp_path / 'snapshot.sqlite', groups_config, extra_config)
+        ad_auditor.configure(['--config', str(config_path), *argv])
+        return entries
+
+    return build
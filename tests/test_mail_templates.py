@@ -0,0 +1,28 @@
+import os
+from string import Template
+
+import pytest
+
+from mail_templates import DEFAULT_TEMPLATE_DIR, TemplateSet, compile_template
+
+FIELDS = {'name': 'Ada', 'count': 3, 'link': 'https://audit.example.com/review?token=abc'}
+
+@pytest.mark.parametrize('text', [
+    'Hello $name',
+    'Hello ${name}, you have ${count} reviews',
+    'Costs $$5 for $name',
+    'Braces {stay} {{literal}} for $name',
+    '<style>p { color: red; }</style><a href="${link}">$name</a>',
+    'No placeholders at all',
+])
+def test_compile_template_renders_like_string_template(text):
+    assert compile_template(text).format(**FIELDS) == Template(text).substitute(FIELDS)
+
+def test_compile_template_rejects_invalid_placeholders():
+    with pytest.raises(ValueError, match='offset 6'):
+        compile_template('Hello $ there')
+
+def test_shipped_templates_compile_once():
+    templates = TemplateSet(DEFAULT_TEMPLATE_DIR)
+    for name in sorted(os.listdir(DEFAULT_TEMPLATE_DIR)):
+        assert templates.get(name) is templates.get(name)
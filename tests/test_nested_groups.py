@@ -0,0 +1,39 @@
+import ad_auditor
+from synthetic_directory import BASE_DN, GROUP_PREFIX
+
+def by_cn(entries, cn):
+    return next(entry for entry in entries if entry['raw'].get('cn') == [cn])
+
+def close_cycle(entries):
+    # The generator nests NG_00001 in NG_00000; nesting NG_00000 back in NG_00001 makes a cycle
+    outer, inner = by_cn(entries, 'NG_00000'), by_cn(entries, 'NG_00001')
+    inner['raw']['member'].append(outer['dn'])
+    outer['raw']['memberOf'].append(inner['dn'])
+
+def collect_cyclic(mock_directory):
+    entries = mock_directory(groups_config='expand_nested = yes', edit=close_cycle, users=40, groups=3,
+                             groups_per_user=1, nested_groups=2, nesting_depth=2, nested_members=4)
+    outer, inner = by_cn(entries, 'NG_00000'), by_cn(entries, 'NG_00001')
+    parent = next(entry for entry in entries if outer['dn'] in entry['raw'].get('member', []) and entry is not inner)
+    group_members, _ = ad_auditor.collect_memberships(ad_auditor.ldap_connection(), BASE_DN, [GROUP_PREFIX])
+    return dict(group_members), parent, outer, inner
+
+def people(group):
+    return [dn for dn in group['raw']['member'] if dn.startswith('CN=User')]
+
+def test_expand_nested_groups_survives_a_cycle(mock_directory, capsys):
+    group_members, parent, outer, inner = collect_cyclic(mock_directory)
+
+    assert 'Nested group cycle detected: ' in capsys.readouterr().out
+    members = {dn.lower() for dn in group_members[parent['raw']['cn'][0]]}
+    assert {dn.lower() for dn in people(outer) + people(inner)} <= members
+    assert outer['dn'].lower() not in members and inner['dn'].lower() not in members
+
+def test_expand_nested_groups_records_the_inheritance_path(mock_directory):
+    _, parent, outer, inner = collect_cyclic(mock_directory)
+
+    direct = {dn.lower() for dn in parent['raw']['member'] + outer['raw']['member']}
+    inherited = [dn.lower() for dn in people(inner) if dn.lower() not in direct]
+    assert inherited
+    for dn in inherited:
+        assert ad_auditor.run_state.membership_paths[(dn, parent['raw']['cn'][0])] == ('NG_00000', 'NG_00001')
@@ -0,0 +1,73 @@
+import pytest
+
+import ad_auditor
+
+def batches(*managers):
+    """
+    Builds manager_batches and due_rank from (manager, [username, ...]) pairs, ranking
+    users by their number: user01 is the most overdue.
+    """
+    manager_batches = {
+        manager: [(username, f"{username}@bench.local", username.title()) for username in usernames]
+        for manager, usernames in managers
+    }
+    due_rank = {username: int(username[4:]) for _, usernames in managers for username in usernames}
+    return manager_batches, due_rank
+
+def recipients_and_users(sends):
+    return [(manager, [user[0] for user in users]) for manager, users in sends]
+
+def test_schedule_sends_round_robins_managers_in_due_order(mock_directory):
+    mock_directory(users=1, groups=1)
+    manager_batches, due_rank = batches(
+        ('busy@bench.local', ['user01', 'user02', 'user03', 'user05']),
+        ('quiet@bench.local', ['user04', 'user06']),
+    )
+
+    sends = ad_auditor.schedule_sends(manager_batches, due_rank)
+
+    assert recipients_and_users(sends) == [
+        ('busy@bench.local', ['user01']), ('quiet@bench.local', ['user04']),
+        ('busy@bench.local', ['user02']), ('quiet@bench.local', ['user06']),
+        ('busy@bench.local', ['user03']),
+        ('busy@bench.local', ['user05']),
+    ]
+    assert ad_auditor.run_state.emails_deferred == 0
+
+def test_schedule_sends_defers_the_least_overdue_past_the_budget(mock_directory):
+    mock_directory(users=1, groups=1, extra_config='[schedule]\nmax_emails_per_run = 3')
+    manager_batches, due_rank = batches(
+        ('busy@bench.local', ['user01', 'user02', 'user03', 'user05']),
+        ('quiet@bench.local', ['user04', 'user06']),
+    )
+
+    sends = ad_auditor.schedule_sends(manager_batches, due_rank)
+
+    assert recipients_and_users(sends) == [
+        ('busy@bench.local', ['user01']), ('busy@bench.local', ['user02']), ('busy@bench.local', ['user03']),
+    ]
+    assert ad_auditor.run_state.emails_deferred == 3
+
+def test_schedule_sends_counts_a_digest_as_one_email(mock_directory):
+    mock_directory(users=1, groups=1, argv=['--digest'], extra_config='[schedule]\nmax_emails_per_run = 1')
+    manager_batches, due_rank = batches(
+        ('busy@bench.local', ['user01', 'user02', 'user03']),
+        ('quiet@bench.local', ['user04']),
+    )
+
+    sends = ad_auditor.schedule_sends(manager_batches, due_rank)
+
+    assert recipients_and_users(sends) == [('busy@bench.local', ['user01', 'user02', 'user03'])]
+    assert ad_auditor.run_state.emails_deferred == 1
+
+def test_sharded_runs_split_the_schedule_limits(mock_directory):
+    mock_directory(users=1, groups=1, argv=['--shards', '4'], extra_config=(
+        '[schedule]\nmessages_per_second = 10\nburst = 8\nmax_concurrent_per_domain = 4\nmax_emails_per_run = 100'
+    ))
+
+    settings = ad_auditor.settings
+    assert (settings.SEND_RATE, settings.SEND_BURST, settings.SEND_DOMAIN_CONCURRENCY, settings.SEND_RUN_BUDGET) == (2.5, 2, 1, 25)
+
+def test_sharded_runs_refuse_a_budget_smaller_than_the_shard_count(mock_directory):
+    with pytest.raises(SystemExit):
+        mock_directory(users=1, groups=1, argv=['--shards', '4'], extra_config='[schedule]\nmax_emails_per_run = 3')
@@ -0,0 +1,28 @@
+import ad_auditor
+from synthetic_directory import BASE_DN, GROUP_PREFIX
+
+def test_shard_of_matches_mysql_crc32():
+    # MySQL: SELECT CRC32('MySQL') -> 3259397556, CRC32('mysql') -> 2501908538
+    assert ad_auditor.shard_of('MySQL', 2 ** 32) == 3259397556
+    assert ad_auditor.shard_of('mysql', 2 ** 32) == 2501908538
+    assert ad_auditor.shard_of('mysql', 7) == 2501908538 % 7
+
+def test_shard_of_spreads_keys_over_every_shard():
+    shards = [ad_auditor.shard_of(f"manager{i:05d}@bench.local", 4) for i in range(200)]
+    assert set(shards) == {0, 1, 2, 3}
+    assert ad_auditor.shard_of(None, 4) == ad_auditor.shard_of('', 4) == 0
+
+def test_group_shards_partition_the_directory(mock_directory):
+    entries = mock_directory(users=60, groups=12)
+    expected = {entry['raw']['cn'][0]: sorted(entry['raw']['member']) for entry in entries
+                if entry['raw'].get('cn', [''])[0].startswith(GROUP_PREFIX)}
+    conn = ad_auditor.ldap_connection()
+
+    seen = {}
+    for shard in range(3):
+        ad_auditor.run_state.group_shard = (shard, 3)
+        for group in ad_auditor.search_groups_in_parallel(conn, BASE_DN, [GROUP_PREFIX], ('member', 'cn')):
+            assert group['cn'] not in seen
+            assert ad_auditor.shard_of(group['cn'], 3) == shard
+            seen[group['cn']] = sorted(group['members'])
+    assert seen == expected
@@ -0,0 +1,61 @@
+import os
+import time
+
+import ad_auditor
+from synthetic_directory import GROUP_PREFIX
+
+def take_snapshot(mock_directory, groups_config=''):
+    mock_directory(groups_config=groups_config, users=30, groups=3, nested_groups=2)
+    ad_auditor.settings.live_refresh = True
+    group_members, members_by_dn, conn = ad_auditor.directory_view()
+    ad_auditor.settings.live_refresh = False
+    assert conn is not None and os.path.exists(ad_auditor.settings.SNAPSHOT_PATH)
+    return group_members, members_by_dn
+
+def test_snapshot_scope_covers_prefixes_and_nesting(mock_directory):
+    mock_directory(groups_config='expand_nested = no')
+    flat = ad_auditor.snapshot_scope()
+    ad_auditor.settings.GROUP_PREFIXES = [GROUP_PREFIX.lower()]
+    assert ad_auditor.snapshot_scope() == flat
+
+    ad_auditor.settings.EXPAND_NESTED = True
+    nested = ad_auditor.snapshot_scope()
+    ad_auditor.settings.NESTED_FAST_PATH = False
+    assert len({flat, nested, ad_auditor.snapshot_scope()}) == 3
+
+def test_open_snapshot_answers_from_a_fresh_snapshot(mock_directory):
+    group_members, members_by_dn = take_snapshot(mock_directory)
+
+    snap = ad_auditor.open_snapshot()
+    assert snap is not None
+    try:
+        cached_members, cached_by_dn = ad_auditor.load_snapshot(snap)
+    finally:
+        snap.close()
+    assert sorted((name, sorted(members)) for name, members in cached_members) == \
+        sorted((name, sorted(m.lower() for m in members)) for name, members in group_members)
+    assert set(cached_by_dn) <= set(members_by_dn)
+
+def test_open_snapshot_misses_when_the_scope_changes(mock_directory):
+    take_snapshot(mock_directory)
+
+    ad_auditor.settings.EXPAND_NESTED = True
+    assert ad_auditor.open_snapshot() is None
+    ad_auditor.settings.EXPAND_NESTED = False
+    ad_auditor.settings.GROUP_PREFIXES = ['SG_OTHER']
+    assert ad_auditor.open_snapshot() is None
+    assert ad_auditor.metrics.counters['snapshot_misses'] == 2
+
+def test_open_snapshot_misses_when_stale(mock_directory, monkeypatch):
+    take_snapshot(mock_directory)
+    ad_auditor.settings.SNAPSHOT_TTL_MINUTES = 10
+    taken_at = time.time()
+    monkeypatch.setattr(time, 'time', lambda: taken_at + 11 * 60)
+    assert ad_auditor.open_snapshot() is None
+
+def test_open_snapshot_misses_on_an_unreadable_file(mock_directory):
+    mock_directory()
+    with open(ad_auditor.settings.SNAPSHOT_PATH, 'wb') as f:
+        f.write(b'not a snapshot' * 100)
+    assert ad_auditor.open_snapshot() is None
+    assert ad_auditor.metrics.counters['snapshot_misses'] == 1